@@ -0,0 +1,143 @@
+"""
+ASGI config for ACSystem project.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+e.g. ``uvicorn ACSystem.asgi:application``.
+
+Django 2.2 has no ASGI handler of its own, so the room-facing API
+(register, checkout, checkDetail, update) is served by the coroutines in
+ACSystemControl/ACSystemAsync.py; every other path is passed to the regular
+WSGI application on the same bounded thread pool.
+"""
+
+import io
+import logging
+import os
+import sys
+from urllib.parse import parse_qsl
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ACSystem.settings')
+
+wsgiApplication = get_wsgi_application()
+
+from ACSystemControl import ACSystemAsync  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    elif scope["type"] == "http":
+        handler = ACSystemAsync.ROUTES.get(scope["path"])
+        if handler is not None and scope["method"] in ("GET", "HEAD"):
+            query = dict(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True))
+            body = await handler(query)
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/json"),
+                            (b"content-length", str(len(body)).encode())],
+            })
+            await send({"type": "http.response.body", "body": body})
+        else:
+            await wsgi(scope, receive, send)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            ACSystemAsync.shutdownExecutor()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def wsgi(scope, receive, send):
+    """
+    在线程池中运行 Django 的 WSGI 应用，处理其他路径
+    """
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            break
+
+    started = {}
+
+    def startResponse(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+    def respond():
+        result = wsgiApplication(environ(scope, body), startResponse)
+        return result, iter(result)
+
+    try:
+        ok, result = await ACSystemAsync.runBlocking(respond)
+    except Exception:
+        logger.exception("WSGI application failed for %s", scope["path"])
+        await send({"type": "http.response.start", "status": 500, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+        return
+    if not ok:
+        await send({"type": "http.response.start", "status": 503, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+        return
+    result, chunks = result
+
+    await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+    try:
+        # 流式返回（SSE 等）逐块在线程池中取出
+        while True:
+            ok, chunk = await ACSystemAsync.runBlocking(next, chunks, None)
+            if not ok or chunk is None:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(result, "close"):
+            await ACSystemAsync.runBlocking(result.close)
+
+
+def environ(scope, body):
+    """
+    由 ASGI 的 scope 构造 WSGI environ
+    """
+    server = scope.get("server") or ("localhost", 80)
+    env = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "CONTENT_LENGTH": str(len(body)),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            env[name] = value
+        elif name == "CONTENT_LENGTH":
+            continue
+        else:
+            key = "HTTP_" + name
+            env[key] = env[key] + "," + value if key in env else value
+    return env
@@ -1,4 +1,5 @@
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
 import json
 from . import ACSystemServer, Response
 
@@ -31,12 +32,12 @@ def startup(request):
         if instanceNum is not None:
             SETTING.INSTANCE_NUM = instanceNum
 
-        if not hasattr(SETTING, "roomNumber"):
+        if not hasattr(SETTING, "roomNum"):
             statusCode = 410
 
         if statusCode != 200:
             response = Response.RespondPack(statusCode)
-            return HttpResponse(json.dumps(dict(response)), content_type="application/json")
+            return HttpResponse(response.toJSON(), content_type="application/json")
 
         server = ACSystemServer.ACServer(SETTING)
         server.startup()
@@ -45,7 +46,7 @@ def startup(request):
         statusCode = 401
 
     response = Response.RespondPack(statusCode)
-    return HttpResponse(json.dumps(dict(response)), content_type="application/json")
+    return HttpResponse(response.toJSON(), content_type="application/json")
 
 
 def shutdown(request):
@@ -57,9 +58,9 @@ def shutdown(request):
     global server
 
     statusCode = 200
-    server.status = "off"
+    server.shutdown()
     response = Response.RespondPack(statusCode)
-    return HttpResponse(json.dumps(dict(response)), content_type="application/json")
+    return HttpResponse(response.toJSON(), content_type="application/json")
 
 
 def destroy(request):
@@ -71,10 +72,12 @@ def destroy(request):
     global server
 
     statusCode = 200
+    if server is not None:
+        server.shutdown()
     del server
     server = None
     response = Response.RespondPack(statusCode)
-    return HttpResponse(json.dumps(dict(response)), content_type="application/json")
+    return HttpResponse(response.toJSON(), content_type="application/json")
 
 
 def config(request):
@@ -112,7 +115,7 @@ def config(request):
         statusCode = 410
 
     response = Response.RespondPack(statusCode)
-    return HttpResponse(json.dumps(dict(response)), content_type="application/json")
+    return HttpResponse(response.toJSON(), content_type="application/json")
 
 
 def register(request):
@@ -133,7 +136,7 @@ def register(request):
         statusCode = server.register(roomNumber, ID)
 
     response = Response.RespondPack(statusCode)
-    return HttpResponse(json.dumps(dict(response)), content_type="application/json")
+    return HttpResponse(response.toJSON(), content_type="application/json")
 
 
 def checkout(request):
@@ -144,6 +147,7 @@ def checkout(request):
     """
     global server
     statusCode = 200
+    bill = None
     roomNumber = request.GET.get("roomNumber", default=None)
     ID = request.GET.get("ID", default=None)
 
@@ -152,10 +156,10 @@ def checkout(request):
     elif server is None or server.status == "off":
         statusCode = 400
     else:
-        statusCode = server.checkout(roomNumber, ID)
+        statusCode, bill = server.checkout(roomNumber, ID)
 
-    response = Response.RespondPack(statusCode)
-    return HttpResponse(json.dumps(dict(response)), content_type="application/json")
+    response = Response.CheckoutResponse(statusCode, bill)
+    return HttpResponse(response.toJSON(), content_type="application/json")
 
 
 def checkDetail(request):
@@ -167,6 +171,7 @@ def checkDetail(request):
     global server
     statusCode = 200
     detail = None
+    page = None
 
     roomNumber = request.GET.get("roomNumber", default=None)
     ID = request.GET.get("ID", default=None)
@@ -176,15 +181,28 @@ def checkDetail(request):
     elif server is None or server.status == "off":
         statusCode = 400
     else:
-        statusCode, detail = server.checkDetail(roomNumber, ID)
+        # 分页：cursor 是上一页返回的 nextCursor，limit 是一页的送风段数
+        page = server.parsePage(request.GET.get("cursor", default=None), request.GET.get("limit", default=None))
+        if page is None:
+            statusCode = 410
+        else:
+            statusCode, detail = server.checkDetail(roomNumber, ID)
 
     response = Response.DetailResponse(statusCode, detail)
-    return HttpResponse(json.dumps(dict(response)), content_type="application/json")
+    if statusCode != 200:
+        return HttpResponse(response.toJSON(), content_type="application/json")
+
+    # 详单边读数据库边返回
+    position, limit = page
+    records = server.detailRecords(roomNumber, position)
+    return StreamingHttpResponse(response.stream(records, limit, SETTING.DETAIL_CHUNK_SIZE),
+                                 content_type="application/json")
 
 
 def update(request):
     """
     处理客户的请求包/心跳包
+    返回调度风速和建议的下一次心跳间隔 interval（秒）
 
     返回码报错信息请查看 Response.py
     :param request:
@@ -193,6 +211,7 @@ def update(request):
     global server
     statusCode = 200
     speed = 0
+    interval = SETTING.HEARTBEAT_IDLE
 
     invalid = False
     roomNumber = request.GET.get("roomNumber", default=None)
@@ -211,6 +230,259 @@ def update(request):
         statusCode = 400
     else:
         statusCode, speed = server.update(roomNumber, state, status)
+        interval = server.heartbeatInterval(roomNumber)
+
+    return HttpResponse(Response.UpdateResponse.payload(statusCode, speed, interval), content_type="application/json")
+
+
+def report(request):
+    """
+    经理查看统计报表
+    type: day 日报（缺省） week 周报 month 月报 year 年报
+    date: 报表周期包含的日期 YYYY-MM-DD，缺省今天
+    :param request:
+    :return:
+    """
+    global server
+    statusCode = 200
+    data = None
+
+    if server is None or server.status == "off":
+        statusCode = 400
+    else:
+        statusCode, data = server.report(request.GET.get("type", default=None), request.GET.get("date", default=None))
+
+    response = Response.ReportResponse(statusCode, data)
+    return HttpResponse(response.toJSON(), content_type="application/json")
+
+
+def analytics(request):
+    """
+    经理查询历史记录的统计（需要 numpy）
+    type: usage 每个房间每个时间桶的送风时长和费用    counts 每个房间每个时间桶的各项次数
+    start/end: 时间段，ISO 格式
+    bucket: 时间桶的长度（秒）
+    :param request:
+    :return:
+    """
+    global server
+    statusCode = 200
+    data = None
+
+    if server is None or server.status == "off":
+        statusCode = 400
+    else:
+        statusCode, data = server.analytics(request.GET.get("type", default=None),
+                                            request.GET.get("start", default=None),
+                                            request.GET.get("end", default=None),
+                                            request.GET.get("bucket", default=None))
+
+    response = Response.AnalyticsResponse(statusCode, data)
+    return HttpResponse(response.toJSON(), content_type="application/json")
+
+
+# 导出文件的格式 -> Content-Type
+EXPORT_CONTENT_TYPES = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def exportResponse(statusCode, filename, content, fileFormat):
+    """
+    导出的文件边生成边返回；出错时返回 JSON
+    """
+    if statusCode != 200:
+        response = Response.RespondPack(statusCode)
+        return HttpResponse(response.toJSON(), content_type="application/json")
+    if fileFormat is None:
+        fileFormat = "csv"
+    response = StreamingHttpResponse(content, content_type=EXPORT_CONTENT_TYPES[fileFormat])
+    response["Content-Disposition"] = 'attachment; filename="%s.%s"' % (filename, fileFormat)
+    return response
+
+
+def exportReport(request):
+    """
+    经理下载统计报表
+    type: day 日报（缺省） week 周报 month 月报 year 年报
+    date: 报表周期包含的日期 YYYY-MM-DD，缺省今天
+    format: csv（缺省） xlsx（需要 openpyxl）
+    :param request:
+    :return:
+    """
+    global server
+    fileFormat = request.GET.get("format", default=None)
+    filename = content = None
+
+    if server is None or server.status == "off":
+        statusCode = 400
+    else:
+        statusCode, filename, content = server.exportReport(request.GET.get("type", default=None),
+                                                            request.GET.get("date", default=None),
+                                                            fileFormat)
+
+    return exportResponse(statusCode, filename, content, fileFormat)
+
+
+def exportRecords(request):
+    """
+    经理下载一个时间段的全部使用记录
+    start/end: 时间段，ISO 格式
+    format: csv（缺省） xlsx（需要 openpyxl）
+    :param request:
+    :return:
+    """
+    global server
+    fileFormat = request.GET.get("format", default=None)
+    filename = content = None
+
+    if server is None or server.status == "off":
+        statusCode = 400
+    else:
+        statusCode, filename, content = server.exportRecords(request.GET.get("start", default=None),
+                                                             request.GET.get("end", default=None),
+                                                             fileFormat)
+
+    return exportResponse(statusCode, filename, content, fileFormat)
 
-    response = Response.UpdateResponse(statusCode, speed)
-    return HttpResponse(json.dumps(dict(response)), content_type="application/json")
+
+def metrics(request):
+    """
+    管理员查看调度器运行指标
+    调度延迟（各风速入队到送风的分布）、等待队列长度、调出/取消次数、每轮调度耗时
+    :param request:
+    :return:
+    """
+    global server
+    statusCode = 200
+    data = None
+
+    if server is None or server.status == "off":
+        statusCode = 400
+    else:
+        data = server.getMetrics()
+
+    response = Response.MetricsResponse(statusCode, data)
+    return HttpResponse(response.toJSON(), content_type="application/json")
+
+
+@csrf_exempt
+def updateMany(request):
+    """
+    楼层网关批量上传多个房间的请求包/心跳包
+    POST 的 JSON: {"rooms": [{"roomNumber": .., "status": .., "ct": .., "tt": .., "cs": .., "ts": ..}, ...]}
+    每个房间的返回和 update 相同，按上传的顺序放在 results 中
+
+    返回码报错信息请查看 Response.py
+    :param request:
+    :return:
+    """
+    global server
+    statusCode = 200
+    results = None
+
+    rooms = None
+    try:
+        rooms = json.loads(request.body.decode("utf-8"))["rooms"]
+    except (ValueError, KeyError, TypeError):
+        pass
+
+    if request.method != "POST" or not isinstance(rooms, list) or len(rooms) > SETTING.UPDATE_BATCH_MAX:
+        statusCode = 410
+    elif server is None or server.status == "off":
+        statusCode = 400
+    else:
+        results = [None] * len(rooms)
+        updates = []
+        indexes = []
+        for idx, room in enumerate(rooms):
+            # ct -> currentTemperature  tt -> targetTemperature
+            # cs -> currentSpeed        ts -> targetSpeed
+            if not isinstance(room, dict) or \
+                    any(room.get(key) is None for key in ("roomNumber", "status", "ct", "tt", "cs", "ts")):
+                results[idx] = (410, 0)
+                continue
+            updates.append((room["roomNumber"], [room["ct"], room["tt"], room["cs"], room["ts"]], room["status"]))
+            indexes.append(idx)
+
+        for idx, result in zip(indexes, server.updateMany(updates)):
+            results[idx] = result
+
+        for idx, (code, speed) in enumerate(results):
+            roomNumber = rooms[idx].get("roomNumber") if isinstance(rooms[idx], dict) else None
+            interval = server.heartbeatInterval(roomNumber)
+            results[idx] = dict(roomNumber=roomNumber, **dict(Response.UpdateResponse(code, speed, interval)))
+
+    response = Response.BatchUpdateResponse(statusCode, results)
+    return HttpResponse(response.toJSON(), content_type="application/json")
+
+
+def watch(request):
+    """
+    长轮询：等待房间的送风风速发生变化
+    客户端带上上一次返回的 version，风速变化（被调度送风/被调出）时立即返回，
+    超时返回当前风速；第一次请求不带 version，立即返回当前风速和 version
+    :param request:
+    :return:
+    """
+    global server
+    version = 0
+    speed = 0
+
+    roomNumber = request.GET.get("roomNumber", default=None)
+
+    if roomNumber is None:
+        statusCode = 410
+    elif server is None or server.status == "off":
+        statusCode = 400
+    else:
+        statusCode, version, speed = server.watch(roomNumber, request.GET.get("version", default=None),
+                                                  request.GET.get("timeout", default=None))
+
+    response = Response.WatchResponse(statusCode, version, speed)
+    return HttpResponse(response.toJSON(), content_type="application/json")
+
+
+def events(request):
+    """
+    SSE：保持一个连接，房间的送风风速每次变化推送一个 speed 事件
+    事件的 id 是 version，data 和 watch 的返回相同；没有变化时定期发送保活注释
+    房间退房或者服务器关闭时结束
+    :param request:
+    :return:
+    """
+    global server
+
+    roomNumber = request.GET.get("roomNumber", default=None)
+
+    if roomNumber is None:
+        statusCode = 410
+    elif server is None or server.status == "off":
+        statusCode = 400
+    else:
+        # 断线重连时浏览器在 Last-Event-ID 中带上最后收到的 version
+        version = request.GET.get("version", default=request.META.get("HTTP_LAST_EVENT_ID"))
+        statusCode, version, speed = server.watch(roomNumber, version)
+
+    if statusCode != 200:
+        response = Response.RespondPack(statusCode)
+        return HttpResponse(response.toJSON(), content_type="application/json")
+
+    def stream(version, speed):
+        yield "id: %d\nevent: speed\ndata: %s\n\n" % (
+            version, json.dumps(dict(Response.WatchResponse(200, version, speed))))
+        while server is not None and server.status == "on":
+            statusCode, newVersion, speed = server.watch(roomNumber, version)
+            if statusCode != 200:
+                break
+            if newVersion == version:
+                yield ": keepalive\n\n"
+                continue
+            version = newVersion
+            yield "id: %d\nevent: speed\ndata: %s\n\n" % (
+                version, json.dumps(dict(Response.WatchResponse(statusCode, version, speed))))
+
+    response = StreamingHttpResponse(stream(version, speed), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    return response
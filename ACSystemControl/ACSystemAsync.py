@@ -0,0 +1,175 @@
+"""
+面向房间控制器的异步接口（ASGI，见 ACSystem/asgi.py）
+和 ACSystem.py 中的同名视图行为相同，参数是解析好的 query string，返回 JSON bytes
+连接由事件循环持有，读写数据库、等待请求队列这些阻塞的操作放到有界的线程池中执行，
+没有变化的心跳直接在内存中完成，不占用线程池
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from . import ACSystem, Response
+
+executor = None
+# 已经提交到线程池、还没有完成的任务数（只在事件循环线程中读写）
+pending = 0
+
+
+def getExecutor():
+    """
+    执行阻塞操作的线程池，第一次使用时按 SETTING.ASYNC_EXECUTOR_WORKERS 创建
+    :return: ThreadPoolExecutor
+    """
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(ACSystem.SETTING.ASYNC_EXECUTOR_WORKERS, thread_name_prefix="ACSystemAsync")
+    return executor
+
+
+def shutdownExecutor():
+    global executor
+    if executor is not None:
+        executor.shutdown(wait=True)
+        executor = None
+
+
+async def runBlocking(func, *args):
+    """
+    在线程池中执行阻塞的操作
+    排队的任务超过 SETTING.ASYNC_EXECUTOR_QUEUE 时不再提交，调用方返回 417，客户端稍后重试
+    :param func: 阻塞的函数
+    :param args: 参数
+    :return: ok         是否执行了
+             result     函数的返回值
+    """
+    global pending
+    if pending >= ACSystem.SETTING.ASYNC_EXECUTOR_QUEUE:
+        return False, None
+    pending += 1
+    try:
+        return True, await asyncio.get_running_loop().run_in_executor(getExecutor(), func, *args)
+    finally:
+        pending -= 1
+
+
+async def register(query):
+    """
+    前台完成旅客登记
+    :param query: 请求参数
+    :return: bytes
+    """
+    server = ACSystem.server
+    roomNumber = query.get("roomNumber")
+    ID = query.get("ID")
+    if roomNumber is None or ID is None:
+        statusCode = 410
+    elif server is None or server.status == "off":
+        statusCode = 400
+    else:
+        ok, statusCode = await runBlocking(server.register, roomNumber, ID)
+        if not ok:
+            statusCode = 417
+
+    return Response.RespondPack.payload(statusCode)
+
+
+async def checkout(query):
+    """
+    前台办理用户退房手续
+    :param query: 请求参数
+    :return: bytes
+    """
+    server = ACSystem.server
+    bill = None
+    roomNumber = query.get("roomNumber")
+    ID = query.get("ID")
+    if roomNumber is None or ID is None:
+        statusCode = 410
+    elif server is None or server.status == "off":
+        statusCode = 400
+    else:
+        ok, result = await runBlocking(server.checkout, roomNumber, ID)
+        if ok:
+            statusCode, bill = result
+        else:
+            statusCode = 417
+
+    return Response.CheckoutResponse(statusCode, bill).toJSON()
+
+
+async def checkDetail(query):
+    """
+    前台查询用户使用详单
+    :param query: 请求参数
+    :return: bytes
+    """
+    server = ACSystem.server
+    detail = None
+    records = None
+    nextCursor = None
+    roomNumber = query.get("roomNumber")
+    ID = query.get("ID")
+    page = None
+    if server is not None:
+        page = server.parsePage(query.get("cursor"), query.get("limit"))
+    if roomNumber is None or ID is None:
+        statusCode = 410
+    elif server is None or server.status == "off":
+        statusCode = 400
+    elif page is None:
+        statusCode = 410
+    else:
+        ok, result = await runBlocking(server.checkDetail, roomNumber, ID)
+        if ok:
+            statusCode, detail = result
+        else:
+            statusCode = 417
+        if statusCode == 200:
+            # 一页详单的大小有上限，在线程池中读出整页
+            ok, result = await runBlocking(server.detailPage, roomNumber, *page)
+            if ok:
+                records, nextCursor = result
+            else:
+                statusCode = 417
+
+    return Response.DetailResponse(statusCode, detail, records, nextCursor).toJSON()
+
+
+async def update(query):
+    """
+    处理客户的请求包/心跳包
+    :param query: 请求参数
+    :return: bytes
+    """
+    server = ACSystem.server
+    speed = 0
+    interval = ACSystem.SETTING.HEARTBEAT_IDLE
+    roomNumber = query.get("roomNumber")
+    status = query.get("status")
+    # ct -> currentTemperature  tt -> targetTemperature
+    # cs -> currentSpeed        ts -> targetSpeed
+    state = [query.get("ct"), query.get("tt"), query.get("cs"), query.get("ts")]
+
+    if roomNumber is None or status is None or None in state:
+        statusCode = 410
+    elif server is None or server.status == "off":
+        statusCode = 400
+    else:
+        # 没有变化的心跳不需要线程池
+        result = server.heartbeat(roomNumber, state, status)
+        if result is None:
+            ok, result = await runBlocking(server.update, roomNumber, state, status)
+            if not ok:
+                result = (417, 0)
+        statusCode, speed = result
+        interval = server.heartbeatInterval(roomNumber)
+
+    return Response.UpdateResponse.payload(statusCode, speed, interval)
+
+
+# 由异步接口处理的路径，其他路径交给 Django
+ROUTES = {
+    "/admin/register": register,
+    "/admin/checkout": checkout,
+    "/admin/checkDetail": checkDetail,
+    "/admin/update": update,
+}
@@ -1,11 +1,23 @@
-import queue
-import threading
+import math
+from datetime import date, datetime
+from itertools import islice
+
+from django.db.models import F, Max, Q
 
 from . import models
+from .Modules import Clock
 from .Modules.StatManager import StatManager
 from .Modules.RoomBindMapper import RoomBindMapper
 from .Modules.ACBillingManager import ACBillingManager
 from .Modules.ACStateManager import ACStateManager
+from .Modules.RecordSink import RecordSink
+from .Modules.RecordAnalytics import RecordAnalytics
+from .Modules.ReportExporter import ReportExporter
+from .Modules.HeartbeatListener import HeartbeatListener
+from .Modules.SpeedNotifier import SpeedNotifier
+from .Modules.RequestChannel import RequestChannel
+from .Modules.AsyncScheduler import AsyncPriorityScheduler, AsyncRoundScheduler
+from .Modules.ShardedScheduler import ShardRouter, ShardedScheduler
 from .Modules.Scheduler import ACAirRequest, PriorityScheduler, RoundScheduler, ServingCluster, Request
 
 
@@ -16,15 +28,92 @@ class DefaultSetting:
     INSTANCE_NUM 实例数量
     AC_START_UP_TARGET_TEMPERATURE 开启空调时候的默认设置温度
     AC_START_UP_SPEED 开启空调时候的默认风速
+    ENGINE 调度引擎    "thread" 调度器线程    "asyncio" 事件循环上的调度协程
+    SCHEDULER 调度策略    "priority" 优先级调度    "round" 优先级 + 时间片轮转调度
+    TIME_SLICE 时间片调度的时间片长度（秒）
+    TIME_SLICE_TICK 时间片调度的时间轮精度（秒）
+    BATCH_INGEST 调度器一次取出全部排队的请求，按房间合并后只做一次调度
+    REQUEST_QUEUE_CAPACITY 请求队列容量
+    REQUEST_PUT_TIMEOUT 请求队列满时 update 最多等待的秒数，超时返回 417，客户端下一次心跳重试
+    SHARD_NUM 调度分片数量，大于 1 时每个分片有自己的服务对象集群和调度器线程（仅 "thread" 引擎）
+    SHARD_MODE 分片方式    "floor" 按楼层    "range" 按房间号区间
+    ROOMS_PER_FLOOR 每层的房间号跨度（1205 -> 12 层）
+    SHARD_BORROW 是否允许分片之间借用空闲的服务对象
+    STATE_FLUSH_INTERVAL 内存中的空调状态写入数据库的最长间隔（秒）
+    RECORD_BATCH_SIZE 记录（Record）一次批量写入的最大条数，积压达到这个数量时提前写数据库
+    RECORD_FLUSH_INTERVAL 记录写入数据库的最长间隔（秒）
+    TEMPERATURE_PERSIST_INTERVAL 没有变化的心跳只更新内存，房间当前温度最多每隔多少秒写一次数据库（0 每次心跳都写）
+    UPDATE_BATCH_MAX 批量更新一次最多包含的房间数
+    UDP_HEARTBEAT_PORT UDP 心跳监听端口，None 表示不启动（包格式见 Modules/HeartbeatListener.py）
+    UDP_HEARTBEAT_HOST UDP 心跳监听地址
+    UDP_HEARTBEAT_BATCH_MAX UDP 心跳一批最多处理的数量
+    ASYNC_EXECUTOR_WORKERS ASGI 入口执行阻塞操作（数据库、请求队列）的线程数
+    ASYNC_EXECUTOR_QUEUE ASGI 入口排队等待线程池的任务上限，超过时返回 417
+    HEARTBEAT_WAITING/HEARTBEAT_SERVING/HEARTBEAT_IDLE 建议的心跳间隔（秒）：等待送风/正在送风/关机或休眠的房间
+    HEARTBEAT_MIN/HEARTBEAT_MAX 建议的心跳间隔的范围（秒），间隔取 2 的整数次幂
+    HEARTBEAT_QUEUE_TARGET 请求队列积压超过这个数量时按比例延长心跳间隔
+    HEARTBEAT_PASS_TARGET 调度一轮的耗时超过这个时长（秒）时按比例延长心跳间隔
+    HEARTBEAT_LOAD_SAMPLE 重新计算负载的间隔（秒）
+    WATCH_TIMEOUT 长轮询/SSE 等待风速变化的最长时间（秒），超时返回当前风速（SSE 发送保活注释）
+    DETAIL_PAGE_SIZE/DETAIL_PAGE_MAX 详单一页缺省/最多的送风段数
+    DETAIL_CHUNK_SIZE 详单每次从数据库读取的记录数，也是流式返回时每一块包含的送风段数
+    ANALYTICS_CACHE_SIZE 历史记录分析缓存的时间段数量（需要 numpy）
+    ANALYTICS_SETTLE_MARGIN 时间段结束超过 RECORD_FLUSH_INTERVAL 加上这个秒数之后，历史记录分析才缓存它的数组
+    ANALYTICS_CHUNK_SIZE 历史记录分析每次从数据库读取的行数
+    ANALYTICS_BUCKET_MAX 历史记录分析一个房间最多的时间桶数量
+    EXPORT_CHUNK_SIZE 导出报表时每次从数据库读取的行数，也是 CSV 每一块包含的行数
+    STAT_CHUNK_SIZE 启动时在后台恢复统计报表每次从数据库读取的记录数
     """
     MODE = 1
     INSTANCE_NUM = 3
+    ENGINE = "thread"
+    SCHEDULER = "priority"
+    TIME_SLICE = 120
+    TIME_SLICE_TICK = 1
+    BATCH_INGEST = True
+    REQUEST_QUEUE_CAPACITY = 4096
+    REQUEST_PUT_TIMEOUT = 0.5
+    SHARD_NUM = 1
+    SHARD_MODE = "floor"
+    ROOMS_PER_FLOOR = 100
+    SHARD_BORROW = True
+    STATE_FLUSH_INTERVAL = 1.0
+    RECORD_BATCH_SIZE = 500
+    RECORD_FLUSH_INTERVAL = 1.0
+    TEMPERATURE_PERSIST_INTERVAL = 60
+    UPDATE_BATCH_MAX = 1000
+    UDP_HEARTBEAT_PORT = None
+    UDP_HEARTBEAT_HOST = "0.0.0.0"
+    UDP_HEARTBEAT_BATCH_MAX = 256
+    ASYNC_EXECUTOR_WORKERS = 32
+    ASYNC_EXECUTOR_QUEUE = 4096
+    HEARTBEAT_WAITING = 2
+    HEARTBEAT_SERVING = 8
+    HEARTBEAT_IDLE = 32
+    HEARTBEAT_MIN = 1
+    HEARTBEAT_MAX = 64
+    HEARTBEAT_QUEUE_TARGET = 256
+    HEARTBEAT_PASS_TARGET = 0.05
+    HEARTBEAT_LOAD_SAMPLE = 1.0
+    WATCH_TIMEOUT = 30
+    DETAIL_PAGE_SIZE = 100
+    DETAIL_PAGE_MAX = 1000
+    DETAIL_CHUNK_SIZE = 100
+    ANALYTICS_CACHE_SIZE = 16
+    ANALYTICS_SETTLE_MARGIN = 5
+    ANALYTICS_CHUNK_SIZE = 10000
+    ANALYTICS_BUCKET_MAX = 100000
+    EXPORT_CHUNK_SIZE = 1000
+    STAT_CHUNK_SIZE = 1000
     AC_START_UP_TARGET_TEMPERATURE = 25
     AC_START_UP_SPEED = 2
     COOLING_WORK_TEMPERATURE_UPPERBOUND = 25
     COOLING_WORK_TEMPERATURE_LOWERBOUND = 18
     HEATING_WORK_TEMPERATURE_UPPERBOUND = 30
     HEATING_WORK_TEMPERATURE_LOWERBOUND = 25
+    # 当前模式的工作温度范围（缺省制冷）
+    WORK_TEMPERATURE_UPPERBOUND = COOLING_WORK_TEMPERATURE_UPPERBOUND
+    WORK_TEMPERATURE_LOWERBOUND = COOLING_WORK_TEMPERATURE_LOWERBOUND
 
 
 class Config:
@@ -40,18 +129,27 @@ class ACServer:
     def __init__(self, setting):
         # modules
         self.ACStateManager = None
+        self.RecordSink = None
+        self.SpeedNotifier = None
+        self.HeartbeatListener = None
+
+        # 负载系数（>= 1）和计算的时间，见 getLoadFactor
+        self.loadFactor = 1.0
+        self.loadSampleTime = None
         self.RoomBindMapper = None
         self.ACBillingManager = None
         self.StatManager = None
+        self.RecordAnalytics = None
+        self.ReportExporter = None
         self.priorityScheduler = None
         self.roundScheduler = None
+        # 当前使用的调度器
+        self.scheduler = None
 
         # Serving Instance
         self.cluster = None
-        # Request Queue Resources
+        # Request Queue
         self.RequestQueue = None
-        self.RequestQueueLock = threading.Lock()
-        self.RequestQueueNotEmptyEvent = threading.Event()
 
         # server setting
         self.SETTING = setting
@@ -59,27 +157,114 @@ class ACServer:
 
         self.status = "off"
 
-    def startup(self):
+    def startup(self, engine=None):
         """
         启动服务器，初始化相关模块
+        :param engine: 调度引擎  "thread" 调度器线程    "asyncio" 事件循环上的调度协程
+                       缺省使用 SETTING.ENGINE
         :return:
         """
         self.status = "on"
+        if engine is None:
+            engine = self.SETTING.ENGINE
 
         # 初始化相关模块
         self.RoomBindMapper = RoomBindMapper(self.roomNum)
-        self.ACStateManager = ACStateManager()
+        self.RecordSink = RecordSink(self.SETTING.RECORD_BATCH_SIZE, self.SETTING.RECORD_FLUSH_INTERVAL)
+        self.ACStateManager = ACStateManager(self.SETTING.STATE_FLUSH_INTERVAL,
+                                             self.RecordSink,
+                                             self.SETTING.TEMPERATURE_PERSIST_INTERVAL)
+        self.ACStateManager.start()
+        self.SpeedNotifier = SpeedNotifier()
+        self.ACStateManager.addListener(self.SpeedNotifier.publish)
         self.ACBillingManager = ACBillingManager()
+        self.ACStateManager.addListener(self.ACBillingManager.speedChanged)
         self.StatManager = StatManager()
+        # 统计只在内存中，在后台线程从数据库中已有的记录恢复，不阻塞启动请求；
+        # 恢复只读取现在已有的记录，之后产生的记录由监听者缓存，恢复完成之后再统计
+        lastId = models.Record.objects.aggregate(lastId=Max("id"))["lastId"] or 0
+        self.ACStateManager.addRecordListener(self.StatManager.addRecords)
+        self.StatManager.startRebuild(models.Record.objects.filter(id__lte=lastId).order_by("date", "id")
+                                      .iterator(chunk_size=self.SETTING.STAT_CHUNK_SIZE))
+        try:
+            self.RecordAnalytics = RecordAnalytics(self.SETTING.ANALYTICS_CACHE_SIZE,
+                                                   self.SETTING.ANALYTICS_CHUNK_SIZE,
+                                                   self.SETTING.RECORD_FLUSH_INTERVAL
+                                                   + self.SETTING.ANALYTICS_SETTLE_MARGIN)
+        except ImportError:
+            # 没有安装 numpy，历史记录分析不可用
+            self.RecordAnalytics = None
+        self.ReportExporter = ReportExporter(self.SETTING.EXPORT_CHUNK_SIZE)
 
         # 初始化调度器和服务对象
         self.cluster = ServingCluster(self.SETTING.INSTANCE_NUM)
-        self.RequestQueue = queue.Queue()
-        self.priorityScheduler = PriorityScheduler(self.SETTING.INSTANCE_NUM,
-                                                   self.cluster,
-                                                   self.RequestQueue,
-                                                   self.RequestQueueLock,
-                                                   self.RequestQueueNotEmptyEvent)
+        if engine == "asyncio":
+            # asyncio 调度器自己就是请求队列
+            if self.SETTING.SCHEDULER == "round":
+                self.roundScheduler = AsyncRoundScheduler(self.SETTING.INSTANCE_NUM,
+                                                          self.cluster,
+                                                          self.SETTING.TIME_SLICE,
+                                                          self.SETTING.REQUEST_QUEUE_CAPACITY,
+                                                          self.SETTING.BATCH_INGEST)
+                self.scheduler = self.roundScheduler
+            else:
+                self.priorityScheduler = AsyncPriorityScheduler(self.SETTING.INSTANCE_NUM,
+                                                                self.cluster,
+                                                                self.SETTING.REQUEST_QUEUE_CAPACITY,
+                                                                self.SETTING.BATCH_INGEST)
+                self.scheduler = self.priorityScheduler
+            self.RequestQueue = self.scheduler
+        elif int(self.SETTING.SHARD_NUM) > 1:
+            # 分片调度，每个分片有自己的集群、请求队列和调度器线程，调度组自己就是请求队列
+            router = ShardRouter(self.SETTING.SHARD_NUM,
+                                 self.SETTING.SHARD_MODE,
+                                 self.SETTING.ROOMS_PER_FLOOR,
+                                 self.roomNum)
+            timeSlice = self.SETTING.TIME_SLICE if self.SETTING.SCHEDULER == "round" else None
+            self.cluster = None
+            self.scheduler = ShardedScheduler(self.SETTING.INSTANCE_NUM,
+                                              router,
+                                              self.SETTING.REQUEST_QUEUE_CAPACITY,
+                                              self.SETTING.BATCH_INGEST,
+                                              self.SETTING.SHARD_BORROW,
+                                              timeSlice,
+                                              self.SETTING.TIME_SLICE_TICK)
+            self.RequestQueue = self.scheduler
+        else:
+            self.RequestQueue = RequestChannel(self.SETTING.REQUEST_QUEUE_CAPACITY)
+            if self.SETTING.SCHEDULER == "round":
+                self.roundScheduler = RoundScheduler(self.SETTING.INSTANCE_NUM,
+                                                     self.cluster,
+                                                     self.RequestQueue,
+                                                     self.SETTING.TIME_SLICE,
+                                                     self.SETTING.TIME_SLICE_TICK,
+                                                     self.SETTING.BATCH_INGEST)
+                self.scheduler = self.roundScheduler
+            else:
+                self.priorityScheduler = PriorityScheduler(self.SETTING.INSTANCE_NUM,
+                                                           self.cluster,
+                                                           self.RequestQueue,
+                                                           self.SETTING.BATCH_INGEST)
+                self.scheduler = self.priorityScheduler
+        self.scheduler.setStateManager(self.ACStateManager)
+        self.scheduler.start()
+
+        # 可选的 UDP 心跳监听
+        if self.SETTING.UDP_HEARTBEAT_PORT is not None:
+            self.HeartbeatListener = HeartbeatListener(self,
+                                                       self.SETTING.UDP_HEARTBEAT_HOST,
+                                                       self.SETTING.UDP_HEARTBEAT_PORT,
+                                                       self.SETTING.UDP_HEARTBEAT_BATCH_MAX)
+            self.HeartbeatListener.start()
+
+    def shutdown(self):
+        """
+        关闭服务器，把内存中的空调状态全部写入数据库
+        :return:
+        """
+        self.status = "off"
+        if self.ACStateManager is not None:
+            self.ACStateManager.flush()
 
     def register(self, roomNumber, ID):
         """
@@ -96,6 +281,7 @@ class ACServer:
             return statusCode
         try:
             self.ACStateManager.startAC(roomNumber)
+            self.ACBillingManager.checkIn(roomNumber)
         except:
             statusCode = 413
         return statusCode
@@ -105,20 +291,29 @@ class ACServer:
         住户离店
         :param roomNumber: 退房房间号
         :param ID: 退房身份证号码
-        :return: 411    房间号越界
-                 414    房间是空房
-                 415    入住人不匹配
-                 413    数据库出错
-                 200    退房成功
+        :return: status 411    房间号越界
+                        414    房间是空房
+                        415    入住人不匹配
+                        413    数据库出错
+                        200    退房成功
+                 bill   最终账单，见 RoomBill.toDict，房间没有退房时为 None
         """
+        bill = None
         status = self.RoomBindMapper.checkout(roomNumber, ID)
         if status != 200:
-            return status
+            return status, bill
 
         # 删除房间实例，并且将使用记录实例化
         # TODO 业务逻辑 : 后续经理报表还需要统计用户修改的次数，
         #  所以后面这个地方还要加上用户操作的统计以及相关的实例化
         try:
+            # 取消还在等待/服务的送风请求，把内存中的状态写入数据库之后再读使用记录
+            self.scheduler.withdraw(roomNumber)
+            self.ACStateManager.remove(roomNumber)
+            self.SpeedNotifier.remove(roomNumber)
+            # 计费已经结束，写数据库出错时也返回账单
+            bill = self.ACBillingManager.checkOut(roomNumber)
+
             _AC = models.AC.objects.get(roomNumber=roomNumber)
             records = models.Record.objects.filter(ac=_AC)
             # 持久化
@@ -127,18 +322,30 @@ class ACServer:
                     record_file = item.toFile()
                     f.write(record_file)
 
+            # 记录不随空调删除（外键置空），保留在报表、导出和历史分析中
             _AC.delete()
         except:
             status = 413
 
-        return status
+        return status, bill
 
     def checkDetail(self, roomNumber, ID):
+        """
+        查询房间的账单，由计费模块的累加器直接给出，不扫描记录
+        :param roomNumber: 房间号
+        :param ID: 入住人身份证号
+        :return: statusCode 411 房间号越界
+                            414 房间是空房（包括登记入住时开始计费失败的房间）
+                            415 入住人不匹配
+                            200 查询成功
+                 detail     账单
+        """
         statusCode = self.RoomBindMapper.query(roomNumber, ID)
         if statusCode != 200:
             return statusCode, None
-        # TODO 业务逻辑 详单生成
         detail = self.ACBillingManager.query(roomNumber)
+        if detail is None:
+            return 414, None
         return statusCode, detail
 
     def update(self, roomNumber, state, status):
@@ -150,74 +357,438 @@ class ACServer:
         :return: statusCode     状态码
                  speed          调度风速
         """
-        statusCode = 200
-        speed = 0
+        return self.updateMany([(roomNumber, state, status)])[0]
+
+    def updateMany(self, updates):
+        """
+        批量更新多个房间（楼层网关汇总的心跳）
+        先逐个检查并构造请求，再把全部请求一次放入请求队列，最后更新空调状态
+        队列放不下（背压）时这一批的请求都不入队、不更新状态，返回 417，网关下一次心跳重试
+        :param updates: [(roomNumber, state, status)]
+        :return: [(statusCode, speed)]，和 updates 一一对应
+        """
+        results = [None] * len(updates)
+        requests = []
+        # 入队之后需要更新空调状态的房间：(序号, roomNumber, state, status, statusCode)
+        pending = []
+
+        for idx, (roomNumber, state, status) in enumerate(updates):
+            statusCode, speed, request, state = self.prepareUpdate(roomNumber, state, status)
+            # 参数不合法、房间没有入住、没有变化的心跳：直接返回
+            if request is None and statusCode != 416:
+                results[idx] = (statusCode, speed)
+                continue
+            if request is not None:
+                requests.append(request)
+            pending.append((idx, roomNumber, state, status, statusCode))
+
+        # 不合法的请求不进入调度
+        # 队列满（背压）时不更新数据库，客户端下一次心跳会重新提出这个请求
+        if not self.RequestQueue.putMany(requests, self.SETTING.REQUEST_PUT_TIMEOUT):
+            for idx, roomNumber, state, status, statusCode in pending:
+                if statusCode == 200:
+                    results[idx] = (417, 0)
+            pending = [item for item in pending if item[4] == 416]
+
+        for idx, roomNumber, state, status, statusCode in pending:
+            # 使用客户端数据更新空调状态（由状态表写入数据库）
+            _AC = self.ACStateManager.update(roomNumber, state, status)
+
+            # 调度之后的风速
+            results[idx] = (statusCode, _AC.currentSpeed)
+
+        return results
+
+    def heartbeatInterval(self, roomNumber):
+        """
+        建议客户端下一次心跳的间隔
+        等待送风的房间心跳快，正在送风的房间次之，关机/休眠的房间最慢；服务器负载高时按负载系数延长
+        结果取 2 的整数次幂，返回值的种类很少，可以使用预先序列化的返回
+        :param roomNumber: 房间号
+        :return: 间隔（秒）
+        """
         _AC = None
         try:
-            _AC = models.AC.objects.get(roomNumber=roomNumber)
+            _AC = self.ACStateManager.peek(roomNumber)
+        except (TypeError, ValueError):
+            pass
+
+        if _AC is None or _AC.status != "on":
+            interval = self.SETTING.HEARTBEAT_IDLE
+        elif _AC.currentSpeed == 0:
+            interval = self.SETTING.HEARTBEAT_WAITING
+        else:
+            interval = self.SETTING.HEARTBEAT_SERVING
+        return self.quantizeInterval(interval * self.getLoadFactor())
+
+    def getLoadFactor(self):
+        """
+        服务器的负载系数：请求队列积压、调度耗时相对于目标值的倍数，不小于 1
+        每隔 HEARTBEAT_LOAD_SAMPLE 秒重新计算一次
+        :return: float
+        """
+        now = Clock.monotonic()
+        if self.loadSampleTime is None or now - self.loadSampleTime >= self.SETTING.HEARTBEAT_LOAD_SAMPLE:
+            self.loadSampleTime = now
+            depth = self.getRequestQueueStats()["depth"]
+            passDuration = self.scheduler.getMetrics().recentPassDuration
+            self.loadFactor = max(1.0,
+                                  depth / self.SETTING.HEARTBEAT_QUEUE_TARGET,
+                                  passDuration / self.SETTING.HEARTBEAT_PASS_TARGET)
+        return self.loadFactor
+
+    def quantizeInterval(self, interval):
+        """
+        把心跳间隔取到 [HEARTBEAT_MIN, HEARTBEAT_MAX] 内最接近的 2 的整数次幂
+        :param interval: 秒
+        :return: int
+        """
+        interval = min(max(interval, self.SETTING.HEARTBEAT_MIN), self.SETTING.HEARTBEAT_MAX)
+        return min(max(2 ** int(round(math.log2(interval))), self.SETTING.HEARTBEAT_MIN), self.SETTING.HEARTBEAT_MAX)
+
+    def heartbeat(self, roomNumber, state, status):
+        """
+        只处理没有变化、而且房间已经在内存中的心跳，不读写数据库，不等待请求队列，
+        异步接口直接在事件循环上调用
+        :param roomNumber: 客户端房间号
+        :param state: 客户端房间参数
+        :param status: 客户房间状态
+        :return: (statusCode, speed)，需要完整处理（包括房间号不合法）时返回 None
+        """
+        state = self.parseState(state)
+        if state is None:
+            return None
+        try:
+            _AC = self.ACStateManager.peek(roomNumber)
+        except (TypeError, ValueError):
+            return None
+        if _AC is None or _AC.isNewRequest(state, status) != 4:
+            return None
+        try:
+            return 200, self.ACStateManager.heartbeat(roomNumber, state[0])
+        except models.AC.DoesNotExist:
+            # 刚刚退房
+            return None
+
+    def prepareUpdate(self, roomNumber, state, status):
+        """
+        检查客户端数据，判断是否提出了新的请求
+        :param roomNumber: 客户端房间号
+        :param state: 客户端房间参数
+        :param status: 客户房间状态
+        :return: statusCode     状态码
+                 speed          没有变化的心跳直接返回的调度风速
+                 request        需要放入请求队列的请求，没有时为 None
+                 state          转换成数值的房间参数
+        """
+        speed = 0
+        state = self.parseState(state)
+        if state is None or status not in ("on", "powerOff", "hibernate"):
+            return 410, speed, None, state
+
+        try:
+            _AC = self.ACStateManager.get(roomNumber)
         except:
-            statusCode = 411
+            return 411, speed, None, state
 
-        if statusCode == 200:
-            # 判断客户端是否提出了新的请求
-            _code = _AC.isNewRequest(state, status)
-            if _code != 4:
-                request = Request()
-
-                # 关机
-                if _code == 0:
-                    request.setType("powerOff")
-                    request.setAirRequest(roomNumber)
-
-                # 休眠
-                elif _code == 2:
-                    request.setType("hibernate")
-                    request.setAirRequest(roomNumber)
-
-                # 调风调温/开机
-                elif _code == 3 or _code == 1:
-                    request.setType("on")
-
-                    # 构造新的送风请求
-                    airRequest = ACAirRequest(roomNumber, state[1], state[3])
-
-                    # 请求是否符合当前工作模式
-                    if self.isValidRequest(airRequest):
-                        request.setAirRequest(airRequest)
-                    # 不符合则删除请求，返回错误码
-                    else:
-                        del airRequest
-                        statusCode = 416
-
-                self.RequestQueueLock.acquire()
-                # 目前没有请求， 那么还需要把调度器给打开
-                if self.RequestQueue.qsize() == 0:
-                    self.RequestQueueNotEmptyEvent.set()
-
-                # 把请求加入队列
-                self.RequestQueue.put(request)
-                self.RequestQueueLock.release()
-
-            # 使用客户端数据更新数据库
-            _AC = models.AC.objects.get(roomNumber=roomNumber)
-            _AC.update(state, status)
+        # 判断客户端是否提出了新的请求
+        _code = _AC.isNewRequest(state, status)
+        # 没有变化的心跳：直接用内存中的状态回复，不读写数据库
+        if _code == 4:
+            return 200, self.ACStateManager.heartbeat(roomNumber, state[0]), None, state
+
+        request = Request()
 
-            # 从数据库获取调度之后的风速
-            speed = _AC.currentSpeed
+        # 关机
+        if _code == 0:
+            request.setType("powerOff")
+            request.setAirRequest(roomNumber)
 
-        return statusCode, speed
+        # 休眠
+        elif _code == 2:
+            request.setType("hibernate")
+            request.setAirRequest(roomNumber)
+
+        # 调风调温/开机
+        elif _code == 3 or _code == 1:
+            request.setType("on")
+
+            # 构造新的送风请求
+            airRequest = ACAirRequest(roomNumber, state[1], state[3])
+
+            # 请求是否符合当前工作模式
+            if self.isValidRequest(airRequest):
+                request.setAirRequest(airRequest)
+            # 不符合则删除请求，返回错误码
+            else:
+                del airRequest
+                return 416, speed, None, state
+
+        return 200, speed, request, state
+
+    def watch(self, roomNumber, version, timeout=None):
+        """
+        等待房间的送风风速发生变化（长轮询/SSE）
+        :param roomNumber: 房间号
+        :param version: 客户端已经见过的版本号，第一次连接时为 None，立即返回当前风速
+        :param timeout: 最长等待的秒数，不超过 SETTING.WATCH_TIMEOUT
+        :return: statusCode     状态码（411 房间没有入住，410 参数不合法）
+                 version        新的版本号
+                 speed          调度风速
+        """
+        try:
+            _AC = self.ACStateManager.get(roomNumber)
+        except:
+            return 411, 0, 0
+
+        if timeout is None:
+            timeout = self.SETTING.WATCH_TIMEOUT
+        try:
+            timeout = min(max(float(timeout), 0), self.SETTING.WATCH_TIMEOUT)
+            version = None if version is None else int(version)
+        except (TypeError, ValueError):
+            return 410, 0, 0
+
+        if version is None:
+            version, speed = self.SpeedNotifier.current(roomNumber, _AC.currentSpeed)
+            return 200, version, speed
+
+        result = self.SpeedNotifier.wait(roomNumber, version, timeout, _AC.currentSpeed)
+        # 等待期间房间退房
+        if result is None:
+            return 411, 0, 0
+        return 200, result[0], result[1]
+
+    def report(self, period=None, day=None):
+        """
+        统计报表
+        :param period: "day" "week" "month" "year"，缺省日报
+        :param day: 报表周期包含的日期 "YYYY-MM-DD"，缺省今天
+        :return: statusCode 410 参数不对
+                            417 正在从数据库恢复统计，稍后重试
+                            200 成功
+                 report     见 StatManager.report
+        """
+        if period is None:
+            period = "day"
+        if period not in StatManager.PERIODS:
+            return 410, None
+        if not self.StatManager.isReady():
+            return 417, None
+        if day is not None:
+            try:
+                day = date.fromisoformat(day)
+            except (TypeError, ValueError):
+                return 410, None
+        return 200, self.StatManager.report(period, day)
+
+    def analytics(self, kind, start, end, bucket=None):
+        """
+        历史记录分析，见 RecordAnalytics
+        :param kind: "usage" 每个房间每个时间桶的送风时长和费用（缺省一小时一个桶）
+                     "counts" 每个房间每个时间桶的开关机、调度、详单、调温、调风次数（缺省一天一个桶）
+        :param start: 开始时间 ISO 格式（YYYY-MM-DD 或 YYYY-MM-DDTHH:MM:SS）
+        :param end: 结束时间（不包含）
+        :param bucket: 时间桶的长度（秒）
+        :return: statusCode 410 参数不对
+                            418 没有安装 numpy
+                            200 成功
+                 analytics  dict，数组转换成列表
+        """
+        if self.RecordAnalytics is None:
+            return 418, None
+        if kind is None:
+            kind = "usage"
+        if kind not in ("usage", "counts"):
+            return 410, None
+        try:
+            start = datetime.fromisoformat(start)
+            end = datetime.fromisoformat(end)
+            bucket = (3600 if kind == "usage" else 86400) if bucket is None else int(bucket)
+        except (TypeError, ValueError):
+            return 410, None
+        if end <= start or bucket <= 0 or (end - start).total_seconds() / bucket > self.SETTING.ANALYTICS_BUCKET_MAX:
+            return 410, None
+
+        self.ACStateManager.flush()
+        if kind == "usage":
+            result = self.RecordAnalytics.usage(start, end, bucket)
+        else:
+            result = self.RecordAnalytics.counts(start, end, bucket)
+        analytics = {"type": kind, "start": start.isoformat(), "end": end.isoformat(), "bucket": bucket}
+        for name, value in result.items():
+            if name in ("usageTime", "cost"):
+                value = value.round(2)
+            analytics[name] = value.tolist()
+        return 200, analytics
+
+    def exportReport(self, period=None, day=None, fileFormat=None):
+        """
+        导出统计报表
+        :param period: "day" "week" "month" "year"，缺省日报
+        :param day: 报表周期包含的日期 "YYYY-MM-DD"，缺省今天
+        :param fileFormat: "csv"（缺省） "xlsx"
+        :return: statusCode 410 参数不对
+                            417 正在从数据库恢复统计，稍后重试
+                            419 没有安装 openpyxl，不能导出 XLSX
+                            200 成功
+                 filename   文件名
+                 content    生成文件内容的生成器
+        """
+        statusCode = self.checkExportFormat(fileFormat)
+        if statusCode != 200:
+            return statusCode, None, None
+        statusCode, report = self.report(period, day)
+        if statusCode != 200:
+            return statusCode, None, None
+        filename = "report-%s-%s" % (report["period"], report["start"])
+        rows = self.ReportExporter.reportRows(report)
+        return 200, filename, self.exportContent(ReportExporter.REPORT_HEADER, rows, fileFormat)
+
+    def exportRecords(self, start, end, fileFormat=None):
+        """
+        导出一个时间段的全部使用记录
+        :param start: 开始时间 ISO 格式（YYYY-MM-DD 或 YYYY-MM-DDTHH:MM:SS）
+        :param end: 结束时间（不包含）
+        :param fileFormat: "csv"（缺省） "xlsx"
+        :return: 同 exportReport
+        """
+        statusCode = self.checkExportFormat(fileFormat)
+        if statusCode != 200:
+            return statusCode, None, None
+        try:
+            start = datetime.fromisoformat(start)
+            end = datetime.fromisoformat(end)
+        except (TypeError, ValueError):
+            return 410, None, None
+        if end <= start:
+            return 410, None, None
+
+        self.ACStateManager.flush()
+        filename = "records-%s-%s" % (start.strftime("%Y%m%d%H%M%S"), end.strftime("%Y%m%d%H%M%S"))
+        rows = self.ReportExporter.recordRows(start, end)
+        return 200, filename, self.exportContent(ReportExporter.RECORD_HEADER, rows, fileFormat)
+
+    def checkExportFormat(self, fileFormat):
+        if fileFormat is None or fileFormat == "csv":
+            return 200
+        if fileFormat == "xlsx":
+            return 200 if self.ReportExporter.xlsxAvailable() else 419
+        return 410
+
+    def exportContent(self, header, rows, fileFormat):
+        if fileFormat == "xlsx":
+            return self.ReportExporter.xlsx(header, rows)
+        return self.ReportExporter.csv(header, rows)
+
+    def detailRecords(self, roomNumber, position=None):
+        """
+        房间的详单，从 position 开始按时间顺序逐段生成
+        只读取风速变化的记录，按 (ac, date) 索引顺序分块读取，不一次加载全部记录
+        :param roomNumber: 房间号
+        :param position: 分页位置 (date, id)，见 ACBillingManager.parseCursor，None 从头开始
+        :return: 生成器，见 ACBillingManager.intervals
+        """
+        self.ACStateManager.flush()
+        records = models.Record.objects.filter(ac=int(roomNumber)).exclude(old_speed=F("new_speed"))
+        if position is not None:
+            date, _id = position
+            records = records.filter(Q(date__gt=date) | Q(date=date, id__gte=_id))
+        records = records.order_by("date", "id").only("id", "date", "old_speed", "new_speed")
+        return self.ACBillingManager.intervals(roomNumber, records.iterator(chunk_size=self.SETTING.DETAIL_CHUNK_SIZE))
+
+    def detailPage(self, roomNumber, position=None, limit=None):
+        """
+        一页详单
+        :param roomNumber: 房间号
+        :param position: 分页位置，None 从头开始
+        :param limit: 这一页最多的送风段数
+        :return: records    [送风段]
+                 nextCursor 下一页的 cursor，没有下一页时为 None
+        """
+        if limit is None:
+            limit = self.SETTING.DETAIL_PAGE_SIZE
+        records = list(islice(self.detailRecords(roomNumber, position), limit + 1))
+        if len(records) > limit:
+            return records[:limit], records[limit]["cursor"]
+        return records, None
+
+    def parsePage(self, cursor, limit):
+        """
+        解析详单的分页参数
+        :param cursor: 上一页返回的 nextCursor，None 从头开始
+        :param limit: 一页的送风段数，None 使用 DETAIL_PAGE_SIZE，超过 DETAIL_PAGE_MAX 时取 DETAIL_PAGE_MAX
+        :return: (position, limit)，格式不对时返回 None
+        """
+        position = None
+        if cursor is not None and cursor != "":
+            position = ACBillingManager.parseCursor(cursor)
+            if position is None:
+                return None
+        if limit is None:
+            limit = self.SETTING.DETAIL_PAGE_SIZE
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            return None
+        if limit <= 0:
+            return None
+        return position, min(limit, self.SETTING.DETAIL_PAGE_MAX)
+
+    @staticmethod
+    def parseState(state):
+        """
+        把客户端上传的房间参数转换成数值，和数据库中的类型一致，才能正确判断是否有变化
+        :param state: [ct, tt, cs, ts] 字符串
+        :return: [当前温度, 目标温度, 当前风速, 目标风速]，格式不对时返回 None
+        """
+        try:
+            return [float(state[0]), float(state[1]), int(state[2]), int(state[3])]
+        except (TypeError, ValueError):
+            return None
+
+    def getIngestStats(self):
+        """
+        调度器消费请求队列的统计（批次大小、合并数量）
+        :return: dict
+        """
+        return self.scheduler.getIngestStats()
+
+    def getRequestQueueStats(self):
+        """
+        请求队列的统计（深度、拒绝数、入队/出队延迟）
+        :return: dict
+        """
+        return self.RequestQueue.getStats()
+
+    def getMetrics(self):
+        """
+        服务器运行指标：调度延迟和队列长度、请求队列、请求消费、空调状态表、计费、统计的统计
+        :return: dict
+        """
+        return {
+            "scheduler": self.scheduler.getMetrics().snapshot(),
+            "ingest": self.getIngestStats(),
+            "requestQueue": self.getRequestQueueStats(),
+            "state": self.ACStateManager.getStats(),
+            "records": self.RecordSink.getStats(),
+            "watch": self.SpeedNotifier.getStats(),
+            "billing": self.ACBillingManager.getStats(),
+            "stat": self.StatManager.getStats(),
+            "analytics": None if self.RecordAnalytics is None else self.RecordAnalytics.getStats(),
+            "udp": None if self.HeartbeatListener is None else self.HeartbeatListener.getStats(),
+        }
 
     def powerOff(self, roomNumber):
         statusCode = 200
 
-        _AC = None
         try:
-            _AC = models.AC.objects.get(roomNumber=roomNumber)
+            self.ACStateManager.get(roomNumber)
         except:
             statusCode = 411
 
         if statusCode == 200:
-            self.priorityScheduler.cancel(roomNumber)
+            self.scheduler.withdraw(roomNumber)
 
     def hibernate(self, roomNumber):
         pass
@@ -1,6 +1,219 @@
+import threading
+from datetime import datetime
+
+from django.utils import timezone
+
+from . import Clock
+
+
+class RoomBill:
+    """
+    一个房间的计费累加器
+    :param roomNumber 房间号
+    :param checkInTime 入住时间
+    :parameter cost 已经结束的送风段的费用（元）
+    :parameter servingTime 已经结束的送风段的时长（秒）
+    :parameter speed 当前的送风风速，0 表示没有送风
+    :parameter since 当前送风段的开始时间
+    :parameter scheduleCount 被调度（开始送风或者送风中改变风速）的次数
+    """
+
+    def __init__(self, roomNumber, checkInTime):
+        self.roomNumber = roomNumber
+        self.checkInTime = checkInTime
+        self.checkOutTime = None
+        self.cost = 0.0
+        self.servingTime = 0.0
+        self.speed = 0
+        self.since = None
+        self.scheduleCount = 0
+
+    def transit(self, speed, date):
+        """
+        送风风速变化：结束当前的送风段，按新的风速开始下一段
+        :param speed: 新的风速
+        :param date: 变化的时间
+        :return:
+        """
+        if self.speed > 0 and self.since is not None:
+            seconds = max((date - self.since).total_seconds(), 0.0)
+            self.servingTime += seconds
+            self.cost += seconds / 60 * ACBillingManager.RATES[self.speed]
+        if speed > 0:
+            self.scheduleCount += 1
+            self.since = date
+        else:
+            self.since = None
+        self.speed = speed
+
+    def toDict(self, now):
+        """
+        账单，当前送风段计到 now 为止
+        :param now: 计费截止时间
+        :return: dict
+        """
+        cost = self.cost
+        servingTime = self.servingTime
+        if self.speed > 0 and self.since is not None:
+            seconds = max((now - self.since).total_seconds(), 0.0)
+            servingTime += seconds
+            cost += seconds / 60 * ACBillingManager.RATES[self.speed]
+        return {
+            "roomNumber": self.roomNumber,
+            "totalCost": round(cost, 2),
+            "servingTime": round(servingTime / 60, 2),
+            "speed": self.speed,
+            "rate": ACBillingManager.RATES.get(self.speed, 0),
+            "scheduleCount": self.scheduleCount,
+            "checkInTime": ACBillingManager.formatTime(self.checkInTime),
+            "checkOutTime": ACBillingManager.formatTime(self.checkOutTime),
+        }
+
+
 class ACBillingManager:
+    """
+    计费
+    每个房间维护一个累加器（RoomBill），由 ACStateManager 的送风风速变化驱动：
+    每次开始送风、送风中改变风速、停止送风时把上一段送风的费用累加进去，
+    查询账单只需要加上当前还没结束的一段，不需要扫描 Record
+    风速变化的时间和调度记录（Record）的时间都取自 Clock.now()，账单和数据库中的记录一致
+    累加器和入住信息（RoomBindMapper）一样只在内存中，服务器重启之后重新登记入住才能查询账单
+    详单（每一段送风）由 intervals 从记录流式生成
+    :parameter bills roomNumber -> RoomBill
+    """
+    # 风速 -> 费率（元/分钟），见需求说明：低 0.5，中 1，高 1.5
+    RATES = {0: 0, 1: 0.5, 2: 1, 3: 1.5}
+    TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
     def __init__(self):
-        pass
+        self.lock = threading.Lock()
+        self.bills = {}
+
+    @classmethod
+    def formatTime(cls, date):
+        return None if date is None else date.strftime(cls.TIME_FORMAT)
+
+    @staticmethod
+    def localTime(date):
+        """
+        数据库读出的时间带时区（USE_TZ），Clock.now() 不带时区，统一成不带时区的本地时间再计算
+        """
+        if timezone.is_aware(date):
+            return timezone.make_naive(date)
+        return date
+
+    @classmethod
+    def makeCursor(cls, record):
+        """
+        详单的分页位置：一段送风开始的记录的 (date, id)
+        :param record: Record
+        :return: str
+        """
+        return "%s_%d" % (cls.localTime(record.date).isoformat(), record.id)
+
+    @staticmethod
+    def parseCursor(cursor):
+        """
+        :param cursor: makeCursor 生成的字符串
+        :return: (date, id)，格式不对时返回 None
+        """
+        try:
+            date, _id = cursor.rsplit("_", 1)
+            return datetime.fromisoformat(date), int(_id)
+        except (AttributeError, ValueError):
+            return None
+
+    @classmethod
+    def intervals(cls, roomNumber, records):
+        """
+        详单：把送风风速变化的记录两两配对成送风段，边读边生成，不在内存中保存全部记录
+        一段送风从风速变为非 0 的记录开始，到下一条风速变化的记录结束
+        :param roomNumber: 房间号
+        :param records: 风速变化的记录，按 (date, id) 排序，可以是 QuerySet.iterator()
+        :return: 生成 dict: cursor 这一段的分页位置  start/end 开始/结束送风时间  duration 送风时长（分钟）
+                 speed 风速  rate 费率  cost 费用
+                 最后一段还没有结束时 end 为 None，时长和费用计到当前时间
+        """
+        current = None
+        for record in records:
+            if current is not None:
+                yield cls.interval(roomNumber, current, cls.localTime(record.date))
+            current = record if record.new_speed > 0 else None
+        if current is not None:
+            yield cls.interval(roomNumber, current, None)
+
+    @classmethod
+    def interval(cls, roomNumber, record, end):
+        start = cls.localTime(record.date)
+        seconds = max(((Clock.now() if end is None else end) - start).total_seconds(), 0.0)
+        rate = cls.RATES[record.new_speed]
+        return {
+            "cursor": cls.makeCursor(record),
+            "roomNumber": int(roomNumber),
+            "start": cls.formatTime(start),
+            "end": cls.formatTime(end),
+            "duration": round(seconds / 60, 2),
+            "speed": record.new_speed,
+            "rate": rate,
+            "cost": round(seconds / 60 * rate, 2),
+        }
+
+    def checkIn(self, roomNumber):
+        """
+        房间入住，开始计费
+        :param roomNumber: 房间号
+        :return:
+        """
+        roomNumber = int(roomNumber)
+        with self.lock:
+            self.bills[roomNumber] = RoomBill(roomNumber, Clock.now())
+
+    def checkOut(self, roomNumber):
+        """
+        房间退房，结束计费
+        :param roomNumber: 房间号
+        :return: 最终账单，房间没有计费时返回 None
+        """
+        roomNumber = int(roomNumber)
+        with self.lock:
+            bill = self.bills.pop(roomNumber, None)
+            if bill is None:
+                return None
+            now = Clock.now()
+            bill.transit(0, now)
+            bill.checkOutTime = now
+            return bill.toDict(now)
+
+    def speedChanged(self, roomNumber, oldSpeed, newSpeed):
+        """
+        ACStateManager 的监听者，送风风速变化时调用
+        没有累加器的房间（没有登记入住的）忽略
+        :param roomNumber: 房间号
+        :param oldSpeed: 原来的风速
+        :param newSpeed: 新的风速
+        :return:
+        """
+        roomNumber = int(roomNumber)
+        with self.lock:
+            bill = self.bills.get(roomNumber)
+            if bill is not None:
+                bill.transit(newSpeed, Clock.now())
 
     def query(self, roomNumber):
-        pass
+        """
+        查询房间的账单
+        :param roomNumber: 房间号
+        :return: dict，房间没有计费时返回 None
+        """
+        with self.lock:
+            bill = self.bills.get(int(roomNumber))
+            if bill is None:
+                return None
+            return bill.toDict(Clock.now())
+
+    def getStats(self):
+        with self.lock:
+            return {
+                "rooms": len(self.bills),
+                "serving": sum(1 for bill in self.bills.values() if bill.speed > 0),
+            }
@@ -1,14 +1,306 @@
+import logging
+import threading
+import time
+
+from django.db import transaction
+
+from . import Clock
+from .RecordSink import RecordSink
 from .. import models
 
+logger = logging.getLogger(__name__)
+
 
 class ACStateManager:
+    """
+    空调状态表
+    内存中的 AC 对象是权威状态，调度器和 ACServer.update 直接读写内存，不等待数据库；
+    改动过的 AC 由后台线程定期在一个事务里批量写入数据库（write-behind），
+    新产生的 Record 交给 RecordSink 批量写入
+    关机、退房、查询详单之前调用 flush 保证数据库是完整的
+    锁只保护内存中的操作，从数据库加载 AC 时不持有锁，异步接口在事件循环上处理心跳时不会被数据库阻塞
+    :param flushInterval 后台写数据库的最长间隔（秒）
+    :param recordSink Record 的批量写入器，缺省新建一个
+    :param temperatureInterval 没有其他变化时，同一房间的当前温度最多每隔多少秒写一次数据库（0 每次心跳都写）
+    :parameter table roomNumber -> AC
+    :parameter dirty 改动过还没写数据库的房间号
+    :parameter flushCount/flushedRows 写数据库的次数/写入的 AC 行数
+    :parameter lastFlushDuration 最近一次写数据库的耗时（秒）
+    :parameter lastMarked roomNumber -> 最近一次标记为要写数据库的时间（Clock.monotonic()）
+    :parameter heartbeatCount/temperatureWrites 没有变化的心跳次数/其中需要写入温度的次数
+    :parameter listeners 送风风速变化时调用的函数 listener(roomNumber, oldSpeed, newSpeed)
+    :parameter recordListeners 产生新记录时调用的函数 listener(records)
+    :parameter removed 已经退房的房间号，get 不再从数据库加载，避免退房删除空调之前又被加载回内存
+    """
+
+    def __init__(self, flushInterval=1.0, recordSink=None, temperatureInterval=60):
+        self.flushInterval = flushInterval
+        self.recordSink = RecordSink(flushInterval=flushInterval) if recordSink is None else recordSink
+        self.temperatureInterval = temperatureInterval
+
+        self.lock = threading.RLock()
+        self.table = {}
+        self.dirty = set()
+        self.removed = set()
+        # 同一时间只有一个 flush 在写数据库，保证写入顺序
+        self.flushLock = threading.Lock()
+
+        self.flushCount = 0
+        self.flushedRows = 0
+        self.lastFlushDuration = 0.0
+
+        self.lastMarked = {}
+        self.listeners = []
+        self.recordListeners = []
+        self.heartbeatCount = 0
+        self.temperatureWrites = 0
+
+        self.wakeup = threading.Event()
+        self.running = False
+        self.flusher = None
+
+    def start(self):
+        """
+        启动后台写数据库的线程（包括 Record 的批量写入）
+        :return:
+        """
+        if self.flusher is not None:
+            return
+        self.recordSink.start()
+        self.running = True
+        self.flusher = threading.Thread(target=self.run, daemon=True)
+        self.flusher.start()
+
+    def stop(self):
+        """
+        停止后台线程，并把积压的改动全部写入数据库
+        :return:
+        """
+        self.running = False
+        self.wakeup.set()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+        self.flush()
+        self.recordSink.stop()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.flushInterval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("AC state flush failed")
 
     def startAC(self, roomNumber):
         """
-        生成空调实例，添加到数据库
+        生成空调实例，添加到数据库（登记入住立即写数据库）
         :param roomNumber: 要开启的空调房间号
         :return:
         """
         _AC = models.AC()
         _AC.init(roomNumber)
         _AC.save()
+        with self.lock:
+            self.table[_AC.roomNumber] = _AC
+            self.removed.discard(_AC.roomNumber)
+
+    def get(self, roomNumber):
+        """
+        获取房间的空调，内存中没有时从数据库加载
+        :param roomNumber: 房间号
+        :return: AC
+        :raise models.AC.DoesNotExist 房间没有空调（没有入住，或者已经退房）
+        """
+        roomNumber = int(roomNumber)
+        with self.lock:
+            _AC = self.table.get(roomNumber)
+            if _AC is not None:
+                return _AC
+            if roomNumber in self.removed:
+                raise models.AC.DoesNotExist("room %d has checked out" % roomNumber)
+
+        loaded = models.AC.objects.get(roomNumber=roomNumber)
+        with self.lock:
+            # 加载期间退房了
+            if roomNumber in self.removed:
+                raise models.AC.DoesNotExist("room %d has checked out" % roomNumber)
+            # 其他线程先加载了，使用先放进内存的那一个
+            return self.table.setdefault(roomNumber, loaded)
+
+    def peek(self, roomNumber):
+        """
+        只在内存中查找房间的空调，不访问数据库，也不拿锁（dict 的读取在 GIL 下是原子的），
+        可以在事件循环上调用
+        :param roomNumber: 房间号
+        :return: AC，不在内存中时返回 None
+        """
+        return self.table.get(int(roomNumber))
+
+    def update(self, roomNumber, state, status):
+        """
+        用客户端数据更新空调状态
+        :param roomNumber: 房间号
+        :param state: 空调运行参数
+        :param status: 空调状态
+        :return: AC
+        """
+        _AC = self.get(roomNumber)
+        with self.lock:
+            self.markDirty(_AC, _AC.update(state, status, commit=False))
+            return _AC
+
+    def heartbeat(self, roomNumber, currentTemperature):
+        """
+        没有变化的心跳：只更新内存中的当前温度，不产生记录
+        距离上一次写入超过 temperatureInterval 时才把温度写入数据库
+        :param roomNumber: 房间号
+        :param currentTemperature: 客户端上报的当前温度
+        :return: 调度之后的风速
+        :raise models.AC.DoesNotExist 房间已经退房
+        """
+        _AC = self.get(roomNumber)
+        with self.lock:
+            _AC.currentTemperature = currentTemperature
+            self.heartbeatCount += 1
+            if Clock.monotonic() - self.lastMarked.get(_AC.roomNumber, float("-inf")) >= self.temperatureInterval:
+                self.temperatureWrites += 1
+                self.markDirty(_AC, [])
+            return _AC.currentSpeed
+
+    def addListener(self, listener):
+        """
+        注册送风风速变化的监听者
+        在状态表的锁内按变化的顺序调用，监听者不能阻塞
+        :param listener: listener(roomNumber, oldSpeed, newSpeed)
+        :return:
+        """
+        self.listeners.append(listener)
+
+    def addRecordListener(self, listener):
+        """
+        注册新记录的监听者（统计）
+        在状态表的锁内按记录产生的顺序调用，监听者不能阻塞
+        :param listener: listener(records)
+        :return:
+        """
+        self.recordListeners.append(listener)
+
+    def startServing(self, roomNumber, speed=None):
+        _AC = self.get(roomNumber)
+        with self.lock:
+            oldSpeed = _AC.currentSpeed
+            self.markDirty(_AC, _AC.startServing(speed, commit=False))
+            self.speedChanged(_AC, oldSpeed)
+            return _AC
+
+    def stopServing(self, roomNumber):
+        _AC = self.get(roomNumber)
+        with self.lock:
+            oldSpeed = _AC.currentSpeed
+            self.markDirty(_AC, _AC.stopServing(commit=False))
+            self.speedChanged(_AC, oldSpeed)
+            return _AC
+
+    def speedChanged(self, _AC, oldSpeed):
+        if _AC.currentSpeed == oldSpeed:
+            return
+        for listener in self.listeners:
+            listener(_AC.roomNumber, oldSpeed, _AC.currentSpeed)
+
+    def addWaitTime(self, roomNumber, waitTime):
+        """
+        累加房间的等待时长
+        :param roomNumber: 房间号
+        :param waitTime: 等待时长（分钟）
+        :return:
+        """
+        _AC = self.get(roomNumber)
+        with self.lock:
+            _AC.addWaitTime(waitTime)
+            self.markDirty(_AC, [])
+
+    def markDirty(self, _AC, records):
+        """
+        记录一次内存中的改动，等待写入数据库
+        :param _AC: 被改动的空调
+        :param records: 这次改动产生的记录
+        :return:
+        """
+        with self.lock:
+            self.dirty.add(_AC.roomNumber)
+            self.lastMarked[_AC.roomNumber] = Clock.monotonic()
+            # 在锁内交给 RecordSink，保证记录的顺序和改动的顺序一致
+            self.recordSink.putMany(records)
+            if len(records) > 0:
+                for listener in self.recordListeners:
+                    listener(records)
+
+    @staticmethod
+    def snapshot(_AC):
+        """
+        AC 各字段的当前值
+        :return: dict 字段名 -> 值
+        """
+        return {field.attname: getattr(_AC, field.attname) for field in models.AC._meta.concrete_fields}
+
+    def flush(self):
+        """
+        把改动过的 AC 在一个事务里写入数据库，再把积压的 Record 全部写入
+        在锁内复制要写入的字段，写数据库时其他线程继续修改内存中的 AC 也不会写入一半的状态；
+        只更新已有的行，已经退房删除的空调不会被重新插入
+        写入失败时这些房间重新标记为改动过，下一次再写
+        :return:
+        """
+        with self.flushLock:
+            with self.lock:
+                rows = [self.snapshot(self.table[roomNumber]) for roomNumber in self.dirty if roomNumber in self.table]
+                self.dirty = set()
+
+            if len(rows) > 0:
+                start = time.monotonic()
+                try:
+                    with transaction.atomic():
+                        for row in rows:
+                            models.AC.objects.filter(roomNumber=row["roomNumber"]).update(**row)
+                except Exception:
+                    with self.lock:
+                        self.dirty.update(row["roomNumber"] for row in rows if row["roomNumber"] in self.table)
+                    raise
+
+                self.flushCount += 1
+                self.flushedRows += len(rows)
+                self.lastFlushDuration = time.monotonic() - start
+
+        self.recordSink.flush()
+
+    def remove(self, roomNumber):
+        """
+        房间退房，先把积压的改动写入数据库，再从状态表中删除
+        删除之后 get 不再从数据库加载这个房间，直到重新入住（startAC）
+        :param roomNumber: 房间号
+        :return:
+        """
+        self.flush()
+        with self.lock:
+            self.removed.add(int(roomNumber))
+            self.table.pop(int(roomNumber), None)
+            self.dirty.discard(int(roomNumber))
+            self.lastMarked.pop(int(roomNumber), None)
+
+    def getStats(self):
+        """
+        写数据库的统计
+        :return: dict
+        """
+        with self.lock:
+            return {
+                "rooms": len(self.table),
+                "dirty": len(self.dirty),
+                "flushCount": self.flushCount,
+                "flushedRows": self.flushedRows,
+                "lastFlushDuration": self.lastFlushDuration,
+                "heartbeatCount": self.heartbeatCount,
+                "temperatureWrites": self.temperatureWrites,
+            }
@@ -0,0 +1,295 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .Scheduler import PriorityPolicy, TimeSlicePolicy
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncPriorityScheduler(PriorityPolicy):
+    """
+    asyncio 版的优先级调度器
+    和 PriorityScheduler 使用同一套调度策略，请求放在 asyncio.Queue 里，由事件循环上的协程消费，
+    没有线程唤醒的开销
+    没有传入事件循环时，自己在一个后台线程里运行一个事件循环（同步的 Django 视图通过 put 投递请求）；
+    传入事件循环时挂在该循环上运行，异步前端可以直接 await aput
+    对 ACServer 来说它同时也是请求队列，提供和 RequestChannel 一样的 put/putMany/getStats 接口
+    调度结果（updateACState）会读写数据库，不能在事件循环里执行：一轮调度中先记在 stateUpdates 里，
+    调度完之后交给 stateExecutor（单线程，保证顺序）执行
+    :param instanceNum Scheduler父类-服务对象数量
+    :param cluster Scheduler父类-服务对象集群
+    :param capacity 请求队列容量
+    :param batch PriorityPolicy父类-批量模式
+    :param loop 挂载的事件循环，None 表示自己创建
+    :parameter stateUpdates 还没有执行的 (roomNumber, action, args)
+    :parameter stateExecutor 执行 updateACState 的线程
+    :parameter stopped 已经停止，之后的调度结果不再执行（只在事件循环里读写）
+    """
+
+    def __init__(self, instanceNum, cluster, capacity=4096, batch=True, loop=None):
+        PriorityPolicy.__init__(self, instanceNum, cluster, batch)
+        self.capacity = int(capacity)
+        self.ownLoop = loop is None
+        self.loop = asyncio.new_event_loop() if loop is None else loop
+        self.thread = None
+        self.task = None
+        # 队列相关的对象要在事件循环里创建
+        self.queue = None
+        self.notFull = None
+        self.ready = threading.Event()
+        self.stateUpdates = []
+        self.stateExecutor = ThreadPoolExecutor(1)
+        self.stopped = False
+
+        # queue statistics
+        self.putCount = 0
+        self.rejectedCount = 0
+        self.getCount = 0
+        self.maxDepth = 0
+        self.queueLatencyTotal = 0.0
+        self.queueLatencyMax = 0.0
+
+    def __len__(self):
+        if self.queue is None:
+            return 0
+        return self.queue.qsize()
+
+    def start(self):
+        """
+        启动调度协程，返回时已经可以接受请求
+        :return:
+        """
+        if self.ownLoop:
+            self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+            self.thread.start()
+        self.loop.call_soon_threadsafe(self._createTask)
+        self.ready.wait()
+
+    def stop(self):
+        """
+        停止调度协程（以及自己创建的事件循环）
+        :return:
+        """
+        def _stop():
+            if self.task is not None:
+                self.task.cancel()
+            # 在事件循环里关闭 stateExecutor，之后到期的定时器（时间片）调度完也不会再提交
+            self.stopped = True
+            self.stateExecutor.shutdown(wait=False)
+            # 先让调度协程处理完取消，再停止事件循环
+            if self.ownLoop:
+                self.loop.call_soon(self.loop.stop)
+        self.loop.call_soon_threadsafe(_stop)
+
+    def _createTask(self):
+        self.queue = asyncio.Queue()
+        self.notFull = asyncio.Condition()
+        self.task = self.loop.create_task(self.serve())
+        self.ready.set()
+
+    async def serve(self):
+        """
+        调度协程：等待请求，一次取出全部排队的请求，（批量模式下）按房间合并，然后调度
+        :return:
+        """
+        while True:
+            requests = [await self.queue.get()]
+            if self.batch:
+                while not self.queue.empty():
+                    requests.append(self.queue.get_nowait())
+
+            now = time.monotonic()
+            for idx, (enqueueTime, request) in enumerate(requests):
+                latency = now - enqueueTime
+                self.queueLatencyTotal += latency
+                self.queueLatencyMax = max(self.queueLatencyMax, latency)
+                requests[idx] = request
+            self.getCount += len(requests)
+            async with self.notFull:
+                self.notFull.notify_all()
+
+            if self.batch:
+                self.countBatch(requests)
+                requests = self.coalesce(requests)
+            else:
+                self.requestCount += 1
+            # 一轮出错不能让调度协程退出
+            try:
+                self.schedulePass(requests)
+            except Exception:
+                logger.exception("schedule pass failed")
+            await self.flushStateUpdates()
+
+    def withdraw(self, roomNumber):
+        """
+        从其他线程（退房、关机）撤回房间的送风请求，在事件循环里执行，
+        返回时调度结果已经写入空调状态
+        在事件循环里调用时直接执行，调度结果稍后写入
+        :param roomNumber: 房间号
+        :return: 被取消的请求总共的等待时长（分钟），该房间没有请求时返回 None
+        """
+        if self.onLoop():
+            waitTime = self.withdrawRequest(roomNumber)
+            self.schedule()
+            self.flushStateUpdates()
+            return waitTime
+        return asyncio.run_coroutine_threadsafe(self.awithdraw(roomNumber), self.loop).result()
+
+    async def awithdraw(self, roomNumber):
+        waitTime = self.withdrawRequest(roomNumber)
+        self.schedule()
+        await self.flushStateUpdates()
+        return waitTime
+
+    def updateACState(self, roomNumber, action, *args):
+        """
+        调度结果先记下来，由 flushStateUpdates 在 stateExecutor 里执行
+        """
+        self.stateUpdates.append((roomNumber, action, args))
+
+    def flushStateUpdates(self):
+        """
+        把记下来的调度结果交给 stateExecutor 按顺序执行
+        :return: asyncio.Future，执行完成时完成
+        """
+        updates = self.stateUpdates
+        self.stateUpdates = []
+        if self.stopped:
+            future = self.loop.create_future()
+            future.set_result(None)
+            return future
+        return self.loop.run_in_executor(self.stateExecutor, self.applyStateUpdates, updates)
+
+    def applyStateUpdates(self, updates):
+        for roomNumber, action, args in updates:
+            try:
+                PriorityPolicy.updateACState(self, roomNumber, action, *args)
+            except Exception:
+                logger.exception("failed to update AC state of room %s", roomNumber)
+
+    async def aput(self, items, timeout=None):
+        """
+        在事件循环里投递请求，要么全部入队，要么全部不入队
+        :param items: 请求列表
+        :param timeout: 队列满时最多等待的秒数，None 表示一直等待
+        :return: 是否入队成功
+        """
+        if len(items) > self.capacity:
+            self.rejectedCount += len(items)
+            return False
+
+        async with self.notFull:
+            if self.queue.qsize() + len(items) > self.capacity:
+                try:
+                    await asyncio.wait_for(
+                        self.notFull.wait_for(lambda: self.queue.qsize() + len(items) <= self.capacity),
+                        timeout)
+                except asyncio.TimeoutError:
+                    self.rejectedCount += len(items)
+                    return False
+            return self.putNowait(items)
+
+    def putNowait(self, items):
+        """
+        在事件循环里投递请求，不等待，队列放不下时全部不入队
+        :param items: 请求列表
+        :return: 是否入队成功
+        """
+        if self.queue.qsize() + len(items) > self.capacity:
+            self.rejectedCount += len(items)
+            return False
+        now = time.monotonic()
+        for item in items:
+            self.queue.put_nowait((now, item))
+        self.putCount += len(items)
+        self.maxDepth = max(self.maxDepth, self.queue.qsize())
+        return True
+
+    def put(self, item, timeout=None):
+        """
+        从其他线程投递一个请求
+        :param item: 请求
+        :param timeout: 队列满时最多等待的秒数
+        :return: 是否入队成功
+        """
+        return self.putMany([item], timeout)
+
+    def putMany(self, items, timeout=None):
+        """
+        从其他线程投递多个请求，要么全部入队，要么全部不入队
+        在调度器自己的事件循环里调用时不能等待（会卡住事件循环），队列满时直接拒绝
+        :param items: 请求列表
+        :param timeout: 队列满时最多等待的秒数
+        :return: 是否入队成功
+        """
+        if len(items) == 0:
+            return True
+        if self.onLoop():
+            return self.putNowait(items)
+        future = asyncio.run_coroutine_threadsafe(self.aput(items, timeout), self.loop)
+        return future.result()
+
+    def onLoop(self):
+        """
+        当前是否在调度器的事件循环里
+        """
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def getStats(self):
+        """
+        请求队列的运行统计
+        :return: dict
+        """
+        return {
+            "capacity": self.capacity,
+            "depth": len(self),
+            "maxDepth": self.maxDepth,
+            "putCount": self.putCount,
+            "rejectedCount": self.rejectedCount,
+            "getCount": self.getCount,
+            "queueLatencyAverage": self.queueLatencyTotal / self.getCount if self.getCount > 0 else 0,
+            "queueLatencyMax": self.queueLatencyMax,
+        }
+
+
+class AsyncRoundScheduler(TimeSlicePolicy, AsyncPriorityScheduler):
+    """
+    asyncio 版的时间片调度器
+    时间片到期直接用事件循环的定时器（loop.call_later）驱动
+    :param timeSlice 时间片长度（秒）
+    :parameter sliceHandles roomNumber -> 该房间时间片的定时器
+    """
+
+    def __init__(self, instanceNum, cluster, timeSlice, capacity=4096, batch=True, loop=None):
+        AsyncPriorityScheduler.__init__(self, instanceNum, cluster, capacity, batch, loop)
+        self.timeSlice = timeSlice
+        self.sliceHandles = {}
+
+    def armSlice(self, roomNumber):
+        self.disarmSlice(roomNumber)
+        self.sliceHandles[roomNumber] = self.loop.call_later(self.timeSlice, self.expire, roomNumber)
+
+    def disarmSlice(self, roomNumber):
+        handle = self.sliceHandles.pop(roomNumber, None)
+        if handle is not None:
+            handle.cancel()
+
+    def expire(self, roomNumber):
+        """
+        时间片到期，轮转之后重新调度
+        :param roomNumber: 房间号
+        :return:
+        """
+        self.sliceHandles.pop(roomNumber, None)
+        try:
+            self.rotate(roomNumber)
+            self.schedule()
+        except Exception:
+            logger.exception("time slice rotation failed")
+        self.flushStateUpdates()
@@ -0,0 +1,74 @@
+import time
+from datetime import datetime, timedelta
+
+
+class SystemClock:
+    """
+    系统时钟，直接读取当前时间
+    """
+
+    def now(self):
+        return datetime.now()
+
+    def monotonic(self):
+        return time.monotonic()
+
+
+class VirtualClock:
+    """
+    虚拟时钟，时间只在调用 advance/set 时前进
+    用于模拟器按事件推进时间，调度的结果可以复现，也不受真实时间的限制
+    :param start 虚拟时钟的起始时间
+    """
+
+    def __init__(self, start=None):
+        self.start = datetime(2000, 1, 1) if start is None else start
+        self.elapsed = 0.0
+
+    def now(self):
+        return self.start + timedelta(seconds=self.elapsed)
+
+    def monotonic(self):
+        return self.elapsed
+
+    def advance(self, seconds):
+        """
+        时间前进
+        :param seconds: 前进的秒数
+        :return:
+        """
+        assert seconds >= 0
+        self.elapsed += seconds
+
+    def set(self, elapsed):
+        """
+        时间前进到起始时间之后的某一秒
+        :param elapsed: 距离起始时间的秒数，不能早于当前时间
+        :return:
+        """
+        assert elapsed >= self.elapsed
+        self.elapsed = elapsed
+
+
+# 当前使用的时钟，调度相关的代码都通过 now()/monotonic() 读取时间
+clock = SystemClock()
+
+
+def now():
+    return clock.now()
+
+
+def monotonic():
+    return clock.monotonic()
+
+
+def setClock(newClock):
+    """
+    替换当前使用的时钟
+    :param newClock: SystemClock / VirtualClock
+    :return: 原来的时钟
+    """
+    global clock
+    oldClock = clock
+    clock = newClock
+    return oldClock
@@ -0,0 +1,110 @@
+import socket
+import struct
+import threading
+
+
+class HeartbeatListener(threading.Thread):
+    """
+    UDP 心跳监听
+    房间控制器用固定长度的二进制包上报心跳，不经过 HTTP 和 Django 的中间件，
+    和 ACSystem.update 使用同一个 ACServer.updateMany，回复同样固定长度的二进制包
+    已经到达的心跳一次全部取出，作为一批交给 updateMany
+    请求包（网络字节序，19 字节）: seq(uint32) roomNumber(uint32) ct(float32) tt(float32) cs(uint8) ts(uint8) status(uint8)
+    回复包（网络字节序，13 字节）: seq(uint32) roomNumber(uint32) statusCode(uint16) speed(uint8) interval(uint16)
+    interval 是建议的下一次心跳间隔（秒）
+    seq 由客户端给出，原样返回，用于匹配回复
+    :param server ACServer
+    :param host 监听地址
+    :param port 监听端口，0 表示由系统分配
+    :param batchMax 一批最多处理的心跳数量
+    :parameter receivedCount/invalidCount/batchCount 收到的心跳数/长度或状态不合法被丢弃的包数/处理的批数
+    """
+    REQUEST = struct.Struct("!IIffBBB")
+    REPLY = struct.Struct("!IIHBH")
+    # 状态编码
+    STATUS = {0: "powerOff", 1: "on", 2: "hibernate"}
+
+    def __init__(self, server, host="0.0.0.0", port=0, batchMax=256):
+        threading.Thread.__init__(self, daemon=True)
+        self.server = server
+        self.batchMax = batchMax
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.address = self.sock.getsockname()
+        self.running = False
+
+        self.receivedCount = 0
+        self.invalidCount = 0
+        self.batchCount = 0
+
+    def start(self):
+        self.running = True
+        threading.Thread.start(self)
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
+
+    def run(self):
+        while self.running:
+            try:
+                # 定期醒来检查是否已经停止
+                self.sock.settimeout(1.0)
+                try:
+                    packets = [self.sock.recvfrom(self.REQUEST.size + 1)]
+                except socket.timeout:
+                    continue
+                # 已经到达的心跳一起处理
+                self.sock.settimeout(0)
+                while len(packets) < self.batchMax:
+                    try:
+                        packets.append(self.sock.recvfrom(self.REQUEST.size + 1))
+                    except (BlockingIOError, socket.timeout):
+                        break
+            except OSError:
+                # stop() 关闭了 socket
+                break
+            self.handle(packets)
+
+    def handle(self, packets):
+        """
+        处理一批心跳并回复
+        :param packets: [(data, address)]
+        :return:
+        """
+        heartbeats = []
+        for data, address in packets:
+            if len(data) != self.REQUEST.size:
+                self.invalidCount += 1
+                continue
+            seq, roomNumber, ct, tt, cs, ts, status = self.REQUEST.unpack(data)
+            if status not in self.STATUS:
+                self.invalidCount += 1
+                continue
+            # float32 只保留两位小数，和 HTTP 上报的温度一致
+            heartbeats.append((seq, address, roomNumber, [round(ct, 2), round(tt, 2), cs, ts], self.STATUS[status]))
+        self.receivedCount += len(heartbeats)
+        if len(heartbeats) == 0:
+            return
+        self.batchCount += 1
+
+        if self.server.status == "off":
+            results = [(400, 0)] * len(heartbeats)
+        else:
+            results = self.server.updateMany([(roomNumber, state, status)
+                                              for seq, address, roomNumber, state, status in heartbeats])
+
+        for (seq, address, roomNumber, state, status), (statusCode, speed) in zip(heartbeats, results):
+            interval = self.server.heartbeatInterval(roomNumber)
+            try:
+                self.sock.sendto(self.REPLY.pack(seq, roomNumber, statusCode, speed, interval), address)
+            except OSError:
+                pass
+
+    def getStats(self):
+        return {
+            "address": "%s:%d" % self.address,
+            "receivedCount": self.receivedCount,
+            "invalidCount": self.invalidCount,
+            "batchCount": self.batchCount,
+        }
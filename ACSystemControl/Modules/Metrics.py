@@ -0,0 +1,153 @@
+from bisect import bisect_left
+
+
+class Histogram:
+    """
+    固定分桶的直方图
+    记录一次观测只需要一次二分查找和几次加法，不保存原始数据
+    :param bounds 各个桶的上界（升序），最后还有一个 +inf 桶
+    """
+    # 缺省分桶（秒）：1ms ~ 1h
+    DEFAULT_BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        合并另一个分桶相同的直方图
+        :param other: Histogram
+        :return: self
+        """
+        for idx, count in enumerate(other.counts):
+            self.counts[idx] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentile(self, p):
+        """
+        估计分位数：在所在的桶内按线性分布插值，不超过观测到的最大值
+        :param p: 0 ~ 1
+        :return:
+        """
+        if self.count == 0:
+            return 0
+        target = p * self.count
+        accumulated = 0
+        for idx, count in enumerate(self.counts):
+            if count > 0 and accumulated + count >= target:
+                if idx == len(self.bounds):
+                    return self.max
+                lower = self.bounds[idx - 1] if idx > 0 else 0
+                value = lower + (self.bounds[idx] - lower) * (target - accumulated) / count
+                return min(value, self.max)
+            accumulated += count
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count > 0 else 0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+            "buckets": [[bound, count] for bound, count in zip(self.bounds + ("+inf",), self.counts)],
+        }
+
+
+class SchedulerMetrics:
+    """
+    调度器的运行指标
+    只由调度器自己（一个线程/一个事件循环）写入，读取时只做拷贝，不加锁
+    :parameter serveLatency 风速 -> 请求从 ACServer.update 入队到开始送风的时长（秒）
+    :parameter passDuration 一轮（处理请求 + 调度）的耗时（秒）
+    :parameter recentPassDuration 最近几轮耗时的指数移动平均（秒），反映当前的负载
+    :parameter queueDepth/maxQueueDepth 风速 -> 等待队列当前/最大长度
+    :parameter serveCount/preemptCount/cancelCount 开始送风/被调出/被取消的次数
+    """
+    SPEEDS = (1, 2, 3)
+    # recentPassDuration 中新一轮耗时的权重
+    RECENT_WEIGHT = 0.2
+
+    def __init__(self):
+        self.serveLatency = {1: Histogram(), 2: Histogram(), 3: Histogram()}
+        self.passDuration = Histogram()
+        self.recentPassDuration = 0.0
+        self.queueDepth = {1: 0, 2: 0, 3: 0}
+        self.maxQueueDepth = {1: 0, 2: 0, 3: 0}
+        self.serveCount = 0
+        self.preemptCount = 0
+        self.cancelCount = 0
+
+    def observeServe(self, airRequest, now):
+        """
+        一个请求开始送风
+        只有第一次送风计入入队到送风的延迟，被调出之后再次送风不重复计入
+        :param airRequest: 送风请求
+        :param now: 当前时间（Clock.monotonic()）
+        :return:
+        """
+        self.serveCount += 1
+        if airRequest.requestTime is not None:
+            self.serveLatency[airRequest.targetSpeed].observe(now - airRequest.requestTime)
+            airRequest.requestTime = None
+
+    def observePass(self, duration, waitQueue):
+        """
+        一轮调度结束
+        :param duration: 这一轮的耗时（秒）
+        :param waitQueue: 等待队列，采样各风速的队列长度
+        :return:
+        """
+        self.passDuration.observe(duration)
+        self.recentPassDuration += self.RECENT_WEIGHT * (duration - self.recentPassDuration)
+        for speed in self.SPEEDS:
+            depth = waitQueue.size(speed)
+            self.queueDepth[speed] = depth
+            if depth > self.maxQueueDepth[speed]:
+                self.maxQueueDepth[speed] = depth
+
+    def merge(self, other):
+        """
+        合并另一个调度器的指标（分片调度时汇总）
+        :param other: SchedulerMetrics
+        :return: self
+        """
+        for speed in self.SPEEDS:
+            self.serveLatency[speed].merge(other.serveLatency[speed])
+            self.queueDepth[speed] += other.queueDepth[speed]
+            # 各分片的最大值不一定同时出现，相加是上界
+            self.maxQueueDepth[speed] += other.maxQueueDepth[speed]
+        self.passDuration.merge(other.passDuration)
+        # 分片并行调度，负载取最慢的分片
+        self.recentPassDuration = max(self.recentPassDuration, other.recentPassDuration)
+        self.serveCount += other.serveCount
+        self.preemptCount += other.preemptCount
+        self.cancelCount += other.cancelCount
+        return self
+
+    def snapshot(self):
+        return {
+            "serveLatency": {str(speed): self.serveLatency[speed].snapshot() for speed in self.SPEEDS},
+            "passDuration": self.passDuration.snapshot(),
+            "recentPassDuration": self.recentPassDuration,
+            "queueDepth": {str(speed): self.queueDepth[speed] for speed in self.SPEEDS},
+            "maxQueueDepth": {str(speed): self.maxQueueDepth[speed] for speed in self.SPEEDS},
+            "serveCount": self.serveCount,
+            "preemptCount": self.preemptCount,
+            "cancelCount": self.cancelCount,
+        }
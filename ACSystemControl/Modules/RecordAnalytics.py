@@ -0,0 +1,315 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from itertools import islice
+
+from django.db.models import F, Max, Subquery
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import Clock
+from .ACBillingManager import ACBillingManager
+from .. import models
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def toSeconds(date):
+    """
+    时间 -> 从 1970-01-01 开始的秒数（不带时区的本地时间）
+    """
+    return (ACBillingManager.localTime(date) - EPOCH).total_seconds()
+
+
+class RecordColumns:
+    """
+    一个时间段内的全部 Record，按列存放在 NumPy 数组中，按 (房间号, 时间) 排序
+    :param start/end 时间段 [start, end)
+    :parameter roomNumber/timestamp 房间号/记录时间（秒，见 toSeconds）
+    :parameter oldSpeed/newSpeed 送风风速
+    :parameter lastTargetTemperature/newTargetTemperature 目标温度
+    :parameter lastTargetSpeed/newTargetSpeed 目标风速
+    :parameter oldStatus/newStatus 空调状态编码，见 STATUS
+    :parameter seedRoom/seedSpeed 时间段开始时正在送风的房间和风速（由开始之前最后一条风速变化的记录得到）
+    """
+    # 空调状态 -> 编码，和 HeartbeatListener.STATUS 一致，入住之后还没开机是 3，其他 -1
+    STATUS = {"powerOff": 0, "on": 1, "hibernate": 2, "off": 3}
+    COLUMNS = (("roomNumber", "roomNumber", "int32"),
+               ("timestamp", "date", "float64"),
+               ("oldSpeed", "old_speed", "int8"),
+               ("newSpeed", "new_speed", "int8"),
+               ("lastTargetTemperature", "last_targetTemperature", "float32"),
+               ("newTargetTemperature", "new_targetTemperature", "float32"),
+               ("lastTargetSpeed", "last_targetSpeed", "int8"),
+               ("newTargetSpeed", "new_targetSpeed", "int8"),
+               ("oldStatus", "old_status", "int8"),
+               ("newStatus", "new_status", "int8"))
+
+    def __init__(self, start, end, columns, seedRoom=None, seedSpeed=None):
+        self.start = start
+        self.end = end
+        for name, field, dtype in self.COLUMNS:
+            setattr(self, name, columns[name])
+        self.seedRoom = np.zeros(0, dtype="int32") if seedRoom is None else seedRoom
+        self.seedSpeed = np.zeros(0, dtype="int8") if seedSpeed is None else seedSpeed
+
+    def __len__(self):
+        return len(self.roomNumber)
+
+    def rooms(self):
+        """
+        :return: 时间段内有记录或者正在送风的房间号，排序
+        """
+        return np.unique(np.concatenate((self.roomNumber, self.seedRoom)))
+
+    @classmethod
+    def load(cls, start, end, chunkSize=10000):
+        """
+        从数据库读出一个时间段的记录，分块转换成数组，不构造 Record 对象
+        :param start: 开始时间
+        :param end: 结束时间（不包含）
+        :param chunkSize: 每次从数据库读取的行数
+        :return: RecordColumns
+        """
+        fields = [field for name, field, dtype in cls.COLUMNS]
+        rows = models.Record.objects.filter(date__gte=start, date__lt=end) \
+            .order_by("roomNumber", "date", "id").values_list(*fields).iterator(chunk_size=chunkSize)
+
+        chunks = {name: [] for name, field, dtype in cls.COLUMNS}
+        while True:
+            chunk = list(islice(rows, chunkSize))
+            if len(chunk) == 0:
+                break
+            for (name, field, dtype), values in zip(cls.COLUMNS, zip(*chunk)):
+                if field == "date":
+                    values = [toSeconds(value) for value in values]
+                elif field.endswith("status"):
+                    values = [cls.STATUS.get(value, -1) for value in values]
+                chunks[name].append(np.array(values, dtype=dtype))
+
+        columns = {}
+        for name, field, dtype in cls.COLUMNS:
+            parts = chunks[name]
+            columns[name] = np.concatenate(parts) if len(parts) > 0 else np.zeros(0, dtype=dtype)
+        seedRoom, seedSpeed = cls.loadSeeds(start)
+        return cls(start, end, columns, seedRoom, seedSpeed)
+
+    @staticmethod
+    def loadSeeds(start):
+        """
+        时间段开始时正在送风的房间：每个房间开始之前最后一条风速变化的记录的新风速不为 0
+        同一个房间的记录按产生的顺序写入数据库，id 最大的就是最后一条
+        :param start: 开始时间
+        :return: (房间号数组, 风速数组)
+        """
+        lastIds = models.Record.objects.filter(date__lt=start).exclude(old_speed=F("new_speed")) \
+            .values("roomNumber").annotate(lastId=Max("id")).values("lastId")
+        rows = list(models.Record.objects.filter(id__in=Subquery(lastIds), new_speed__gt=0)
+                    .order_by("roomNumber").values_list("roomNumber", "new_speed"))
+        if len(rows) == 0:
+            return np.zeros(0, dtype="int32"), np.zeros(0, dtype="int8")
+        room, speed = zip(*rows)
+        return np.array(room, dtype="int32"), np.array(speed, dtype="int8")
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name, field, dtype in self.COLUMNS) \
+               + self.seedRoom.nbytes + self.seedSpeed.nbytes
+
+
+class RecordAnalytics:
+    """
+    历史记录的分析
+    把一个时间段的 Record 导出成按列存放的数组（RecordColumns），报表和图表在数组上做向量化的分组统计，
+    不逐行经过 ORM；已经结束的时间段的数组缓存起来，重复查询直接使用内存中的数组
+    记录是批量延迟写入数据库的（RecordSink），时间段结束超过 settle 秒之后才认为数据库中的记录已经完整，
+    在此之前只读不缓存
+    需要 numpy，没有安装时构造时抛出 ImportError
+    :param cacheSize 缓存的时间段数量，超过时淘汰最久没有使用的
+    :param chunkSize 每次从数据库读取的行数
+    :param settle 时间段结束多少秒之后才可以缓存，不能小于记录写入数据库的最长间隔
+    :parameter cache (start, end) -> RecordColumns
+    :parameter hitCount/missCount 缓存命中/没有命中的次数
+    """
+
+    def __init__(self, cacheSize=16, chunkSize=10000, settle=10):
+        if np is None:
+            raise ImportError("RecordAnalytics requires numpy")
+        self.cacheSize = cacheSize
+        self.chunkSize = chunkSize
+        self.settle = timedelta(seconds=settle)
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.hitCount = 0
+        self.missCount = 0
+
+    def columns(self, start, end):
+        """
+        一个时间段的记录数组，结束超过 settle 秒的时间段使用缓存
+        :param start: 开始时间
+        :param end: 结束时间（不包含）
+        :return: RecordColumns
+        """
+        key = (start, end)
+        with self.lock:
+            columns = self.cache.get(key)
+            if columns is not None:
+                self.cache.move_to_end(key)
+                self.hitCount += 1
+                return columns
+            self.missCount += 1
+
+        columns = RecordColumns.load(start, end, self.chunkSize)
+        if end <= Clock.now() - self.settle:
+            with self.lock:
+                self.cache[key] = columns
+                while len(self.cache) > self.cacheSize:
+                    self.cache.popitem(last=False)
+        return columns
+
+    @staticmethod
+    def edges(columns, bucket):
+        """
+        时间段按 bucket 秒分桶
+        :return: 桶的边界（相对开始时间的秒数），最后一个桶可能不满
+        """
+        span = (columns.end - columns.start).total_seconds()
+        edges = np.arange(0, span, bucket, dtype=np.float64)
+        return np.append(edges, span)
+
+    @staticmethod
+    def intervals(columns):
+        """
+        把风速变化的记录配对成送风段（向量化版本的 ACBillingManager.intervals）
+        每个房间第一条风速变化的记录之前已经在送风的，从时间段开始算起；
+        时间段内没有风速变化、开始时正在送风的房间（seedRoom），整个时间段都在送风；
+        没有结束的送风段算到时间段结束和现在中较早的一个，和 StatManager.report 一致
+        :return: room 房间号  start/end 开始/结束时间（相对时间段开始的秒数）  speed 风速
+        """
+        origin = toSeconds(columns.start)
+        span = (columns.end - columns.start).total_seconds()
+        limit = max(min(span, toSeconds(Clock.now()) - origin), 0.0)
+        mask = columns.oldSpeed != columns.newSpeed
+        room = columns.roomNumber[mask]
+        time = columns.timestamp[mask] - origin
+        old = columns.oldSpeed[mask]
+        new = columns.newSpeed[mask]
+
+        n = len(room)
+        sameNext = np.zeros(n, dtype=bool)
+        sameNext[:-1] = room[1:] == room[:-1]
+        first = np.ones(n, dtype=bool)
+        first[1:] = ~sameNext[:-1]
+
+        # 记录开始的送风段
+        started = new > 0
+        nextTime = np.empty(n)
+        nextTime[:-1] = time[1:]
+        end = np.maximum(np.where(sameNext, nextTime, limit), time)
+        # 时间段开始时已经在送风的
+        leading = first & (old > 0)
+        seeded = np.isin(columns.seedRoom, room, invert=True)
+        seedCount = np.count_nonzero(seeded)
+
+        return {
+            "room": np.concatenate((room[started], room[leading], columns.seedRoom[seeded])),
+            "start": np.concatenate((time[started], np.zeros(np.count_nonzero(leading)), np.zeros(seedCount))),
+            "end": np.concatenate((end[started], time[leading], np.full(seedCount, limit))),
+            "speed": np.concatenate((new[started], old[leading], columns.seedSpeed[seeded])),
+        }
+
+    def usage(self, start, end, bucket=3600):
+        """
+        每个房间在每个时间桶内的送风时长和费用，跨桶的送风段按重叠的部分分摊
+        用累积函数 G(t) = Σ rate·overlap([s, e), (-∞, t]) 在桶边界上的差分得到每个桶的值，
+        把各房间的时间平移到互不重叠的区间里，一次 searchsorted 完成所有房间
+        :param start: 开始时间
+        :param end: 结束时间（不包含）
+        :param bucket: 桶的长度（秒），缺省一小时
+        :return: rooms 房间号数组  edges 桶的边界（相对 start 的秒数）
+                 usageTime/cost [房间, 桶] 送风时长（分钟）/费用（元）
+        """
+        columns = self.columns(start, end)
+        edges = self.edges(columns, bucket)
+        span = edges[-1]
+        rooms = columns.rooms()
+        intervals = self.intervals(columns)
+        index = np.searchsorted(rooms, intervals["room"])
+        offset = index * span
+        starts = offset + intervals["start"]
+        ends = offset + intervals["end"]
+        rates = np.array([ACBillingManager.RATES.get(speed, 0) for speed in range(4)])[intervals["speed"]]
+
+        grid = (np.arange(len(rooms)) * span)[:, None] + edges[None, :]
+        seconds = np.diff(self.cumulative(starts, ends, np.ones(len(starts)), grid), axis=1)
+        cost = np.diff(self.cumulative(starts, ends, rates, grid), axis=1)
+        return {
+            "rooms": rooms,
+            "edges": edges,
+            "usageTime": seconds / 60,
+            "cost": cost / 60,
+        }
+
+    @staticmethod
+    def cumulative(starts, ends, weights, grid):
+        """
+        G(T) = Σ_{s<=T} w·(T - s) - Σ_{e<=T} w·(T - e)
+        :return: 和 grid 形状相同
+        """
+        def partial(points):
+            order = np.argsort(points, kind="stable")
+            points = points[order]
+            w = weights[order]
+            weightSum = np.concatenate(([0.0], np.cumsum(w)))
+            pointSum = np.concatenate(([0.0], np.cumsum(w * points)))
+            k = np.searchsorted(points, grid, side="right")
+            return grid * weightSum[k] - pointSum[k]
+
+        return partial(starts) - partial(ends)
+
+    def counts(self, start, end, bucket=86400):
+        """
+        每个房间在每个时间桶内的次数统计，口径和 StatManager 相同
+        :param start: 开始时间
+        :param end: 结束时间（不包含）
+        :param bucket: 桶的长度（秒），缺省一天
+        :return: rooms edges
+                 onCount/offCount/scheduleCount/detailCount/temperatureCount/speedCount [房间, 桶]
+        """
+        columns = self.columns(start, end)
+        edges = self.edges(columns, bucket)
+        rooms = columns.rooms()
+        buckets = len(edges) - 1
+        index = np.searchsorted(rooms, columns.roomNumber)
+        position = np.minimum(((columns.timestamp - toSeconds(columns.start)) // bucket).astype(np.int64),
+                              buckets - 1)
+        flat = index * buckets + position
+
+        statusChanged = columns.oldStatus != columns.newStatus
+        speedChanged = columns.oldSpeed != columns.newSpeed
+        masks = {
+            "onCount": statusChanged & (columns.newStatus == RecordColumns.STATUS["on"]),
+            "offCount": statusChanged & (columns.newStatus == RecordColumns.STATUS["powerOff"]),
+            "scheduleCount": speedChanged & (columns.oldSpeed == 0),
+            "detailCount": speedChanged & (columns.newSpeed > 0),
+            # 入住之后第一次设置不算调温调风
+            "temperatureCount": (columns.lastTargetTemperature != columns.newTargetTemperature)
+                                & (columns.lastTargetTemperature != 0),
+            "speedCount": (columns.lastTargetSpeed != columns.newTargetSpeed) & (columns.lastTargetSpeed != 0),
+        }
+        result = {"rooms": rooms, "edges": edges}
+        for name, mask in masks.items():
+            result[name] = np.bincount(flat[mask], minlength=len(rooms) * buckets).reshape(len(rooms), buckets)
+        return result
+
+    def getStats(self):
+        with self.lock:
+            return {
+                "cached": len(self.cache),
+                "cachedBytes": sum(columns.nbytes() for columns in self.cache.values()),
+                "cachedRecords": sum(len(columns) for columns in self.cache.values()),
+                "hitCount": self.hitCount,
+                "missCount": self.missCount,
+            }
@@ -0,0 +1,176 @@
+import logging
+import threading
+import time
+
+from django.db import transaction
+
+from .. import models
+
+logger = logging.getLogger(__name__)
+
+
+class RecordSink:
+    """
+    Record 的批量写入器
+    请求线程、调度器线程产生的 Record 先放进内存，由后台线程用 bulk_create 批量写入数据库，
+    积压达到 batchSize 条或者距离上一次写入超过 flushInterval 秒时写一次
+    退房、查询详单之前调用 flush 保证数据库中的记录是完整的
+    一批记录写入失败时改为逐条写入，写不进去的记录记日志后丢弃，不影响其他记录，后台线程也不会退出
+    :param batchSize 一次 bulk_create 最多写入的记录数，积压达到这个数量时提前写数据库
+    :param flushInterval 后台写数据库的最长间隔（秒）
+    :parameter pending 还没写数据库的 Record
+    :parameter flushCount/batchCount/recordCount 写数据库的次数/bulk_create 的次数/写入的 Record 数
+    :parameter failedFlushCount/droppedCount 批量写入失败的次数/逐条写入仍然失败而丢弃的 Record 数
+    :parameter lastBatchSize/maxBatchSize 最近一次/最大的 bulk_create 批次大小
+    :parameter lastFlushDuration/maxFlushDuration/totalFlushDuration 写数据库的耗时（秒）
+    """
+
+    def __init__(self, batchSize=500, flushInterval=1.0):
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+
+        self.lock = threading.Lock()
+        self.pending = []
+        # 同一时间只有一个 flush 在写数据库，保证写入顺序
+        self.flushLock = threading.Lock()
+
+        self.flushCount = 0
+        self.batchCount = 0
+        self.recordCount = 0
+        self.failedFlushCount = 0
+        self.droppedCount = 0
+        self.lastBatchSize = 0
+        self.maxBatchSize = 0
+        self.lastFlushDuration = 0.0
+        self.maxFlushDuration = 0.0
+        self.totalFlushDuration = 0.0
+
+        self.wakeup = threading.Event()
+        self.running = False
+        self.writer = None
+
+    def start(self):
+        """
+        启动后台写数据库的线程
+        :return:
+        """
+        if self.writer is not None:
+            return
+        self.running = True
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def stop(self):
+        """
+        停止后台线程，并把积压的记录全部写入数据库
+        :return:
+        """
+        self.running = False
+        self.wakeup.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        self.flush()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.flushInterval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("record flush failed")
+
+    def put(self, record):
+        """
+        添加一条记录
+        :param record: Record
+        :return:
+        """
+        self.putMany([record])
+
+    def putMany(self, records):
+        """
+        添加多条记录，保持给出的顺序
+        :param records: [Record]
+        :return:
+        """
+        if len(records) == 0:
+            return
+        with self.lock:
+            self.pending.extend(records)
+            if len(self.pending) >= self.batchSize:
+                self.wakeup.set()
+
+    def flush(self):
+        """
+        把积压的记录在一个事务里按 batchSize 分批 bulk_create
+        :return:
+        """
+        with self.flushLock:
+            with self.lock:
+                if len(self.pending) == 0:
+                    return
+                records = self.pending
+                self.pending = []
+
+            start = time.monotonic()
+            try:
+                with transaction.atomic():
+                    for idx in range(0, len(records), self.batchSize):
+                        batch = records[idx:idx + self.batchSize]
+                        models.Record.objects.bulk_create(batch)
+                        self.batchCount += 1
+                        self.lastBatchSize = len(batch)
+                        self.maxBatchSize = max(self.maxBatchSize, len(batch))
+                written = len(records)
+            except Exception:
+                logger.exception("bulk_create of %d records failed, writing them one by one", len(records))
+                self.failedFlushCount += 1
+                written = self.saveEach(records)
+            duration = time.monotonic() - start
+
+            self.flushCount += 1
+            self.recordCount += written
+            self.lastFlushDuration = duration
+            self.maxFlushDuration = max(self.maxFlushDuration, duration)
+            self.totalFlushDuration += duration
+
+    def saveEach(self, records):
+        """
+        逐条写入记录，写不进去的丢弃
+        :param records: [Record]
+        :return: 写入的记录数
+        """
+        written = 0
+        for record in records:
+            try:
+                with transaction.atomic():
+                    record.save()
+                written += 1
+            except Exception:
+                self.droppedCount += 1
+                logger.exception("dropped record of room %s", record.roomNumber)
+        return written
+
+    def getStats(self):
+        """
+        批量写入的统计
+        :return: dict
+        """
+        with self.lock:
+            pending = len(self.pending)
+        return {
+            "pending": pending,
+            "flushCount": self.flushCount,
+            "batchCount": self.batchCount,
+            "recordCount": self.recordCount,
+            "failedFlushCount": self.failedFlushCount,
+            "droppedCount": self.droppedCount,
+            "lastBatchSize": self.lastBatchSize,
+            "maxBatchSize": self.maxBatchSize,
+            "averageBatchSize": self.recordCount / self.batchCount if self.batchCount > 0 else 0,
+            "lastFlushDuration": self.lastFlushDuration,
+            "maxFlushDuration": self.maxFlushDuration,
+            "averageFlushDuration": self.totalFlushDuration / self.flushCount if self.flushCount > 0 else 0,
+        }
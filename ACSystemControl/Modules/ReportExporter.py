@@ -0,0 +1,105 @@
+import csv
+import tempfile
+from itertools import islice
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+from .ACBillingManager import ACBillingManager
+from .StatManager import RoomStat
+from .. import models
+
+
+class Echo:
+    """
+    csv.writer 的输出对象，write 直接返回写入的内容，不缓存
+    """
+
+    def write(self, value):
+        return value
+
+
+class ReportExporter:
+    """
+    报表导出
+    行数据都是生成器，按块从数据库读取，边读边写，内存占用和报表大小无关
+    CSV 一块一块地返回，第一块（表头）马上就能发出去；
+    XLSX 需要 openpyxl，用只写模式写入临时文件，写完之后再按块返回
+    :param chunkSize 每次从数据库读取的行数，也是 CSV 每一块包含的行数
+    """
+    REPORT_HEADER = ("roomNumber",) + RoomStat.FIELDS
+    RECORD_FIELDS = ("roomNumber", "date", "old_status", "new_status", "old_speed", "new_speed",
+                     "last_targetTemperature", "new_targetTemperature", "last_targetSpeed", "new_targetSpeed")
+    RECORD_HEADER = ("roomNumber", "date", "oldStatus", "newStatus", "oldSpeed", "newSpeed",
+                     "lastTargetTemperature", "newTargetTemperature", "lastTargetSpeed", "newTargetSpeed")
+    # XLSX 按块返回临时文件时每一块的字节数
+    FILE_BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, chunkSize=1000):
+        self.chunkSize = chunkSize
+
+    @staticmethod
+    def xlsxAvailable():
+        return openpyxl is not None
+
+    def reportRows(self, report):
+        """
+        统计报表的行：每个房间一行，最后一行是合计
+        :param report: StatManager.report 的返回
+        :return: 生成 tuple
+        """
+        for row in report["rooms"]:
+            yield tuple(row[name] for name in self.REPORT_HEADER)
+        total = report["total"]
+        yield ("total",) + tuple(total[name] for name in RoomStat.FIELDS)
+
+    def recordRows(self, start, end):
+        """
+        一个时间段的全部记录，按 (房间号, 时间) 顺序，分块读取，不构造 Record 对象
+        :param start: 开始时间
+        :param end: 结束时间（不包含）
+        :return: 生成 tuple
+        """
+        rows = models.Record.objects.filter(date__gte=start, date__lt=end) \
+            .order_by("roomNumber", "date", "id").values_list(*self.RECORD_FIELDS).iterator(chunk_size=self.chunkSize)
+        for row in rows:
+            yield (row[0], ACBillingManager.formatTime(ACBillingManager.localTime(row[1]))) + row[2:]
+
+    def csv(self, header, rows):
+        """
+        CSV，每 chunkSize 行返回一块
+        :param header: 表头
+        :param rows: 行的生成器
+        :return: 生成 str
+        """
+        writer = csv.writer(Echo())
+        yield writer.writerow(header)
+        while True:
+            chunk = list(islice(rows, self.chunkSize))
+            if len(chunk) == 0:
+                break
+            yield "".join(writer.writerow(row) for row in chunk)
+
+    def xlsx(self, header, rows, title="report"):
+        """
+        XLSX，只写模式逐行写入临时文件，写完之后按 FILE_BLOCK_SIZE 返回
+        :param header: 表头
+        :param rows: 行的生成器
+        :param title: 工作表名称
+        :return: 生成 bytes
+        """
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet(title)
+        sheet.append(header)
+        for row in rows:
+            sheet.append(row)
+        with tempfile.TemporaryFile() as f:
+            workbook.save(f)
+            f.seek(0)
+            while True:
+                block = f.read(self.FILE_BLOCK_SIZE)
+                if len(block) == 0:
+                    break
+                yield block
@@ -0,0 +1,162 @@
+import threading
+import time
+from collections import deque
+
+
+class RequestChannel:
+    """
+    客户端（ACServer.update）和调度器线程之间的请求通道
+    有界的先进先出队列，一把锁 + 两个条件变量，不会出现 Event set/clear 的竞争
+    队列满时 put 最多阻塞 timeout 秒，仍然放不下则返回 False，由调用方决定怎么处理（背压）
+    :param capacity 队列容量
+    :parameter putCount 入队的请求数
+    :parameter rejectedCount 因为队列满被拒绝的请求数
+    :parameter getCount 出队的请求数
+    :parameter maxDepth 队列出现过的最大长度
+    :parameter putWaitTotal/putWaitMax 入队时因为队列满而阻塞的总时长/最长时长（秒）
+    :parameter queueLatencyTotal/queueLatencyMax 请求从入队到被调度器取走的总时长/最长时长（秒）
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = int(capacity)
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.notEmpty = threading.Condition(self.lock)
+        self.notFull = threading.Condition(self.lock)
+
+        self.putCount = 0
+        self.rejectedCount = 0
+        self.getCount = 0
+        self.maxDepth = 0
+        self.putWaitTotal = 0.0
+        self.putWaitMax = 0.0
+        self.queueLatencyTotal = 0.0
+        self.queueLatencyMax = 0.0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item, timeout=None):
+        """
+        请求入队
+        :param item: 请求
+        :param timeout: 队列满时最多等待的秒数，0 表示不等待，None 表示一直等待
+        :return: 是否入队成功
+        """
+        return self.putMany([item], timeout)
+
+    def putMany(self, items, timeout=None):
+        """
+        一次入队多个请求，要么全部入队，要么全部不入队
+        :param items: 请求列表
+        :param timeout: 队列满时最多等待的秒数，0 表示不等待，None 表示一直等待
+        :return: 是否入队成功
+        """
+        if len(items) == 0:
+            return True
+        if len(items) > self.capacity:
+            self.reject(len(items))
+            return False
+
+        with self.notFull:
+            # 队列满，等待调度器取走请求
+            if not self.hasRoom(len(items)) and not self.waitRoom(len(items), timeout):
+                self.rejectedCount += len(items)
+                return False
+            self.enqueue(items)
+        return True
+
+    def hasRoom(self, count):
+        """
+        队列是否还放得下 count 个请求，调用方持有 lock
+        """
+        return len(self.items) + count <= self.capacity
+
+    def waitRoom(self, count, timeout=None):
+        """
+        等待队列放得下 count 个请求
+        :param count: 请求数
+        :param timeout: 最多等待的秒数，None 表示一直等待
+        :return: 是否放得下
+        """
+        with self.notFull:
+            start = time.monotonic()
+            ok = self.notFull.wait_for(lambda: self.hasRoom(count), timeout)
+            waited = time.monotonic() - start
+            self.putWaitTotal += waited
+            self.putWaitMax = max(self.putWaitMax, waited)
+            return ok
+
+    def enqueue(self, items):
+        """
+        请求入队，不检查容量，调用方持有 lock 并且已经确认放得下
+        :param items: 请求列表
+        :return:
+        """
+        now = time.monotonic()
+        for item in items:
+            self.items.append((now, item))
+        self.putCount += len(items)
+        self.maxDepth = max(self.maxDepth, len(self.items))
+        self.notEmpty.notify()
+
+    def reject(self, count):
+        """
+        记录被拒绝的请求数
+        """
+        with self.lock:
+            self.rejectedCount += count
+
+    def get(self, timeout=None):
+        """
+        取出一个请求
+        :param timeout: 队列空时最多等待的秒数，None 表示一直等待
+        :return: 请求，超时返回 None
+        """
+        items = self.getBatch(1, timeout)
+        if len(items) == 0:
+            return None
+        return items[0]
+
+    def getBatch(self, maxItems=None, timeout=None):
+        """
+        取出队列中的请求，队列空时阻塞直到有请求或者超时
+        :param maxItems: 最多取出多少个，None 表示全部取出
+        :param timeout: 队列空时最多等待的秒数，None 表示一直等待
+        :return: 按入队顺序排列的请求列表，超时返回空列表
+        """
+        batch = []
+        with self.notEmpty:
+            if not self.notEmpty.wait_for(lambda: len(self.items) > 0, timeout):
+                return batch
+
+            now = time.monotonic()
+            count = len(self.items) if maxItems is None else min(maxItems, len(self.items))
+            for i in range(count):
+                enqueueTime, item = self.items.popleft()
+                latency = now - enqueueTime
+                self.queueLatencyTotal += latency
+                self.queueLatencyMax = max(self.queueLatencyMax, latency)
+                batch.append(item)
+            self.getCount += count
+            self.notFull.notify_all()
+        return batch
+
+    def getStats(self):
+        """
+        通道的运行统计
+        :return: dict
+        """
+        with self.lock:
+            return {
+                "capacity": self.capacity,
+                "depth": len(self.items),
+                "maxDepth": self.maxDepth,
+                "putCount": self.putCount,
+                "rejectedCount": self.rejectedCount,
+                "getCount": self.getCount,
+                "putWaitAverage": self.putWaitTotal / self.putCount if self.putCount > 0 else 0,
+                "putWaitMax": self.putWaitMax,
+                "queueLatencyAverage": self.queueLatencyTotal / self.getCount if self.getCount > 0 else 0,
+                "queueLatencyMax": self.queueLatencyMax,
+            }
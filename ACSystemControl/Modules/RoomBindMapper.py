@@ -11,11 +11,7 @@ class RoomBindMapper:
         :param num: 房间数量
         """
         self.upperBound = int(num)
-        _roomBindDict = []
-        for i in range(200):
-            _roomBindDict.append(None)
-
-        self.roomBindDict = _roomBindDict
+        self.roomBindDict = [None] * self.upperBound
 
     def register(self, roomNumber, ID):
         """
@@ -52,7 +48,7 @@ class RoomBindMapper:
         if roomNumber > self.upperBound or roomNumber <= 0:
             statusCode = 411
         elif self.roomBindDict[roomNumber - 1] is None:
-            statusCode = 413
+            statusCode = 414
         elif self.roomBindDict[roomNumber - 1] != ID:
             statusCode = 415
         else:
@@ -75,10 +71,10 @@ class RoomBindMapper:
         roomNumber = int(roomNumber)
         if roomNumber > self.upperBound or roomNumber <= 0:
             statusCode = 411
-        elif self.roomBindDict[roomNumber] is None:
-            statusCode = 413
-        elif self.roomBindDict[roomNumber] != ID:
+        elif self.roomBindDict[roomNumber - 1] is None:
+            statusCode = 414
+        elif self.roomBindDict[roomNumber - 1] != ID:
             statusCode = 415
-        elif self.roomBindDict[roomNumber] == ID:
+        elif self.roomBindDict[roomNumber - 1] == ID:
             statusCode = 200
         return statusCode
@@ -1,6 +1,16 @@
+import heapq
+import logging
 import threading
-from datetime import datetime
-from ..models import AC, Record
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from ..models import AC
+from . import Clock
+from .Metrics import SchedulerMetrics
+from .TimerWheel import TimerWheel
+from .WaitQueue import WaitQueue
+
+logger = logging.getLogger(__name__)
 
 
 class Request:
@@ -21,6 +31,16 @@ class Request:
     def setType(self, type):
         self.type = type
 
+    def getRoomNumber(self):
+        """
+        请求所属的房间号
+        （关机/休眠请求的 airRequest 直接就是房间号）
+        :return:
+        """
+        if isinstance(self.airRequest, ACAirRequest):
+            return self.airRequest.roomNumber
+        return int(self.airRequest)
+
 
 class ACAirRequest:
     """
@@ -30,27 +50,28 @@ class ACAirRequest:
     :param targetSpeed 目标风速
     :param lastWaitStartTime 开始等待的时间
     :param waitingTime 总共等待的时间
+    :param requestTime 请求产生的时间（Clock.monotonic()），第一次开始送风之后清空，用于统计调度延迟
     """
 
     def __init__(self, roomNumber, targetTemperature, targetSpeed):
-        self.roomNumber = roomNumber
-        self.targetTemperature = targetTemperature
-        self.targetSpeed = targetSpeed
-        self.lastWaitStartTime = datetime.now()
+        self.roomNumber = int(roomNumber)
+        self.targetTemperature = float(targetTemperature)
+        self.targetSpeed = int(targetSpeed)
+        self.lastWaitStartTime = Clock.now()
         self.waitingTime = None
+        self.requestTime = Clock.monotonic()
 
     def getWaitTime(self):
         """
         返回等待时间
         :return:
         """
-        _current_time = datetime.now()
-
-        if self.waitingTime is None:
-            waitTime = _current_time - self.lastWaitStartTime
-        else:
-            waitTime = _current_time - self.lastWaitStartTime
+        waitTime = timedelta(0)
+        if self.waitingTime is not None:
             waitTime += self.waitingTime
+        # 正在等待，还要加上这一次已经等待的时长
+        if self.lastWaitStartTime is not None:
+            waitTime += Clock.now() - self.lastWaitStartTime
 
         return waitTime
 
@@ -59,14 +80,16 @@ class ACAirRequest:
         该Request开始等待
         :return:
         """
-        self.lastWaitStartTime = datetime.now()
+        self.lastWaitStartTime = Clock.now()
 
     def stopWaiting(self):
         """
         该Request停止等待
         :return:
         """
-        self.waitingTime = datetime.now() - self.lastWaitStartTime
+        if self.lastWaitStartTime is None:
+            return
+        self.waitingTime = self.getWaitTime()
         self.lastWaitStartTime = None
 
     def setWaitTime(self, waitTime):
@@ -97,7 +120,7 @@ class ServingInstance:
         :return:
         """
         self.airRequest = airRequest
-        self.servingTimeStamp = datetime.now()
+        self.servingTimeStamp = Clock.now()
 
 
 class ServingCluster:
@@ -105,36 +128,48 @@ class ServingCluster:
     服务对象集群
     :param instanceNum 服务对象数量
     :parameter runningInstance 正在运行的服务对象数量
+    服务状态是增量维护的，serve/quitServing/finishServing/updateRequest 时同步更新，
+    调度时的容量判断和淘汰对象选择不需要遍历所有服务对象：
+    :parameter freeSlots 空闲服务对象编号（小根堆，优先使用编号小的）
+    :parameter servingBySpeed 风速 -> 正在以该风速服务的服务对象编号（按开始服务的先后排列）
+    :parameter roomIndex roomNumber -> 正在为该房间服务的服务对象编号
+    :parameter lentSlots 借给其他集群的服务对象编号
+    :parameter retiredSlots 借来又归还了的服务对象编号（可以再次借入时复用）
     """
+    SPEEDS = (1, 2, 3)
+
     def __init__(self, instanceNum):
-        self.instanceNum = instanceNum
+        self.instanceNum = int(instanceNum)
         self.instances = []
-        for i in range(instanceNum):
+        for i in range(self.instanceNum):
             self.instances.append(ServingInstance(i))
         self.runningInstance = 0
 
+        self.freeSlots = list(range(self.instanceNum))
+        self.servingBySpeed = {1: OrderedDict(), 2: OrderedDict(), 3: OrderedDict()}
+        self.roomIndex = {}
+        self.lentSlots = []
+        self.retiredSlots = []
+
     def canServe(self):
         """
         服务对象集群是否可以接受新的请求
         :return:
         """
-        if self.runningInstance < self.instanceNum:
-            return True
-        else:
-            return False
+        return len(self.freeSlots) > 0
 
     def serve(self, airRequest):
         """
         处理一个送风请求
         :param airRequest:
-        :return:
+        :return: 服务对象编号
         """
         airRequest.stopWaiting()
         self.runningInstance += 1
-        for i in range(self.instanceNum):
-            if self.instances[i].airRequest is None:
-                self.instances[i].serve(airRequest)
-                break
+        num = heapq.heappop(self.freeSlots)
+        self.instances[num].serve(airRequest)
+        self._track(num, airRequest)
+        return num
 
     def quitServing(self, num):
         """
@@ -143,9 +178,7 @@ class ServingCluster:
         :param num: 停止运行在几号服务对象上的服务
         :return: airRequest 被调出的送风请求
         """
-        self.runningInstance -= 1
-        airRequest = self.instances[num].airRequest
-        self.instances[num].airRequest = None
+        airRequest = self._release(num)
 
         airRequest.startWaiting()
         return airRequest
@@ -155,35 +188,126 @@ class ServingCluster:
         完成了一个请求
         （主要由取消触发，送风请求已经被满足）
         :param roomNumber: 停止服务的房间号
-        :return: airRequest 被满足的请求
+        :return: airRequest 被满足的请求，该房间没有在服务时返回 None
         """
-        self.runningInstance -= 1
-        airRequest = None
-        for idx, item in enumerate(self.instances):
-            if item.airRequest.roomNumber == roomNumber:
-                airRequest = self.instances[idx].airRequest
-                self.instances[idx].airRequest = None
+        num = self.findInstance(roomNumber)
+        if num is None:
+            return None
 
-        return airRequest
+        return self._release(num)
 
     def updateRequest(self, newRequest):
-        for idx, item in enumerate(self.instances):
-            if item.airRequest.roomNumber == newRequest.roomNumber:
-                self.instances[idx].airRequest = newRequest
-                break
+        num = self.findInstance(newRequest.roomNumber)
+        if num is None:
+            return
+        oldRequest = self.instances[num].airRequest
+        self.instances[num].airRequest = newRequest
+        # 风速变了，服务优先级也跟着变
+        if oldRequest.targetSpeed != newRequest.targetSpeed:
+            del self.servingBySpeed[oldRequest.targetSpeed][num]
+            self.servingBySpeed[newRequest.targetSpeed][num] = None
+
+    def lendInstance(self):
+        """
+        借出一个空闲的服务对象（分片调度时借给其他集群），借出期间本集群不使用它
+        :return: 是否借出成功
+        """
+        if len(self.freeSlots) == 0:
+            return False
+        self.lentSlots.append(heapq.heappop(self.freeSlots))
+        self.instanceNum -= 1
+        return True
+
+    def reclaimInstance(self):
+        """
+        收回一个借出的服务对象
+        :return:
+        """
+        heapq.heappush(self.freeSlots, self.lentSlots.pop())
+        self.instanceNum += 1
+
+    def addInstance(self):
+        """
+        增加一个服务对象（从其他集群借来的）
+        :return: 服务对象编号
+        """
+        if len(self.retiredSlots) > 0:
+            num = self.retiredSlots.pop()
+        else:
+            num = len(self.instances)
+            self.instances.append(ServingInstance(num))
+        heapq.heappush(self.freeSlots, num)
+        self.instanceNum += 1
+        return num
+
+    def removeInstance(self, num):
+        """
+        去掉一个空闲的服务对象（归还借来的服务对象）
+        :param num: 服务对象编号
+        :return: 是否去掉成功（服务对象正在服务时不能去掉）
+        """
+        if num not in self.freeSlots:
+            return False
+        self.freeSlots.remove(num)
+        heapq.heapify(self.freeSlots)
+        self.retiredSlots.append(num)
+        self.instanceNum -= 1
+        return True
+
+    def findInstance(self, roomNumber):
+        """
+        查找正在为某个房间服务的服务对象
+        :param roomNumber: 房间号
+        :return: 服务对象编号，该房间没有在服务时返回 None
+        """
+        return self.roomIndex.get(int(roomNumber))
+
+    def findRequest(self, roomNumber):
+        """
+        查找某个房间正在被服务的送风请求
+        :param roomNumber: 房间号
+        :return: airRequest 该房间没有在服务时返回 None
+        """
+        num = self.findInstance(roomNumber)
+        if num is None:
+            return None
+        return self.instances[num].airRequest
+
+    def minServingSpeed(self):
+        """
+        正在服务的请求中最低的风速
+        :return: 1/2/3，没有正在服务的请求时返回 4
+        """
+        for speed in self.SPEEDS:
+            if self.servingBySpeed[speed]:
+                return speed
+        return 4
+
+    def getVictim(self):
+        """
+        优先级调度时被淘汰的服务对象：风速最低的服务对象中最早开始服务的那个
+        :return: 服务对象编号，没有正在服务的请求时返回 None
+        """
+        for speed in self.SPEEDS:
+            serving = self.servingBySpeed[speed]
+            if serving:
+                return next(iter(serving))
+        return None
 
     def getServingStatus(self):
         """
         获取当前服务对象集群的服务状态简报
+        （只用于展示，调度请使用 minServingSpeed/getVictim）
         :return: servingSpeedList 服务对象集群上的送风速度
                  servingTimeList 服务对象集群上的送风时长
         """
         servingSpeedList = []
         servingTimeList = []
+        now = Clock.now()
         for item in self.instances:
             if item.airRequest is not None:
                 servingSpeedList.append(item.airRequest.targetSpeed)
-                servingTimeList.append(datetime.now() - item.servingTimeStamp)
+                servingTimeList.append(now - item.servingTimeStamp)
             else:
                 servingSpeedList.append(0)
                 servingTimeList.append(None)
@@ -191,46 +315,91 @@ class ServingCluster:
         return servingSpeedList, servingTimeList
 
     def getRoomNumbers(self):
-        _list = []
-        for item in self.instances:
-            _list.append(item.airRequest.roomNumber)
-        return _list
+        return list(self.roomIndex.keys())
+
+    def _track(self, num, airRequest):
+        """
+        登记一个开始服务的服务对象
+        :param num: 服务对象编号
+        :param airRequest: 送风请求
+        :return:
+        """
+        self.servingBySpeed[airRequest.targetSpeed][num] = None
+        self.roomIndex[airRequest.roomNumber] = num
+
+    def _release(self, num):
+        """
+        释放一个服务对象，放回空闲集合
+        :param num: 服务对象编号
+        :return: airRequest 该服务对象上原来的送风请求
+        """
+        self.runningInstance -= 1
+        airRequest = self.instances[num].airRequest
+        self.instances[num].airRequest = None
+
+        del self.servingBySpeed[airRequest.targetSpeed][num]
+        del self.roomIndex[airRequest.roomNumber]
+        heapq.heappush(self.freeSlots, num)
+        return airRequest
+
 
 class Scheduler:
     """
     调度器基类
     :param cluster 服务对象集群
     :param instanceNum 服务对象数量
+    :parameter waitQueue 低/中/高三个风速的等待队列
     """
-    # 共有属性 三个队列
-    lowSpeedQueue = []
-    midSpeedQueue = []
-    highSpeedQueue = []
 
     def __init__(self, instanceNum, cluster):
         self.instanceNum = instanceNum
         self.cluster = cluster
+        self.waitQueue = WaitQueue()
 
 
-class PriorityScheduler(threading.Thread, Scheduler):
+class PriorityPolicy(Scheduler):
     """
-    优先级调度器
-    有新请求的时候产生跟据优先级进行调度
+    优先级调度策略
+    风速高的请求优先，服务对象不够时淘汰风速最低的请求；同风速先来先服务
+    线程版（PriorityScheduler）和 asyncio 版（AsyncPriorityScheduler）共用这一套策略，
+    只是取请求的方式不同
     :param instanceNum Scheduler父类-服务对象数量
     :param cluster Scheduler父类-服务对象集群
-    :param requestQueue 请求队列——客户端的消息队列
-    因为请求队列是调度器和客户端共同使用的，下面的两个资源是用来进程之间同步的
-    :param lock 请求队列加的锁
-    :param event 请求队列有新请求的事件
+    :param batch 批量模式：一次取出请求队列中的全部请求，按房间合并后只做一次调度
+    :parameter batchCount 批量模式下处理过的批次数
+    :parameter requestCount 从请求队列取出的请求总数
+    :parameter coalescedCount 因为同一房间有更新的请求而被合并掉的请求数
+    :parameter lastBatchSize/maxBatchSize 最近一批/最大一批的请求数
+    :parameter stateManager 空调状态表（ACStateManager），None 时直接读写数据库
+    :parameter group 所属的分片调度组，不分片时为 None
+    :parameter metrics 调度延迟、队列长度、调度次数等运行指标
     """
-    def __init__(self, instanceNum, cluster, requestQueue, lock, event):
-        Scheduler.__init__(self, instanceNum, cluster)
-        threading.Thread.__init__(self)
 
-        # request queue resource
-        self.requestQueue = requestQueue
-        self.lock = lock
-        self.event = event
+    def __init__(self, instanceNum, cluster, batch=False):
+        Scheduler.__init__(self, instanceNum, cluster)
+        self.stateManager = None
+        self.group = None
+        self.metrics = SchedulerMetrics()
+
+        # ingest statistics
+        self.batch = batch
+        self.batchCount = 0
+        self.requestCount = 0
+        self.coalescedCount = 0
+        self.lastBatchSize = 0
+        self.maxBatchSize = 0
+
+    def countBatch(self, requests):
+        """
+        记录一批取出的请求
+        :param requests: 这一批请求
+        :return:
+        """
+        if len(requests) > 0:
+            self.batchCount += 1
+            self.requestCount += len(requests)
+            self.lastBatchSize = len(requests)
+            self.maxBatchSize = max(self.maxBatchSize, len(requests))
 
     def canSchedule(self):
         """
@@ -239,26 +408,17 @@ class PriorityScheduler(threading.Thread, Scheduler):
                  1 可以进行优先级调度
                  0 没办法调度
         """
+        maxWaitingSpeed = self.waitQueue.maxSpeed()
+        # 没有请求在等待
+        if maxWaitingSpeed == 0:
+            return 0
+
         # 如果有空闲的服务对象
         if self.cluster.canServe():
             return 2
         else:
             # 查看当前服务的优先级，是否有低于正在等待的请求
-            speedList = self.cluster.getServingStatus()
-            minServingSpeed = 4
-            for item in speedList:
-                if item < minServingSpeed:
-                    minServingSpeed = item
-
-            maxWaitingSpeed = 0
-            if len(self.highSpeedQueue) > 0:
-                maxWaitingSpeed = 3
-            elif len(self.midSpeedQueue) > 0:
-                maxWaitingSpeed = 2
-            elif len(self.lowSpeedQueue) > 0:
-                maxWaitingSpeed = 1
-
-            if minServingSpeed < maxWaitingSpeed:
+            if self.cluster.minServingSpeed() < maxWaitingSpeed:
                 return 1
             else:
                 return 0
@@ -268,14 +428,7 @@ class PriorityScheduler(threading.Thread, Scheduler):
         获取一个优先级最高的请求
         :return:  airRequest 优先级最高的请求
         """
-        airRequest = None
-        if len(self.highSpeedQueue) > 0:
-            airRequest = self.highSpeedQueue.pop(0)
-        elif len(self.midSpeedQueue) > 0:
-            airRequest = self.midSpeedQueue.pop(0)
-        elif len(self.lowSpeedQueue) > 0:
-            airRequest = self.lowSpeedQueue.pop(0)
-        return airRequest
+        return self.waitQueue.get()
 
     def putRequest(self, airRequest):
         """
@@ -287,12 +440,59 @@ class PriorityScheduler(threading.Thread, Scheduler):
         airRequest.startWaiting()
 
         # 放入相应队列
-        if airRequest.targetSpeed == "1":
-            self.lowSpeedQueue.append(airRequest)
-        elif airRequest.targetSpeed == "2":
-            self.midSpeedQueue.append(airRequest)
-        elif airRequest.targetSpeed == "3":
-            self.highSpeedQueue.append(airRequest)
+        self.waitQueue.put(airRequest)
+
+    def setStateManager(self, stateManager):
+        """
+        设置空调状态表
+        :param stateManager: ACStateManager
+        :return:
+        """
+        self.stateManager = stateManager
+
+    def updateACState(self, roomNumber, action, *args):
+        """
+        调度结果同步到空调状态
+        有状态表时只改内存，由状态表负责写数据库；房间已经退房时忽略
+        :param roomNumber: 房间号
+        :param action: "startServing" / "stopServing" / "addWaitTime"
+        :param args: 其他参数
+        :return:
+        """
+        try:
+            if self.stateManager is not None:
+                getattr(self.stateManager, action)(roomNumber, *args)
+            else:
+                _AC = AC.objects.get(roomNumber=roomNumber)
+                getattr(_AC, action)(*args)
+                _AC.save()
+        except AC.DoesNotExist:
+            pass
+
+    def serveRequest(self, airRequest):
+        """
+        为一个送风请求分配服务对象，开始送风
+        :param airRequest: 送风请求
+        :return: 服务对象编号
+        """
+        num = self.cluster.serve(airRequest)
+        self.metrics.observeServe(airRequest, Clock.monotonic())
+        # 更新空调状态
+        self.updateACState(airRequest.roomNumber, "startServing", airRequest.targetSpeed)
+        return num
+
+    def preempt(self, num):
+        """
+        调出一个服务对象上的送风请求，放回等待队列
+        :param num: 服务对象编号
+        :return: airRequest 被调出的送风请求
+        """
+        airRequest = self.cluster.quitServing(num)
+        self.metrics.preemptCount += 1
+        self.putRequest(airRequest)
+        # 更新空调状态
+        self.updateACState(airRequest.roomNumber, "stopServing")
+        return airRequest
 
     def schedule(self):
         """
@@ -306,72 +506,115 @@ class PriorityScheduler(threading.Thread, Scheduler):
                 break
             elif canSchedule == 2:
                 # 有空位直接服务
-                airRequest = self.getRequest()
-                self.cluster.serve(airRequest)
+                self.serveRequest(self.getRequest())
             elif canSchedule == 1:
                 # 进行优先级调度
-                speedList, IGNORE = self.cluster.getServingStatus()
-
-                minServingSpeed = 4
-                minServingSpeedIndex = 0
-                for idx, item in enumerate(speedList):
-                    if item < minServingSpeed:
-                        minServingSpeed = item
-                        minServingSpeedIndex = idx
-
                 # 淘汰优先级最低的送风请求（风速最小），放回等待队列
-                ms_airRequest = self.cluster.quitServing(minServingSpeedIndex)
-                self.putRequest(ms_airRequest)
-                # 更新空调状态
-                _AC = AC.objects.get(roomNumber=ms_airRequest.roomNumber)
-                _AC.stopServing()
+                self.preempt(self.cluster.getVictim())
 
                 # 获得优先级最高的送风请求（风速最大），开始服务
-                airRequest = self.getRequest()
-                self.cluster.serve(airRequest)
-                # 更新空调状态
-                _AC = AC.objects.get(roomNumber=airRequest.roomNumber)
-                _AC.startServing()
+                self.serveRequest(self.getRequest())
 
-    def run(self):
+    def schedulePass(self, requests):
         """
-        运行
+        一轮调度：处理取出的请求，处理定时事件，（分片时）调整服务对象，然后调度
+        :param requests: 这一轮要处理的请求
         :return:
         """
-        while True:
-            # 如果 队列中没有请求的话，就挂起，避免一直占用锁资源（拿了放， 放了拿）
-            if len(self.requestQueue) == 0:
-                self.event.wait()
-                if self.event.isSet():
-                    self.event.clear()
-
-            # 处理请求
-            self.lock.acquire()
-            request = self.requestQueue.pop(0)
-            self.lock.release()
-
-            # 如果是关机，或者休眠，直接取消送风请求
-            if request.type == "off" or request.type == "hibernate":
-                waitTime = self.cancel(request.airRequest)
-                waitTime = waitTime.seconds/60
-                _AC = AC.objects.get(roomNumber=request.airRequest)
-                _AC.addWaitTime(waitTime)
-                _AC.save()
+        start = time.perf_counter()
+        for request in requests:
+            self.handleRequest(request)
+
+        self.tick()
+        if self.group is not None:
+            self.group.rebalance(self)
+        self.schedule()
+        self.metrics.observePass(time.perf_counter() - start, self.waitQueue)
+
+    def tick(self):
+        """
+        每次调度之前调用，子类可以在这里处理定时事件
+        :return:
+        """
+        pass
+
+    def handleRequest(self, request):
+        """
+        处理请求队列中的一个请求
+        :param request: Request
+        :return:
+        """
+        # 如果是关机，或者休眠，直接取消送风请求
+        if request.type == "powerOff" or request.type == "hibernate":
+            self.withdrawRequest(request.airRequest)
 
+        else:
+            # 判断该房间是否有请求在队列中
+            _request, serving = self.findRequest(request.airRequest.roomNumber)
+            # 该房间没有请求在队列中/服务中
+            if _request is None:
+                # 构造新请求，放入队列
+                airRequest = request.airRequest
+                self.putRequest(airRequest)
+            # 该房间有请求在队列中，正在等待，或者正在送风
             else:
-                # 判断该房间是否有请求在队列中
-                _request, serving = self.findRequest(request.airRequest.roomNumber)
-                # 该房间没有请求在队列中/服务中
-                if _request is None:
-                    # 构造新请求，放入队列
-                    airRequest = request.airRequest
-                    self.putRequest(airRequest)
-                # 该房间有请求在队列中，正在等待，或者正在送风
-                else:
-                    self.updateRequest(_request, request, serving)
-
-            # 调度
-            self.schedule()
+                self.updateRequest(_request, request.airRequest, serving)
+
+    def withdrawRequest(self, roomNumber):
+        """
+        撤回房间的送风请求（关机、休眠、退房）
+        取消等待中/服务中的请求，正在送风的房间停止送风，累加等待时长
+        调用方要保证和调度互斥，调度器外部请使用各调度器的 withdraw
+        :param roomNumber: 房间号
+        :return: 被取消的请求总共的等待时长（分钟），该房间没有请求时返回 None
+        """
+        serving = self.findRequest(roomNumber)[1]
+        waitTime = self.cancel(roomNumber)
+        # 正在送风的房间停止送风
+        if serving:
+            self.updateACState(roomNumber, "stopServing")
+        if waitTime is None:
+            return None
+        waitTime = waitTime.total_seconds() / 60
+        self.updateACState(roomNumber, "addWaitTime", waitTime)
+        return waitTime
+
+    def coalesce(self, requests):
+        """
+        按房间合并请求，同一个房间只保留最后一个请求（最新的设定/开关状态）
+        :param requests: 按到达顺序排列的请求
+        :return: 合并之后的请求，按每个房间最后一个请求的到达顺序排列
+        """
+        latest = OrderedDict()
+        for request in requests:
+            roomNumber = request.getRoomNumber()
+            if roomNumber in latest:
+                del latest[roomNumber]
+                self.coalescedCount += 1
+            latest[roomNumber] = request
+        return list(latest.values())
+
+    def getMetrics(self):
+        """
+        调度延迟、队列长度、调度次数等运行指标
+        :return: SchedulerMetrics
+        """
+        return self.metrics
+
+    def getIngestStats(self):
+        """
+        请求队列的消费情况
+        :return: dict
+        """
+        return {
+            "batch": self.batch,
+            "batchCount": self.batchCount,
+            "requestCount": self.requestCount,
+            "coalescedCount": self.coalescedCount,
+            "lastBatchSize": self.lastBatchSize,
+            "maxBatchSize": self.maxBatchSize,
+            "averageBatchSize": self.requestCount / self.batchCount if self.batchCount > 0 else 0,
+        }
 
     def updateRequest(self, oldRequest, newRequest, serving):
         """
@@ -384,26 +627,19 @@ class PriorityScheduler(threading.Thread, Scheduler):
         :param serving:     旧的请求是否正在被服务
         :return:
         """
+        # 新请求继承旧请求的等待状态
+        newRequest.lastWaitStartTime = oldRequest.lastWaitStartTime
+        newRequest.waitingTime = oldRequest.waitingTime
+
         if serving:
             self.cluster.updateRequest(newRequest)
+            # 送风中调风，直接按新的风速送风
+            if oldRequest.targetSpeed != newRequest.targetSpeed:
+                self.updateACState(newRequest.roomNumber, "startServing", newRequest.targetSpeed)
         else:
             # 只是调温，没有改变风速
             if oldRequest.targetSpeed == newRequest.targetSpeed:
-                if oldRequest.targetSpeed == 1:
-                    # 低风
-                    for idx, item in enumerate(self.lowSpeedQueue):
-                        if item.roomNumber == oldRequest.roomNumber:
-                            self.lowSpeedQueue[idx] = newRequest
-                elif oldRequest.targetSpeed == 2:
-                    # 中风
-                    for idx, item in enumerate(self.midSpeedQueue):
-                        if item.roomNumber == oldRequest.roomNumber:
-                            self.midSpeedQueue[idx] = newRequest
-                elif oldRequest.targetSpeed == 3:
-                    # 高风
-                    for idx, item in enumerate(self.highSpeedQueue):
-                        if item.roomNumber == oldRequest.roomNumber:
-                            self.highSpeedQueue[idx] = newRequest
+                self.waitQueue.replace(newRequest)
             # 改变了风速
             else:
                 waitTime = self.cancel(oldRequest.roomNumber)
@@ -417,51 +653,183 @@ class PriorityScheduler(threading.Thread, Scheduler):
         :return: request    查找到的请求
                  serving    是否正在服务
         """
-        request = None
-        serving = False
-        for item in self.lowSpeedQueue:
-            if item.roomNumber == roomNumber:
-                request = item
-        for item in self.midSpeedQueue:
-            if item.roomNumber == roomNumber:
-                request = item
-        for item in self.highSpeedQueue:
-            if item.roomNumber == roomNumber:
-                request = item
-        for item in self.cluster.getRoomNumbers:
-            if item.roomNumber == roomNumber:
-                request = item
-                serving = True
-        return request, serving
+        request = self.waitQueue.find(roomNumber)
+        if request is not None:
+            return request, False
+
+        request = self.cluster.findRequest(roomNumber)
+        return request, request is not None
 
     def cancel(self, roomNumber):
         """
         取消请求
         :param roomNumber: 取消请求的房间号
-        :return: 被取消的请求总共的等待时长
-        """
-        request = None
-        for idx, item in enumerate(self.lowSpeedQueue):
-            if item.roomNumber == roomNumber:
-                request = self.lowSpeedQueue[idx]
-                self.lowSpeedQueue[idx] = None
-        for idx, item in enumerate(self.midSpeedQueue):
-            if item.roomNumber == roomNumber:
-                request = self.midSpeedQueue[idx]
-                self.midSpeedQueue[idx] = None
-        for idx, item in enumerate(self.highSpeedQueue):
-            if item.roomNumber == roomNumber:
-                request = self.highSpeedQueue[idx]
-                self.highSpeedQueue[idx] = None
-
-        _request = self.cluster.finishServing(roomNumber)
-        if _request is not None:
-            request = _request
+        :return: 被取消的请求总共的等待时长，该房间没有请求时返回 None
+        """
+        request = self.waitQueue.remove(roomNumber)
+        if request is None:
+            request = self.cluster.finishServing(roomNumber)
+        if request is None:
+            return None
+        self.metrics.cancelCount += 1
 
         request.stopWaiting()
         return request.getWaitTime()
 
 
-class RoundScheduler(Scheduler):
-    pass
+class PriorityScheduler(threading.Thread, PriorityPolicy):
+    """
+    优先级调度器
+    有新请求的时候产生跟据优先级进行调度，在单独的线程中运行
+    :param instanceNum Scheduler父类-服务对象数量
+    :param cluster Scheduler父类-服务对象集群
+    :param requestQueue 请求队列——客户端和调度器共用的 RequestChannel
+    :param batch PriorityPolicy父类-批量模式
+    :parameter passLock 处理请求+调度的一轮中持有的锁（分片调度时其他分片借用服务对象要先拿到这把锁）
+    """
+    # 请求队列为空时挂起的最长时间，None 表示一直等到有新请求
+    waitTimeout = None
+
+    def __init__(self, instanceNum, cluster, requestQueue, batch=False):
+        PriorityPolicy.__init__(self, instanceNum, cluster, batch)
+        threading.Thread.__init__(self, daemon=True)
+
+        # request queue resource
+        self.requestQueue = requestQueue
+
+        self.passLock = threading.Lock()
 
+    def run(self):
+        """
+        运行
+        :return:
+        """
+        while True:
+            # 队列中没有请求的时候挂起
+            # waitTimeout 不为 None 时定期醒来处理定时事件
+            if self.batch:
+                requests = self.coalesce(self.drainRequests())
+            else:
+                request = self.requestQueue.get(self.waitTimeout)
+                requests = [] if request is None else [request]
+                self.requestCount += len(requests)
+
+            # 调度，一轮出错不能让调度线程退出
+            with self.passLock:
+                try:
+                    self.schedulePass(requests)
+                except Exception:
+                    logger.exception("schedule pass failed")
+
+    def withdraw(self, roomNumber):
+        """
+        从其他线程（退房、关机）撤回房间的送风请求，拿到 passLock 之后和调度互斥地执行，
+        空出来的服务对象马上分给等待中的请求
+        :param roomNumber: 房间号
+        :return: 被取消的请求总共的等待时长（分钟），该房间没有请求时返回 None
+        """
+        with self.passLock:
+            waitTime = self.withdrawRequest(roomNumber)
+            self.schedule()
+            return waitTime
+
+    def drainRequests(self):
+        """
+        一次取出请求队列中的全部请求，队列为空时最多挂起 waitTimeout 秒
+        :return: requests 按到达顺序排列的请求
+        """
+        requests = self.requestQueue.getBatch(None, self.waitTimeout)
+        self.countBatch(requests)
+        return requests
+
+
+class TimeSlicePolicy(PriorityPolicy):
+    """
+    时间片轮转策略
+    在优先级调度的基础上，同一风速的请求轮流使用服务对象：
+    一个请求服务满一个时间片之后，如果有同风速的请求在等待，就把它调回等待队列的队尾，
+    换同风速等待最久的请求上来
+    时间片的计时由子类实现（armSlice/disarmSlice，缺省不计时），到期后调用 rotate
+    :parameter timeSlice 时间片长度（秒）
+    """
+    timeSlice = None
+
+    def armSlice(self, roomNumber):
+        """
+        为某个房间开始计时一个时间片
+        :param roomNumber: 房间号
+        :return:
+        """
+        pass
+
+    def disarmSlice(self, roomNumber):
+        """
+        取消某个房间的时间片计时
+        :param roomNumber: 房间号
+        :return:
+        """
+        pass
+
+    def serveRequest(self, airRequest):
+        num = PriorityPolicy.serveRequest(self, airRequest)
+        self.armSlice(airRequest.roomNumber)
+        return num
+
+    def preempt(self, num):
+        airRequest = PriorityPolicy.preempt(self, num)
+        self.disarmSlice(airRequest.roomNumber)
+        return airRequest
+
+    def cancel(self, roomNumber):
+        self.disarmSlice(int(roomNumber))
+        return PriorityPolicy.cancel(self, roomNumber)
+
+    def rotate(self, roomNumber):
+        """
+        某个房间的时间片用完
+        有同风速的请求在等待则让出服务对象，否则继续服务一个时间片
+        :param roomNumber: 房间号
+        :return:
+        """
+        num = self.cluster.findInstance(roomNumber)
+        if num is None:
+            return
+
+        speed = self.cluster.instances[num].airRequest.targetSpeed
+        if self.waitQueue.size(speed) == 0:
+            self.armSlice(roomNumber)
+            return
+
+        # 先取出同风速等待最久的请求，再把用完时间片的请求放回队尾
+        airRequest = self.waitQueue.get(speed)
+        self.preempt(num)
+        self.serveRequest(airRequest)
+
+
+class RoundScheduler(TimeSlicePolicy, PriorityScheduler):
+    """
+    时间片调度器
+    时间片轮转策略的线程版，时间片到期由哈希时间轮驱动，不需要轮询每个请求的等待时长
+    :param timeSlice 时间片长度（秒）
+    :param tickInterval 时间轮一个 tick 的时长（秒）
+    :parameter wheel 时间轮 roomNumber -> 该房间时间片到期的时间
+    """
+    def __init__(self, instanceNum, cluster, requestQueue, timeSlice, tickInterval=1, batch=False):
+        PriorityScheduler.__init__(self, instanceNum, cluster, requestQueue, batch)
+        self.timeSlice = timeSlice
+        self.wheel = TimerWheel(tickInterval)
+        self.waitTimeout = tickInterval
+
+    def armSlice(self, roomNumber):
+        self.wheel.schedule(roomNumber, self.timeSlice)
+
+    def disarmSlice(self, roomNumber):
+        self.wheel.cancel(roomNumber)
+
+    def tick(self):
+        """
+        推进时间轮，轮转时间片到期的请求
+        :return:
+        """
+        for roomNumber in self.wheel.advance():
+            self.rotate(roomNumber)
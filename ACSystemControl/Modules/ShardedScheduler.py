@@ -0,0 +1,254 @@
+import time
+
+from .Metrics import SchedulerMetrics
+from .RequestChannel import RequestChannel
+from .Scheduler import PriorityScheduler, RoundScheduler, ServingCluster
+
+
+class ShardRouter:
+    """
+    房间分片规则
+    :param shardNum 分片数量
+    :param mode "floor" 按楼层分片（roomNumber // roomsPerFloor 为楼层号）
+                "range" 按房间号区间分片（1..roomNum 等分成 shardNum 段）
+    :param roomsPerFloor 每层的房间号跨度，按楼层分片时使用
+    :param roomNum 房间数量，按区间分片时使用
+    """
+
+    def __init__(self, shardNum, mode="floor", roomsPerFloor=100, roomNum=None):
+        self.shardNum = int(shardNum)
+        self.mode = mode
+        self.roomsPerFloor = int(roomsPerFloor)
+        self.roomNum = None if roomNum is None else int(roomNum)
+
+    def route(self, roomNumber):
+        """
+        房间所属的分片
+        :param roomNumber: 房间号
+        :return: 分片编号 0..shardNum-1
+        """
+        roomNumber = int(roomNumber)
+        if self.mode == "range" and self.roomNum:
+            shard = (roomNumber - 1) * self.shardNum // self.roomNum
+            return min(max(shard, 0), self.shardNum - 1)
+        return (roomNumber // self.roomsPerFloor) % self.shardNum
+
+
+class ShardedScheduler:
+    """
+    分片调度组
+    房间按 ShardRouter 分成若干分片，每个分片有自己的服务对象集群、请求队列和调度器线程，
+    不同分片的请求互不争用同一把锁、同一个队列
+    开启借用时，有请求在等待而没有空闲服务对象的分片可以向没有请求等待的分片借空闲的服务对象；
+    借来的服务对象空闲下来、或者借出方也有请求在等待时归还
+    对 ACServer 来说它同时也是请求队列，提供和 RequestChannel 一样的 put/putMany/getStats 接口
+    :param instanceNum 服务对象总数，平均分给各个分片
+    :param router 分片规则
+    :param capacity 每个分片的请求队列容量
+    :param batch 批量模式
+    :param borrow 是否允许跨分片借用空闲服务对象
+    :param timeSlice 时间片长度（秒），None 表示使用优先级调度，否则使用时间片调度
+    :param tickInterval 时间片调度的时间轮精度（秒）
+    :parameter borrowed 分片 -> [(借出方分片, 借来的服务对象编号)]
+    """
+    # 开启借用时调度器线程至少每隔这么久醒来一次，检查是否需要归还借来的服务对象
+    REBALANCE_INTERVAL = 1
+
+    def __init__(self, instanceNum, router, capacity=4096, batch=False, borrow=True, timeSlice=None, tickInterval=1):
+        self.router = router
+        self.shardNum = router.shardNum
+        self.borrow = borrow
+
+        self.clusters = []
+        self.channels = []
+        self.schedulers = []
+        self.borrowed = []
+        instanceNum = int(instanceNum)
+        for i in range(self.shardNum):
+            # 余数分给前面的分片
+            num = instanceNum // self.shardNum + (1 if i < instanceNum % self.shardNum else 0)
+            cluster = ServingCluster(num)
+            channel = RequestChannel(capacity)
+            if timeSlice is None:
+                scheduler = PriorityScheduler(num, cluster, channel, batch)
+            else:
+                scheduler = RoundScheduler(num, cluster, channel, timeSlice, tickInterval, batch)
+            scheduler.shardIndex = i
+            if borrow:
+                scheduler.group = self
+                if scheduler.waitTimeout is None:
+                    scheduler.waitTimeout = self.REBALANCE_INTERVAL
+
+            self.clusters.append(cluster)
+            self.channels.append(channel)
+            self.schedulers.append(scheduler)
+            self.borrowed.append([])
+
+    def __len__(self):
+        return sum(len(channel) for channel in self.channels)
+
+    def start(self):
+        for scheduler in self.schedulers:
+            scheduler.start()
+
+    def setStateManager(self, stateManager):
+        """
+        各分片调度器共用一个空调状态表
+        :param stateManager: ACStateManager
+        :return:
+        """
+        for scheduler in self.schedulers:
+            scheduler.stateManager = stateManager
+
+    def getScheduler(self, roomNumber):
+        """
+        负责某个房间的调度器
+        :param roomNumber: 房间号
+        :return:
+        """
+        return self.schedulers[self.router.route(roomNumber)]
+
+    def put(self, item, timeout=None):
+        """
+        请求放入所属分片的请求队列
+        :param item: 请求
+        :param timeout: 队列满时最多等待的秒数
+        :return: 是否入队成功
+        """
+        return self.channels[self.router.route(item.getRoomNumber())].put(item, timeout)
+
+    def putMany(self, items, timeout=None):
+        """
+        多个请求按分片分组入队，要么全部入队，要么全部不入队
+        按分片编号的顺序拿到涉及的各分片请求队列的锁，所有分片都放得下时才一起入队；
+        有分片放不下时先放开全部的锁，等这个分片有空位之后再试，总共最多等待 timeout 秒
+        :param items: 请求列表
+        :param timeout: 队列满时最多等待的秒数
+        :return: 是否入队成功
+        """
+        groups = {}
+        for item in items:
+            groups.setdefault(self.router.route(item.getRoomNumber()), []).append(item)
+        if len(groups) == 0:
+            return True
+        if len(groups) == 1:
+            shard, group = groups.popitem()
+            return self.channels[shard].putMany(group, timeout)
+
+        shards = sorted(groups)
+        channels = [self.channels[shard] for shard in shards]
+        counts = [len(groups[shard]) for shard in shards]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            full = None
+            for channel in channels:
+                channel.lock.acquire()
+            try:
+                for idx, channel in enumerate(channels):
+                    if not channel.hasRoom(counts[idx]):
+                        full = idx
+                        break
+                if full is None:
+                    for channel, shard in zip(channels, shards):
+                        channel.enqueue(groups[shard])
+                    return True
+            finally:
+                for channel in channels:
+                    channel.lock.release()
+
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if counts[full] > channels[full].capacity or remaining == 0 \
+                    or not channels[full].waitRoom(counts[full], remaining):
+                for channel, count in zip(channels, counts):
+                    channel.reject(count)
+                return False
+
+    def withdraw(self, roomNumber):
+        """
+        撤回某个房间的送风请求，由房间所在分片的调度器执行
+        :param roomNumber: 房间号
+        :return: 被取消的请求总共的等待时长（分钟）
+        """
+        return self.getScheduler(roomNumber).withdraw(roomNumber)
+
+    def rebalance(self, scheduler):
+        """
+        分片调度器每轮调度之前调用（调用方已经持有自己的 passLock）
+        先归还不再需要的服务对象，再为等待中的请求借空闲的服务对象
+        为了避免死锁，拿其他分片的锁时都不阻塞，拿不到就等下一轮
+        :param scheduler: 分片调度器
+        :return:
+        """
+        shard = scheduler.shardIndex
+        cluster = scheduler.cluster
+
+        # 归还：自己没有请求在等待时归还空闲的；借出方有请求在等待时调出正在服务的请求再归还
+        for lender, num in list(self.borrowed[shard]):
+            lenderScheduler = self.schedulers[lender]
+            lenderWaiting = len(lenderScheduler.waitQueue) > 0
+            if not lenderWaiting and len(scheduler.waitQueue) > 0:
+                continue
+            if not lenderScheduler.passLock.acquire(blocking=False):
+                continue
+            try:
+                if cluster.instances[num].airRequest is not None:
+                    if not lenderWaiting:
+                        continue
+                    scheduler.preempt(num)
+                cluster.removeInstance(num)
+                self.clusters[lender].reclaimInstance()
+                self.borrowed[shard].remove((lender, num))
+            finally:
+                lenderScheduler.passLock.release()
+
+        # 借用：有请求在等待，又没有空闲的服务对象
+        need = len(scheduler.waitQueue)
+        if need == 0 or cluster.canServe():
+            return
+        for lender, lenderScheduler in enumerate(self.schedulers):
+            if need == 0:
+                break
+            if lender == shard or len(lenderScheduler.waitQueue) > 0:
+                continue
+            if not lenderScheduler.passLock.acquire(blocking=False):
+                continue
+            try:
+                while need > 0 and self.clusters[lender].lendInstance():
+                    self.borrowed[shard].append((lender, cluster.addInstance()))
+                    need -= 1
+            finally:
+                lenderScheduler.passLock.release()
+
+    def getIngestStats(self):
+        """
+        各分片调度器消费请求队列的统计
+        :return: dict 汇总值 + 每个分片的统计
+        """
+        shards = [scheduler.getIngestStats() for scheduler in self.schedulers]
+        stats = {"shardNum": self.shardNum, "shards": shards}
+        for key in ("batchCount", "requestCount", "coalescedCount"):
+            stats[key] = sum(item[key] for item in shards)
+        stats["maxBatchSize"] = max(item["maxBatchSize"] for item in shards)
+        return stats
+
+    def getMetrics(self):
+        """
+        各分片调度器的运行指标汇总
+        :return: SchedulerMetrics
+        """
+        metrics = SchedulerMetrics()
+        for scheduler in self.schedulers:
+            metrics.merge(scheduler.metrics)
+        return metrics
+
+    def getStats(self):
+        """
+        各分片请求队列的统计
+        :return: dict 汇总值 + 每个分片的统计
+        """
+        shards = [channel.getStats() for channel in self.channels]
+        stats = {"shardNum": self.shardNum, "shards": shards}
+        for key in ("capacity", "depth", "putCount", "rejectedCount", "getCount"):
+            stats[key] = sum(item[key] for item in shards)
+        stats["instances"] = [cluster.instanceNum for cluster in self.clusters]
+        return stats
@@ -0,0 +1,236 @@
+import csv
+import heapq
+
+from . import Clock
+from .Scheduler import ACAirRequest, PriorityScheduler, Request, RoundScheduler, ServingCluster
+from .ThermalModel import ThermalModel
+
+
+class TraceEvent:
+    """
+    房间请求轨迹中的一个事件
+    :param time 事件发生的时间（距离开始的秒数）
+    :param roomNumber 房间号
+    :param type "on" 开机/调温调风    "powerOff" 关机    "hibernate" 休眠
+    :param targetTemperature 目标温度（"on" 事件）
+    :param targetSpeed 目标风速（"on" 事件）
+    """
+
+    def __init__(self, time, roomNumber, type, targetTemperature=None, targetSpeed=None):
+        self.time = float(time)
+        self.roomNumber = int(roomNumber)
+        self.type = type
+        self.targetTemperature = targetTemperature
+        self.targetSpeed = targetSpeed
+
+    def toRequest(self):
+        request = Request()
+        request.setType(self.type)
+        if self.type == "on":
+            request.setAirRequest(ACAirRequest(self.roomNumber, self.targetTemperature, self.targetSpeed))
+        else:
+            request.setAirRequest(self.roomNumber)
+        return request
+
+
+def loadTrace(path):
+    """
+    从 csv 文件读取请求轨迹
+    每行: time,roomNumber,type[,targetTemperature,targetSpeed]
+    :param path: 文件路径
+    :return: [TraceEvent]
+    """
+    trace = []
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) == 0 or row[0].startswith('#') or row[0] == 'time':
+                continue
+            trace.append(TraceEvent(*row))
+    return trace
+
+
+def traceFromRecords(records):
+    """
+    把数据库中记录的用户操作转换成请求轨迹，用于回放
+    开关机/休眠记录 -> 对应的事件，调温调风记录 -> "on" 事件
+    调度产生的记录（送风风速变化）不是用户操作，忽略
+    :param records: 按时间排序的 Record
+    :return: [TraceEvent]
+    """
+    trace = []
+    start = None
+    for record in records:
+        if start is None:
+            start = record.date
+        time = (record.date - start).total_seconds()
+        roomNumber = record.roomNumber
+        if record.old_status != record.new_status:
+            if record.new_status == "on":
+                trace.append(TraceEvent(time, roomNumber, "on", record.new_targetTemperature, record.new_targetSpeed))
+            else:
+                trace.append(TraceEvent(time, roomNumber, record.new_status))
+        elif record.last_targetTemperature != record.new_targetTemperature or \
+                record.last_targetSpeed != record.new_targetSpeed:
+            trace.append(TraceEvent(time, roomNumber, "on", record.new_targetTemperature, record.new_targetSpeed))
+    return trace
+
+
+class SimulatedStateManager:
+    """
+    模拟用的空调状态表，不读写数据库，只统计调度结果
+    :parameter serving roomNumber -> 正在送风的风速
+    :parameter serveCount 开始送风的次数
+    :parameter preemptCount 被调度出服务对象的次数
+    """
+
+    def __init__(self):
+        self.serving = {}
+        self.serveCount = 0
+        self.preemptCount = 0
+        self.waitTime = {}
+
+    def startServing(self, roomNumber, speed=None):
+        # 送风中调风不算一次新的送风
+        if int(roomNumber) not in self.serving:
+            self.serveCount += 1
+        self.serving[int(roomNumber)] = True
+
+    def stopServing(self, roomNumber):
+        # 关机/休眠的房间在交给调度器之前已经移除，这里只统计被调出
+        if self.serving.pop(int(roomNumber), None) is not None:
+            self.preemptCount += 1
+
+    def addWaitTime(self, roomNumber, waitTime):
+        roomNumber = int(roomNumber)
+        self.waitTime[roomNumber] = self.waitTime.get(roomNumber, 0) + waitTime
+
+
+class Simulator:
+    """
+    调度器的离散事件模拟器
+    使用虚拟时钟，按事件时间推进，把请求轨迹直接交给调度策略处理（不启动调度器线程、不读写数据库），
+    同样的轨迹每次得到同样的结果，而且不受真实时间限制
+    :param instanceNum 服务对象数量
+    :param scheduler "priority" 优先级调度    "round" 时间片调度
+    :param timeSlice 时间片长度（秒）
+    :param tickInterval 时间片调度的时间轮精度（秒）
+    :param batch 同一时刻的请求是否按房间合并后一次调度
+    :param thermal 是否用 ThermalModel 模拟房间温度（需要 numpy），结果中增加平均温度和到达目标温度的房间数
+    """
+
+    def __init__(self, instanceNum, scheduler="priority", timeSlice=120, tickInterval=1, batch=True, thermal=False):
+        self.instanceNum = instanceNum
+        self.schedulerType = scheduler
+        self.timeSlice = timeSlice
+        self.tickInterval = tickInterval
+        self.batch = batch
+        self.thermal = thermal
+
+    def run(self, trace, until=None):
+        """
+        运行一条请求轨迹
+        :param trace: [TraceEvent]
+        :param until: 模拟到第几秒，缺省为最后一个事件
+        :return: dict 等待时长、吞吐量、调度统计
+        """
+        clock = Clock.VirtualClock()
+        oldClock = Clock.setClock(clock)
+        try:
+            return self._run(clock, trace, until)
+        finally:
+            Clock.setClock(oldClock)
+
+    def _run(self, clock, trace, until):
+        cluster = ServingCluster(self.instanceNum)
+        if self.schedulerType == "round":
+            scheduler = RoundScheduler(self.instanceNum, cluster, None, self.timeSlice, self.tickInterval, self.batch)
+        else:
+            scheduler = PriorityScheduler(self.instanceNum, cluster, None, self.batch)
+        stateManager = SimulatedStateManager()
+        scheduler.setStateManager(stateManager)
+        thermal = ThermalModel() if self.thermal else None
+
+        # 事件堆：(时间, 序号, 事件)，序号保证同一时刻的事件按轨迹顺序处理
+        events = []
+        for seq, event in enumerate(trace):
+            heapq.heappush(events, (event.time, seq, event))
+        if until is None:
+            until = events[0][0] if len(events) == 0 else max(item[0] for item in events)
+
+        # 房间开始等待的时间，用来统计每次从提出请求（或被调出）到开始送风的等待时长
+        waitingSince = {}
+        waits = []
+        busyTime = 0.0
+        cancelCount = 0
+
+        def sync():
+            # 调度之后刷新等待状态
+            for roomNumber in list(waitingSince):
+                if roomNumber in stateManager.serving:
+                    waits.append(clock.monotonic() - waitingSince.pop(roomNumber))
+            for roomNumber in scheduler.waitQueue.roomNumbers():
+                if roomNumber not in waitingSince:
+                    waitingSince[roomNumber] = clock.monotonic()
+
+        while clock.monotonic() < until or (len(events) > 0 and events[0][0] <= until):
+            # 下一个时间点：下一个事件或者下一个 tick（时间片调度）
+            nextTime = until
+            if len(events) > 0:
+                nextTime = min(nextTime, events[0][0])
+            if self.schedulerType == "round":
+                nextTime = min(nextTime, scheduler.wheel.lastTickTime + self.tickInterval)
+            busyTime += (nextTime - clock.monotonic()) * cluster.runningInstance
+            if thermal is not None:
+                thermal.step(nextTime - clock.monotonic())
+            clock.set(nextTime)
+
+            requests = []
+            while len(events) > 0 and events[0][0] <= clock.monotonic():
+                requests.append(heapq.heappop(events)[2].toRequest())
+            if self.batch:
+                scheduler.countBatch(requests)
+                requests = scheduler.coalesce(requests)
+            for request in requests:
+                if request.type != "on":
+                    roomNumber = request.getRoomNumber()
+                    if scheduler.findRequest(roomNumber)[0] is not None:
+                        cancelCount += 1
+                    waitingSince.pop(roomNumber, None)
+                    stateManager.serving.pop(roomNumber, None)
+                scheduler.handleRequest(request)
+            scheduler.tick()
+            scheduler.schedule()
+            sync()
+            if thermal is not None:
+                for request in requests:
+                    if request.type == "on":
+                        thermal.setTarget(request.airRequest.roomNumber, request.airRequest.targetTemperature)
+                thermal.syncCluster(cluster)
+
+            if len(events) == 0 and clock.monotonic() >= until:
+                break
+
+        # 模拟结束时还在等待的请求也计入等待时长
+        pending = [clock.monotonic() - since for since in waitingSince.values()]
+        allWaits = sorted(waits + pending)
+        duration = clock.monotonic()
+        result = {
+            "duration": duration,
+            "events": len(trace),
+            "serveCount": stateManager.serveCount,
+            "preemptCount": stateManager.preemptCount,
+            "cancelCount": cancelCount,
+            "coalescedCount": scheduler.coalescedCount,
+            "throughput": stateManager.serveCount / (duration / 60) if duration > 0 else 0,
+            "utilisation": busyTime / (duration * self.instanceNum) if duration > 0 else 0,
+            "waitCount": len(allWaits),
+            "stillWaiting": len(pending),
+            "meanWait": sum(allWaits) / len(allWaits) if len(allWaits) > 0 else 0,
+            "p95Wait": allWaits[int(0.95 * (len(allWaits) - 1))] if len(allWaits) > 0 else 0,
+            "maxWait": allWaits[-1] if len(allWaits) > 0 else 0,
+        }
+        if thermal is not None:
+            stats = thermal.getStats()
+            result["meanTemperature"] = stats["meanTemperature"]
+            result["reachedTarget"] = stats["reachedTarget"]
+        return result
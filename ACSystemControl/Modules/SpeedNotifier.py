@@ -0,0 +1,94 @@
+import threading
+
+
+class SpeedNotifier:
+    """
+    送风风速变化的通知
+    调度器改变房间的送风风速（startServing/stopServing）时发布，客户端的长轮询/SSE 连接在这里等待
+    每个房间有一个单调递增的版本号，客户端带上自己见过的版本号等待，错过的变化不会丢失
+    :parameter speeds roomNumber -> (版本号, 当前风速)
+    :parameter conditions roomNumber -> 等待该房间变化的条件变量（只唤醒这个房间的连接）
+    :parameter waiting 正在等待的连接数
+    :parameter publishCount 发布的次数
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.speeds = {}
+        self.conditions = {}
+        self.waiting = 0
+        self.publishCount = 0
+
+    def publish(self, roomNumber, oldSpeed, newSpeed):
+        """
+        房间的送风风速发生变化，唤醒等待该房间的连接
+        可以直接注册为 ACStateManager 的监听者
+        :param roomNumber: 房间号
+        :param oldSpeed: 原来的风速
+        :param newSpeed: 新的风速
+        :return:
+        """
+        roomNumber = int(roomNumber)
+        with self.lock:
+            version = self.speeds.get(roomNumber, (0, oldSpeed))[0] + 1
+            self.speeds[roomNumber] = (version, newSpeed)
+            self.publishCount += 1
+            condition = self.conditions.get(roomNumber)
+            if condition is not None:
+                condition.notify_all()
+
+    def current(self, roomNumber, speed=0):
+        """
+        房间当前的版本号和风速
+        :param roomNumber: 房间号
+        :param speed: 还没有发布过变化时返回的风速
+        :return: (版本号, 风速)
+        """
+        with self.lock:
+            return self.speeds.get(int(roomNumber), (0, speed))
+
+    def wait(self, roomNumber, version, timeout, speed=0):
+        """
+        等待房间的风速在给定的版本之后发生变化
+        :param roomNumber: 房间号
+        :param version: 客户端已经见过的版本号
+        :param timeout: 最长等待的秒数
+        :param speed: 还没有发布过变化时返回的风速
+        :return: (版本号, 风速)，超时返回当前版本；房间已经被移除时返回 None
+        """
+        roomNumber = int(roomNumber)
+        with self.lock:
+            condition = self.conditions.get(roomNumber)
+            if condition is None:
+                condition = threading.Condition(self.lock)
+                self.conditions[roomNumber] = condition
+            self.waiting += 1
+            try:
+                condition.wait_for(lambda: self.speeds.get(roomNumber, (0,))[0] > version or
+                                   self.conditions.get(roomNumber) is not condition, timeout)
+            finally:
+                self.waiting -= 1
+            if self.conditions.get(roomNumber) is not condition:
+                return None
+            return self.speeds.get(roomNumber, (0, speed))
+
+    def remove(self, roomNumber):
+        """
+        房间退房，结束所有等待该房间的连接
+        :param roomNumber: 房间号
+        :return:
+        """
+        roomNumber = int(roomNumber)
+        with self.lock:
+            self.speeds.pop(roomNumber, None)
+            condition = self.conditions.pop(roomNumber, None)
+            if condition is not None:
+                condition.notify_all()
+
+    def getStats(self):
+        with self.lock:
+            return {
+                "rooms": len(self.speeds),
+                "waiting": self.waiting,
+                "publishCount": self.publishCount,
+            }
@@ -1,3 +1,262 @@
+import logging
+import threading
+from datetime import datetime, time, timedelta
+
+from . import Clock
+from .ACBillingManager import ACBillingManager
+
+logger = logging.getLogger(__name__)
+
+
+class RoomStat:
+    """
+    一个房间在一个统计周期内的汇总
+    :parameter onCount/offCount 开机/关机次数
+    :parameter usageTime 使用空调（送风）的时长（分钟）
+    :parameter cost 费用（元）
+    :parameter scheduleCount 被调度（从等待变为送风）的次数
+    :parameter detailCount 详单数（送风段数，送风中改变风速开始新的一段）
+    :parameter temperatureCount/speedCount 调温/调风次数
+    """
+    FIELDS = ("onCount", "offCount", "usageTime", "cost", "scheduleCount", "detailCount",
+              "temperatureCount", "speedCount")
+    __slots__ = FIELDS
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def copy(self):
+        stat = RoomStat()
+        stat.add(self)
+        return stat
+
+    def add(self, other):
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def toDict(self):
+        result = {field: getattr(self, field) for field in self.FIELDS}
+        result["usageTime"] = round(self.usageTime, 2)
+        result["cost"] = round(self.cost, 2)
+        return result
+
+
 class StatManager:
+    """
+    统计报表
+    记录产生时（ACStateManager 的记录监听者）增量更新汇总，按 房间 × 天 分桶，
+    同一个增量同时加到所在的周、月、年的桶中，生成任何周期的报表都只读取这个周期的桶，不扫描 Record
+    送风时长和费用在一段送风结束时按天切分后累加；报表中还没有结束的送风段计到当前时间
+    汇总只在内存中，服务器启动时用 startRebuild 在后台线程从数据库中的记录恢复
+    周从星期一开始
+    :parameter buckets (周期, 周期开始的日期) -> {roomNumber: RoomStat}
+    :parameter serving roomNumber -> (当前送风段开始时间, 风速)
+    :parameter recordCount 处理过的记录数
+    :parameter pending 正在恢复时新产生的记录，恢复完成之后按顺序处理；None 表示没有在恢复
+    """
+    PERIODS = ("day", "week", "month", "year")
+
     def __init__(self):
-        pass
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.serving = {}
+        self.recordCount = 0
+        self.pending = None
+        self.rebuilder = None
+
+    @staticmethod
+    def periodRange(period, day):
+        """
+        包含某一天的统计周期
+        :param period: "day" "week" "month" "year"
+        :param day: date
+        :return: (开始日期, 结束日期)，不包含结束日期
+        """
+        if period == "day":
+            start = day
+            return start, start + timedelta(days=1)
+        elif period == "week":
+            start = day - timedelta(days=day.weekday())
+            return start, start + timedelta(days=7)
+        elif period == "month":
+            start = day.replace(day=1)
+            if start.month == 12:
+                return start, start.replace(year=start.year + 1, month=1)
+            return start, start.replace(month=start.month + 1)
+        elif period == "year":
+            start = day.replace(month=1, day=1)
+            return start, start.replace(year=start.year + 1)
+        raise ValueError("unknown period %r" % period)
+
+    def roomBuckets(self, roomNumber, day):
+        """
+        房间在某一天所在的 日/周/月/年 的桶，没有时创建
+        :return: [RoomStat]
+        """
+        result = []
+        for period in self.PERIODS:
+            key = (period, self.periodRange(period, day)[0])
+            rooms = self.buckets.get(key)
+            if rooms is None:
+                rooms = self.buckets[key] = {}
+            stat = rooms.get(roomNumber)
+            if stat is None:
+                stat = rooms[roomNumber] = RoomStat()
+            result.append(stat)
+        return result
+
+    def startRebuild(self, records):
+        """
+        在后台线程中 rebuild，不阻塞调用方；恢复期间新产生的记录先缓存在 pending 中
+        :param records: 同 rebuild，在后台线程中读取
+        :return:
+        """
+        with self.lock:
+            self.pending = []
+        self.rebuilder = threading.Thread(target=self.rebuild, args=(records,), daemon=True)
+        self.rebuilder.start()
+
+    def rebuild(self, records):
+        """
+        丢弃现有的汇总，由记录重新生成
+        读取记录时不持有锁（addRecords 在 ACStateManager 的锁内调用，不能等待数据库），
+        在新的汇总上生成完之后再替换，然后处理恢复期间缓存的记录
+        :param records: Record，按时间排序，可以是 QuerySet.iterator()
+        :return:
+        """
+        rebuilt = StatManager()
+        try:
+            for record in records:
+                rebuilt.addRecord(record)
+        except Exception:
+            # 只恢复了一部分，仍然替换，之后的记录照常统计
+            logger.exception("stat rebuild failed after %d records", rebuilt.recordCount)
+        with self.lock:
+            self.buckets = rebuilt.buckets
+            self.serving = rebuilt.serving
+            self.recordCount = rebuilt.recordCount
+            pending, self.pending = self.pending, None
+            for record in pending or ():
+                self.addRecord(record)
+
+    def isReady(self):
+        """
+        :return: 没有在恢复汇总
+        """
+        with self.lock:
+            return self.pending is None
+
+    def addRecords(self, records):
+        """
+        ACStateManager 的记录监听者，新产生的记录按顺序调用
+        :param records: [Record]
+        :return:
+        """
+        with self.lock:
+            if self.pending is not None:
+                self.pending.extend(records)
+                return
+            for record in records:
+                self.addRecord(record)
+
+    def addRecord(self, record):
+        roomNumber = record.roomNumber
+        now = ACBillingManager.localTime(record.date)
+        stats = self.roomBuckets(roomNumber, now.date())
+        self.recordCount += 1
+
+        # 开关机
+        if record.old_status != record.new_status:
+            field = "onCount" if record.new_status == "on" else "offCount" if record.new_status == "powerOff" else None
+            if field is not None:
+                for stat in stats:
+                    setattr(stat, field, getattr(stat, field) + 1)
+        # 调温调风，入住之后第一次开机设置的目标温度和风速（原来是 0）不算
+        if record.last_targetTemperature != record.new_targetTemperature and record.last_targetTemperature != 0:
+            for stat in stats:
+                stat.temperatureCount += 1
+        if record.last_targetSpeed != record.new_targetSpeed and record.last_targetSpeed != 0:
+            for stat in stats:
+                stat.speedCount += 1
+        # 送风风速变化：结束上一段，开始新的一段
+        if record.old_speed != record.new_speed:
+            started = self.serving.pop(roomNumber, None)
+            if started is not None:
+                self.addUsage(roomNumber, started[0], now, started[1])
+            if record.new_speed > 0:
+                self.serving[roomNumber] = (now, record.new_speed)
+                for stat in stats:
+                    stat.detailCount += 1
+                    if record.old_speed == 0:
+                        stat.scheduleCount += 1
+
+    def addUsage(self, roomNumber, start, end, speed, buckets=None):
+        """
+        累加一段送风的时长和费用，跨天的部分按天切分
+        :param roomNumber: 房间号
+        :param start: 开始时间
+        :param end: 结束时间
+        :param speed: 风速
+        :param buckets: day -> [RoomStat]，缺省加到房间的桶中
+        :return:
+        """
+        rate = ACBillingManager.RATES[speed]
+        while start < end:
+            stop = min(end, datetime.combine(start.date() + timedelta(days=1), time()))
+            minutes = (stop - start).total_seconds() / 60
+            stats = self.roomBuckets(roomNumber, start.date()) if buckets is None else buckets(start.date())
+            for stat in stats:
+                stat.usageTime += minutes
+                stat.cost += minutes * rate
+            start = stop
+
+    def report(self, period="day", day=None):
+        """
+        全酒店的报表
+        :param period: "day" "week" "month" "year"，缺省日报
+        :param day: 报表周期包含的日期，缺省今天
+        :return: dict: period start end
+                       rooms  [每个房间的汇总（RoomStat.toDict() 加上 roomNumber）]，按房间号排序
+                       total  所有房间的合计
+        """
+        now = Clock.now()
+        if day is None:
+            day = now.date()
+        start, end = self.periodRange(period, day)
+        with self.lock:
+            rooms = {roomNumber: stat.copy() for roomNumber, stat in self.buckets.get((period, start), {}).items()}
+            # 还没有结束的送风段计到当前时间，只加到这份报表的副本中
+            periodStart = datetime.combine(start, time())
+            periodEnd = min(datetime.combine(end, time()), now)
+            for roomNumber, (since, speed) in self.serving.items():
+                if since >= periodEnd or periodEnd <= periodStart:
+                    continue
+                stat = rooms.get(roomNumber)
+                if stat is None:
+                    stat = rooms[roomNumber] = RoomStat()
+                self.addUsage(roomNumber, max(since, periodStart), periodEnd, speed, lambda day: (stat,))
+
+        total = RoomStat()
+        rows = []
+        for roomNumber in sorted(rooms):
+            total.add(rooms[roomNumber])
+            row = {"roomNumber": roomNumber}
+            row.update(rooms[roomNumber].toDict())
+            rows.append(row)
+        return {
+            "period": period,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "rooms": rows,
+            "total": total.toDict(),
+        }
+
+    def getStats(self):
+        with self.lock:
+            return {
+                "recordCount": self.recordCount,
+                "buckets": sum(len(rooms) for rooms in self.buckets.values()),
+                "serving": len(self.serving),
+                "rebuilding": self.pending is not None,
+            }
@@ -0,0 +1,178 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class ThermalModel:
+    """
+    房间温度模型
+    所有房间的温度、目标温度、环境温度和送风风速放在 NumPy 数组中，每个 tick 用一次向量运算推进全部房间，
+    用于楼宇规模的模拟和压测，不需要为每个房间运行一个客户端
+    正在送风的房间以风速对应的速率向目标温度变化，到达目标温度后保持；
+    没有送风的房间以 IDLE_RATE 向环境温度（房间初始温度）回温
+    需求说明中没有给出温度变化速率，这里使用常用的设定：中风 0.5°C/分钟，高风快 20%，低风慢 20%，
+    回温 0.5°C/分钟
+    :param capacity 预先分配的房间数量，不够时自动扩大
+    :parameter roomNumbers 数组下标 -> 房间号
+    :parameter index 房间号 -> 数组下标
+    :parameter temperature/target/ambient/speed 当前温度/目标温度/环境温度/送风风速
+    """
+    # 风速 -> 温度变化速率（°C/分钟），下标 0 表示不送风
+    RATES = (0.0, 0.4, 0.5, 0.6)
+    IDLE_RATE = 0.5
+    # 需求说明中房间一到房间五的初始温度，其他房间依次循环使用
+    INITIAL_TEMPERATURES = (31, 27, 30, 32, 33)
+    # 缺省目标温度
+    DEFAULT_TARGET = 25
+
+    def __init__(self, capacity=64):
+        if np is None:
+            raise ImportError("ThermalModel requires numpy")
+        self.rates = np.array(self.RATES)
+        self.size = 0
+        self.roomNumbers = np.zeros(capacity, dtype=np.int64)
+        self.temperature = np.zeros(capacity)
+        self.target = np.zeros(capacity)
+        self.ambient = np.zeros(capacity)
+        self.speed = np.zeros(capacity, dtype=np.int8)
+        self.index = {}
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, roomNumber):
+        return int(roomNumber) in self.index
+
+    def addRoom(self, roomNumber, initialTemperature=None, targetTemperature=None):
+        """
+        添加一个房间，已经存在时不做改动
+        :param roomNumber: 房间号
+        :param initialTemperature: 初始温度（也是环境温度），缺省按房间顺序取需求说明中的初始温度
+        :param targetTemperature: 目标温度，缺省 DEFAULT_TARGET
+        :return: 数组下标
+        """
+        roomNumber = int(roomNumber)
+        idx = self.index.get(roomNumber)
+        if idx is not None:
+            return idx
+        if initialTemperature is None:
+            initialTemperature = self.INITIAL_TEMPERATURES[self.size % len(self.INITIAL_TEMPERATURES)]
+        if targetTemperature is None:
+            targetTemperature = self.DEFAULT_TARGET
+
+        if self.size == len(self.temperature):
+            self._grow(2 * max(self.size, 1))
+        idx = self.size
+        self.size += 1
+        self.index[roomNumber] = idx
+        self.roomNumbers[idx] = roomNumber
+        self.temperature[idx] = initialTemperature
+        self.ambient[idx] = initialTemperature
+        self.target[idx] = targetTemperature
+        self.speed[idx] = 0
+        return idx
+
+    def removeRoom(self, roomNumber):
+        """
+        删除一个房间，用最后一个房间填补空位
+        :param roomNumber: 房间号
+        :return:
+        """
+        idx = self.index.pop(int(roomNumber), None)
+        if idx is None:
+            return
+        last = self.size - 1
+        if idx != last:
+            for array in (self.roomNumbers, self.temperature, self.target, self.ambient, self.speed):
+                array[idx] = array[last]
+            self.index[int(self.roomNumbers[idx])] = idx
+        self.size = last
+
+    def _grow(self, capacity):
+        for name in ("roomNumbers", "temperature", "target", "ambient", "speed"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def setTarget(self, roomNumber, targetTemperature):
+        # 先添加房间，数组可能被扩大
+        idx = self.addRoom(roomNumber)
+        self.target[idx] = targetTemperature
+
+    def setSpeed(self, roomNumber, speed):
+        idx = self.addRoom(roomNumber)
+        self.speed[idx] = speed
+
+    def syncCluster(self, cluster):
+        """
+        按服务对象集群的调度结果设置送风风速：正在服务的房间按请求的风速，其他房间不送风
+        :param cluster: ServingCluster
+        :return:
+        """
+        self.speed[:self.size] = 0
+        for roomNumber, num in cluster.roomIndex.items():
+            idx = self.index.get(roomNumber)
+            if idx is None:
+                idx = self.addRoom(roomNumber)
+            airRequest = cluster.instances[num].airRequest
+            self.target[idx] = airRequest.targetTemperature
+            self.speed[idx] = airRequest.targetSpeed
+
+    def step(self, seconds):
+        """
+        所有房间的温度前进一段时间
+        :param seconds: 经过的秒数
+        :return:
+        """
+        n = self.size
+        if n == 0 or seconds <= 0:
+            return
+        minutes = seconds / 60
+        temperature = self.temperature[:n]
+        speed = self.speed[:n]
+
+        # 送风：向目标温度移动，不越过目标温度
+        step = self.rates[speed] * minutes
+        serving = np.clip(self.target[:n] - temperature, -step, step)
+        # 不送风：向环境温度回温
+        drift = self.IDLE_RATE * minutes
+        idle = np.clip(self.ambient[:n] - temperature, -drift, drift)
+
+        temperature += np.where(speed > 0, serving, idle)
+
+    def get(self, roomNumber):
+        """
+        房间的当前温度
+        :param roomNumber: 房间号
+        :return: float，房间不存在时返回 None
+        """
+        idx = self.index.get(int(roomNumber))
+        return None if idx is None else float(self.temperature[idx])
+
+    def reached(self, tolerance=0.05):
+        """
+        已经到达目标温度的房间
+        :param tolerance: 允许的误差（°C）
+        :return: 房间号数组
+        """
+        n = self.size
+        mask = np.abs(self.temperature[:n] - self.target[:n]) <= tolerance
+        return self.roomNumbers[:n][mask]
+
+    def snapshot(self):
+        """
+        :return: {roomNumber: 当前温度}
+        """
+        n = self.size
+        return dict(zip(self.roomNumbers[:n].tolist(), self.temperature[:n].tolist()))
+
+    def getStats(self):
+        n = self.size
+        return {
+            "rooms": n,
+            "serving": int(np.count_nonzero(self.speed[:n])),
+            "meanTemperature": float(self.temperature[:n].mean()) if n > 0 else 0,
+            "reachedTarget": int(len(self.reached())),
+        }
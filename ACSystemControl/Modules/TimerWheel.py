@@ -0,0 +1,90 @@
+import math
+
+from . import Clock
+
+
+class TimerWheel:
+    """
+    哈希时间轮
+    把定时器按到期的 tick 散列到环形的槽里，每个 tick 只处理当前槽，
+    添加、取消定时器都是 O(1)，推进一个 tick 的开销只和该槽里的定时器数量有关，
+    和定时器总数无关
+    超过一圈的定时器记录剩余圈数，指针每经过一次该槽圈数减一
+    :param tickInterval 一个 tick 的时长（秒）
+    :param slotNum 槽的数量
+    :parameter slots 槽 -> {key: 剩余圈数}
+    :parameter timers key -> 所在的槽
+    """
+
+    def __init__(self, tickInterval, slotNum=512, now=None):
+        self.tickInterval = float(tickInterval)
+        self.slotNum = slotNum
+        self.slots = []
+        for i in range(slotNum):
+            self.slots.append({})
+        self.timers = {}
+        self.current = 0
+        self.lastTickTime = Clock.monotonic() if now is None else now
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def schedule(self, key, delay):
+        """
+        添加定时器，同一个 key 已有定时器时会被覆盖
+        :param key: 定时器标识
+        :param delay: 多少秒之后到期
+        :return:
+        """
+        self.cancel(key)
+        ticks = max(1, int(math.ceil(delay / self.tickInterval)))
+        slot = (self.current + ticks) % self.slotNum
+        self.slots[slot][key] = (ticks - 1) // self.slotNum
+        self.timers[key] = slot
+
+    def cancel(self, key):
+        """
+        取消定时器
+        :param key: 定时器标识
+        :return: 是否取消了一个定时器
+        """
+        slot = self.timers.pop(key, None)
+        if slot is None:
+            return False
+        del self.slots[slot][key]
+        return True
+
+    def tick(self):
+        """
+        指针前进一格
+        :return: expired 这一格中到期的定时器
+        """
+        self.current = (self.current + 1) % self.slotNum
+        slot = self.slots[self.current]
+        expired = []
+        for key, rounds in slot.items():
+            if rounds == 0:
+                expired.append(key)
+            else:
+                slot[key] = rounds - 1
+        for key in expired:
+            del slot[key]
+            del self.timers[key]
+        return expired
+
+    def advance(self, now=None):
+        """
+        按照经过的时间推进指针
+        :param now: 当前时间（Clock.monotonic()）
+        :return: expired 到期的定时器
+        """
+        if now is None:
+            now = Clock.monotonic()
+        expired = []
+        while now - self.lastTickTime >= self.tickInterval:
+            self.lastTickTime += self.tickInterval
+            expired.extend(self.tick())
+        return expired
@@ -0,0 +1,141 @@
+from collections import OrderedDict
+
+
+class WaitQueue:
+    """
+    送风请求的等待队列
+    低/中/高三种风速各有一个先进先出的队列，另外维护 roomNumber -> 风速 的索引，
+    查找、取消、调整优先级、出队都是 O(1)，不需要遍历队列
+    每个风速的队列用 OrderedDict(roomNumber -> airRequest) 实现：
+    既保持入队顺序（popitem(last=False) 即队头出队），又能按房间号直接删除/替换
+    :parameter queues 风速 -> 该风速的等待队列
+    :parameter index  roomNumber -> 该房间请求所在队列的风速
+    """
+    # 出队时按优先级从高到低检查
+    SPEEDS = (3, 2, 1)
+
+    def __init__(self):
+        self.queues = {1: OrderedDict(), 2: OrderedDict(), 3: OrderedDict()}
+        self.index = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, roomNumber):
+        return int(roomNumber) in self.index
+
+    def size(self, speed):
+        """
+        某个风速的等待队列长度
+        :param speed: 风速 1 低 2 中 3 高
+        :return:
+        """
+        return len(self.queues[int(speed)])
+
+    def maxSpeed(self):
+        """
+        正在等待的请求中最高的风速
+        :return: 3 高 2 中 1 低 0 没有请求在等待
+        """
+        for speed in self.SPEEDS:
+            if self.queues[speed]:
+                return speed
+        return 0
+
+    def put(self, airRequest):
+        """
+        请求排到对应风速队列的队尾
+        如果该房间已经有请求在等待，旧请求会被移除
+        :param airRequest: 送风请求
+        :return:
+        """
+        roomNumber = int(airRequest.roomNumber)
+        self.remove(roomNumber)
+        speed = int(airRequest.targetSpeed)
+        self.queues[speed][roomNumber] = airRequest
+        self.index[roomNumber] = speed
+
+    def get(self, speed=None):
+        """
+        取出优先级最高（风速最大，等待最久）的请求
+        :param speed: 指定风速，只从该风速的队列出队
+        :return: airRequest 没有请求等待时返回 None
+        """
+        speeds = self.SPEEDS if speed is None else (int(speed),)
+        for _speed in speeds:
+            queue = self.queues[_speed]
+            if queue:
+                roomNumber, airRequest = queue.popitem(last=False)
+                del self.index[roomNumber]
+                return airRequest
+        return None
+
+    def peek(self, speed=None):
+        """
+        查看队头的请求，但不出队
+        :param speed: 指定风速，缺省为优先级最高的队列
+        :return: airRequest 没有请求时返回 None
+        """
+        speeds = self.SPEEDS if speed is None else (int(speed),)
+        for _speed in speeds:
+            queue = self.queues[_speed]
+            if queue:
+                return next(iter(queue.values()))
+        return None
+
+    def find(self, roomNumber):
+        """
+        查询某个房间正在等待的请求
+        :param roomNumber: 房间号
+        :return: airRequest 没有等待的请求时返回 None
+        """
+        roomNumber = int(roomNumber)
+        speed = self.index.get(roomNumber)
+        if speed is None:
+            return None
+        return self.queues[speed][roomNumber]
+
+    def remove(self, roomNumber):
+        """
+        把某个房间的请求移出等待队列
+        :param roomNumber: 房间号
+        :return: airRequest 被移出的请求，没有时返回 None
+        """
+        roomNumber = int(roomNumber)
+        speed = self.index.pop(roomNumber, None)
+        if speed is None:
+            return None
+        return self.queues[speed].pop(roomNumber)
+
+    def replace(self, airRequest):
+        """
+        用新请求替换某个房间正在等待的请求
+        风速不变时保持原来的排队位置，风速改变时排到新风速队列的队尾
+        :param airRequest: 新的送风请求
+        :return: oldRequest 被替换的请求，房间没有请求在等待时返回 None（此时不入队）
+        """
+        roomNumber = int(airRequest.roomNumber)
+        speed = self.index.get(roomNumber)
+        if speed is None:
+            return None
+
+        newSpeed = int(airRequest.targetSpeed)
+        if speed == newSpeed:
+            queue = self.queues[speed]
+            oldRequest = queue[roomNumber]
+            queue[roomNumber] = airRequest
+        else:
+            oldRequest = self.queues[speed].pop(roomNumber)
+            self.queues[newSpeed][roomNumber] = airRequest
+            self.index[roomNumber] = newSpeed
+        return oldRequest
+
+    def roomNumbers(self):
+        """
+        所有正在等待的房间号，按出队顺序
+        :return:
+        """
+        _list = []
+        for speed in self.SPEEDS:
+            _list.extend(self.queues[speed].keys())
+        return _list
@@ -1,29 +1,36 @@
+import json
+
+# 状态码 -> 返回信息
+INFO = {
+    400: "Server not available(Server not exist or inited)",
+    401: "Server already initiated",
+    410: "Invalid arguments",
+    411: "Invalid roomNumber",
+    412: "room has already been taken",
+    413: "database transaction error",
+    414: "room is empty",
+    415: "ID mismatch",
+    416: "Invalid request",
+    417: "Server busy, retry later",
+    418: "Analytics not available(numpy is not installed)",
+    419: "XLSX export not available(openpyxl is not installed)",
+    200: "OK",
+}
+
+# 预先序列化的返回：(返回类型, cacheKey) -> JSON bytes
+# 只有 状态码 / 状态码 × 风速 这样取值很少的返回会被缓存
+_payloads = {}
+
+
 class RespondPack(object):
     def __init__(self, status):
         self.status = status
-        if status == 400:
-            self.info = "Server not available(Server not exist or inited)"
-        elif status == 401:
-            self.info = "Server already initiated"
-        elif status == 410:
-            self.info = "Invalid arguments"
-        elif status == 411:
-            self.info = "Invalid roomNumber"
-        elif status == 412:
-            self.info = "room has already been taken"
-        elif status == 413:
-            self.info = "database transaction error"
-        elif status == 414:
-            self.info = "room is empty"
-        elif status == 415:
-            self.info = "ID mismatch"
-        elif status == 416:
-            self.info = "Invalid request"
-        elif status == 200:
-            self.info = "OK"
+        self.info = INFO.get(status)
+        self.cacheable = status in INFO
 
     def setInfo(self, info):
         self.info = info
+        self.cacheable = False
 
     def keys(self):
         return 'status', 'info'
@@ -31,22 +38,185 @@ class RespondPack(object):
     def __getitem__(self, item):
         return getattr(self, item)
 
+    def cacheKey(self):
+        """
+        相同 cacheKey 的返回序列化结果相同
+        :return: None 表示不缓存，每次都序列化
+        """
+        return self.status
+
+    @classmethod
+    def payload(cls, status):
+        """
+        直接取状态码对应的 JSON bytes，不构造返回对象
+        :param status: 状态码
+        :return: bytes
+        """
+        payload = _payloads.get((cls, status))
+        return cls(status).toJSON() if payload is None else payload
+
+    def toJSON(self):
+        """
+        序列化成 JSON bytes，能缓存的返回直接使用缓存
+        :return: bytes
+        """
+        key = self.cacheKey() if self.cacheable else None
+        if key is None:
+            return json.dumps(dict(self)).encode()
+        payload = _payloads.get((type(self), key))
+        if payload is None:
+            payload = json.dumps(dict(self)).encode()
+            _payloads[(type(self), key)] = payload
+        return payload
+
 
 class DetailResponse(RespondPack):
-    def __init__(self, status, detail):
+    def __init__(self, status, detail, records=None, nextCursor=None):
         super().__init__(status)
         self.detail = detail
+        self.records = records
+        self.nextCursor = nextCursor
+
+    def keys(self):
+        return 'status', 'info', 'detail', 'records', 'nextCursor'
+
+    def cacheKey(self):
+        return None
+
+    def stream(self, records, limit, chunkSize=100):
+        """
+        流式序列化：先输出状态和账单，再逐块输出详单，最后输出下一页的 cursor
+        详单一边从数据库读取一边输出，不构造完整的列表
+        :param records: 送风段的生成器
+        :param limit: 最多输出的送风段数，还有剩余时 nextCursor 是下一段的 cursor
+        :param chunkSize: 每一块包含的送风段数
+        :return: 生成 str
+        """
+        head = json.dumps({key: self[key] for key in ('status', 'info', 'detail')})
+        yield head[:-1] + ', "records": ['
+        separator = ""
+        chunk = []
+        count = 0
+        nextCursor = None
+        for record in records:
+            if count == limit:
+                nextCursor = record["cursor"]
+                break
+            chunk.append(json.dumps(record))
+            count += 1
+            if len(chunk) == chunkSize:
+                yield separator + ", ".join(chunk)
+                separator = ", "
+                chunk = []
+        if len(chunk) > 0:
+            yield separator + ", ".join(chunk)
+        yield '], "nextCursor": %s}' % json.dumps(nextCursor)
+
+
+class CheckoutResponse(RespondPack):
+    def __init__(self, status, bill):
+        super().__init__(status)
+        self.bill = bill
+
+    def keys(self):
+        return 'status', 'info', 'bill'
+
+    def cacheKey(self):
+        return None if self.bill is not None else self.status
+
+
+class ReportResponse(RespondPack):
+    def __init__(self, status, report):
+        super().__init__(status)
+        self.report = report
+
+    def keys(self):
+        return 'status', 'info', 'report'
+
+    def cacheKey(self):
+        return None
+
+
+class AnalyticsResponse(RespondPack):
+    def __init__(self, status, analytics):
+        super().__init__(status)
+        self.analytics = analytics
 
     def keys(self):
-        return 'status', 'info', 'detail'
+        return 'status', 'info', 'analytics'
+
+    def cacheKey(self):
+        return None
+
+
+class MetricsResponse(RespondPack):
+    def __init__(self, status, metrics):
+        super().__init__(status)
+        self.metrics = metrics
+
+    def keys(self):
+        return 'status', 'info', 'metrics'
+
+    def cacheKey(self):
+        return None
+
+
+class BatchUpdateResponse(RespondPack):
+    def __init__(self, status, results):
+        super().__init__(status)
+        self.results = results
+
+    def keys(self):
+        return 'status', 'info', 'results'
+
+    def cacheKey(self):
+        return None
+
+
+class WatchResponse(RespondPack):
+    def __init__(self, status, version, speed):
+        super().__init__(status)
+        self.version = version
+        self.speed = speed
+
+    def keys(self):
+        return 'status', 'info', 'version', 'speed'
+
+    def cacheKey(self):
+        return None
 
 
 class UpdateResponse(RespondPack):
-    def __init__(self, status, speed):
+    # 可以缓存的风速
+    SPEEDS = (0, 1, 2, 3)
+    # 可以缓存的心跳间隔（秒），服务器建议的间隔都是 2 的整数次幂
+    INTERVALS = (None, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+    def __init__(self, status, speed, interval=None):
         super().__init__(status)
         self.speed = speed
+        self.interval = interval
 
     def keys(self):
-        return 'status', 'info', 'speed'
+        return 'status', 'info', 'speed', 'interval'
+
+    @classmethod
+    def payload(cls, status, speed, interval=None):
+        payload = _payloads.get((cls, (status, speed, interval)))
+        return cls(status, speed, interval).toJSON() if payload is None else payload
+
+    def cacheKey(self):
+        if type(self.speed) is not int or self.speed not in self.SPEEDS or self.interval not in self.INTERVALS:
+            return None
+        return self.status, self.speed, self.interval
+
+
+def _preserialize():
+    for status in INFO:
+        RespondPack(status).toJSON()
+        for speed in UpdateResponse.SPEEDS:
+            for interval in UpdateResponse.INTERVALS:
+                UpdateResponse(status, speed, interval).toJSON()
 
 
+_preserialize()
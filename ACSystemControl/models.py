@@ -1,5 +1,6 @@
 from django.db import models
-from datetime import datetime
+
+from .Modules import Clock
 
 
 class AC(models.Model):
@@ -28,21 +29,38 @@ class AC(models.Model):
     def addWaitTime(self, waitTime):
         self.waitTime += waitTime
 
-    def stopServing(self):
+    def stopServing(self, commit=True):
+        """
+        停止送风（被调度出服务对象）
+        :param commit: 是否立即写数据库，False 时由调用方负责保存
+        :return: 产生的记录
+        """
         _record = Record()
         _record.init_ScheduleRecord(self, 0)
         self.currentSpeed = 0
 
-        _record.save()
-        self.save()
+        if commit:
+            _record.save()
+            self.save()
+        return [_record]
 
-    def startServing(self):
+    def startServing(self, speed=None, commit=True):
+        """
+        开始送风（被调度到服务对象上），或者送风中的风速发生变化
+        :param speed: 送风风速，缺省为目标风速
+        :param commit: 是否立即写数据库，False 时由调用方负责保存
+        :return: 产生的记录
+        """
+        if speed is None:
+            speed = self.targetSpeed
         _record = Record()
-        _record.init_ScheduleRecord(self, self.targetSpeed)
-        self.currentSpeed = self.targetSpeed
+        _record.init_ScheduleRecord(self, speed)
+        self.currentSpeed = speed
 
-        _record.save()
-        self.save()
+        if commit:
+            _record.save()
+            self.save()
+        return [_record]
 
     def isNewRequest(self, state, status):
         """
@@ -70,13 +88,15 @@ class AC(models.Model):
             else:
                 return 4
 
-    def update(self, state, status):
+    def update(self, state, status, commit=True):
         """
         用当前状态更新数据库
         :param state: 空调运行参数
         :param status: 空调状态
-        :return:
+        :param commit: 是否立即写数据库，False 时由调用方负责保存
+        :return: 产生的记录
         """
+        records = []
 
         # 根据数据是否被改变产生相应的记录
         statusModified = False
@@ -96,8 +116,8 @@ class AC(models.Model):
         # 用户开关机/空调休眠
         if statusModified:
             _record = Record()
-            _record.init_OperationRecord()
-            _record.save()
+            _record.init_OperationRecord(self, status)
+            records.append(_record)
 
         # 用户调风调温
         # 默认不修改
@@ -109,19 +129,27 @@ class AC(models.Model):
         if targetTemperatureModified:
             new_targetTemperature = state[1]
 
-        _record = Record()
-        _record.init_RequestRecord(self, new_targetTemperature, new_targetSpeed)
-        _record.save()
+        if targetSpeedModified or targetTemperatureModified:
+            _record = Record()
+            _record.init_RequestRecord(self, new_targetTemperature, new_targetSpeed)
+            records.append(_record)
 
         self.currentTemperature = state[0]
         self.targetSpeed = state[3]
         self.targetTemperature = state[1]
         self.status = status
-        self.save()
+
+        if commit:
+            for _record in records:
+                _record.save()
+            self.save()
+        return records
 
 
 class Record(models.Model):
-    ac = models.ForeignKey(AC, on_delete=models.CASCADE)
+    # 当前入住的空调，退房删除空调之后置空，记录保留给报表、导出和历史分析
+    ac = models.ForeignKey(AC, on_delete=models.SET_NULL, null=True)
+    roomNumber = models.IntegerField()
 
     # 调温度
     last_targetTemperature = models.IntegerField()
@@ -141,6 +169,10 @@ class Record(models.Model):
 
     date = models.DateTimeField()
 
+    class Meta:
+        # 按房间、按时间顺序读取记录：本次入住的（详单、账单恢复）/全部历史的（统计、导出、分析）
+        indexes = [models.Index(fields=["ac", "date"]), models.Index(fields=["roomNumber", "date"])]
+
     def __str__(self):
         return "record : " \
                "targetTemperature from " + str(self.last_targetTemperature) + " to " + str(self.new_targetTemperature) + ", " \
@@ -154,13 +186,14 @@ class Record(models.Model):
         :return:
         """
         self.ac = ac
+        self.roomNumber = ac.roomNumber
         self.old_speed = ac.currentSpeed
         self.new_speed = ac.currentSpeed
         self.last_targetTemperature = ac.targetTemperature
         self.new_targetTemperature = ac.targetTemperature
         self.last_targetSpeed = ac.targetSpeed
         self.new_targetSpeed = ac.targetSpeed
-        self.date = datetime.now()
+        self.date = Clock.now()
 
         self.old_status = ac.status
         self.new_status = new_status
@@ -176,6 +209,7 @@ class Record(models.Model):
 
         assert new_targetTemperature != -1 or new_targetSpeed != -1
         self.ac = ac
+        self.roomNumber = ac.roomNumber
         _AC = self.ac
         self.old_speed = _AC.currentSpeed
         self.new_speed = _AC.currentSpeed
@@ -183,7 +217,7 @@ class Record(models.Model):
         self.new_status = _AC.status
         self.last_targetTemperature = _AC.targetTemperature
         self.last_targetSpeed = _AC.targetSpeed
-        self.date = datetime.now()
+        self.date = Clock.now()
 
         if new_targetSpeed != -1:
             self.new_targetSpeed = new_targetSpeed
@@ -196,7 +230,17 @@ class Record(models.Model):
             self.new_targetTemperature = _AC.targetTemperature
 
     def init_ScheduleRecord(self, ac, new_speed):
+        """
+        创建一条关于调度（送风风速变化）的记录
+        :param ac: 空调
+        :param new_speed: 调度之后的风速
+        :return:
+        """
         self.ac = ac
+        self.roomNumber = ac.roomNumber
+        self.old_status = ac.status
+        self.new_status = ac.status
+        self.date = Clock.now()
         self.old_speed = ac.currentSpeed
         self.last_targetTemperature = ac.targetTemperature
         self.last_targetSpeed = ac.targetSpeed
@@ -206,8 +250,7 @@ class Record(models.Model):
         self.new_speed = new_speed
 
     def toFile(self):
-        _AC = self.ac
-        _list = [str(_AC.roomNumber),
+        _list = [str(self.roomNumber),
                  str(self.old_speed), str(self.new_speed),
                  str(self.last_targetSpeed), str(self.new_targetSpeed),
                  str(self.last_targetTemperature), str(self.new_targetTemperature),
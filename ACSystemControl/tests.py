@@ -0,0 +1,510 @@
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from . import models
+from .Modules import Clock
+from .Modules.ACBillingManager import ACBillingManager, RoomBill
+from .Modules.ACStateManager import ACStateManager
+from .Modules.AsyncScheduler import AsyncPriorityScheduler, AsyncRoundScheduler
+from .Modules.Metrics import Histogram
+from .Modules.RecordAnalytics import RecordAnalytics, RecordColumns, np, toSeconds
+from .Modules.RequestChannel import RequestChannel
+from .Modules.Scheduler import ACAirRequest, PriorityScheduler, Request, RoundScheduler, ServingCluster
+from .Modules.ShardedScheduler import ShardedScheduler, ShardRouter
+from .Modules.StatManager import RoomStat, StatManager
+
+
+class RecordingStateManager:
+    """
+    记录调度结果的空调状态表，不读写数据库
+    :parameter serving roomNumber -> 正在送风的风速
+    :parameter events [(action, roomNumber)]
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.serving = {}
+        self.events = []
+
+    def startServing(self, roomNumber, speed):
+        with self.lock:
+            self.serving[int(roomNumber)] = speed
+            self.events.append(("startServing", int(roomNumber)))
+
+    def stopServing(self, roomNumber):
+        with self.lock:
+            self.serving.pop(int(roomNumber), None)
+            self.events.append(("stopServing", int(roomNumber)))
+
+    def addWaitTime(self, roomNumber, waitTime):
+        with self.lock:
+            self.events.append(("addWaitTime", int(roomNumber)))
+
+    def servingRooms(self):
+        with self.lock:
+            return set(self.serving)
+
+    def count(self, action, roomNumber):
+        with self.lock:
+            return self.events.count((action, roomNumber))
+
+
+def onRequest(roomNumber, targetSpeed, targetTemperature=25):
+    request = Request()
+    request.setType("on")
+    request.setAirRequest(ACAirRequest(roomNumber, targetTemperature, targetSpeed))
+    return request
+
+
+def powerOffRequest(roomNumber):
+    request = Request()
+    request.setType("powerOff")
+    request.setAirRequest(roomNumber)
+    return request
+
+
+class SchedulerScenarios:
+    """
+    两种调度引擎（线程/asyncio）共用的场景，子类实现 createScheduler
+    """
+    TIME_SLICE = 0.2
+    TIMEOUT = 3
+
+    def createScheduler(self, instanceNum, timeSlice=None):
+        """
+        :return: (调度器, 请求队列)
+        """
+        raise NotImplementedError
+
+    def setUp(self):
+        self.stateManager = RecordingStateManager()
+        self.schedulers = []
+
+    def tearDown(self):
+        for scheduler in self.schedulers:
+            if hasattr(scheduler, "stop"):
+                scheduler.stop()
+
+    def start(self, instanceNum, timeSlice=None):
+        scheduler, channel = self.createScheduler(instanceNum, timeSlice)
+        scheduler.setStateManager(self.stateManager)
+        scheduler.start()
+        self.schedulers.append(scheduler)
+        return scheduler, channel
+
+    def waitFor(self, condition):
+        deadline = time.monotonic() + self.TIMEOUT
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("timed out, serving %s, events %s" % (self.stateManager.servingRooms(),
+                                                                  self.stateManager.events))
+            time.sleep(0.01)
+
+    def testPriority(self):
+        scheduler, channel = self.start(1)
+        self.assertTrue(channel.putMany([onRequest(101, 1), onRequest(102, 3), onRequest(103, 2)]))
+        self.waitFor(lambda: self.stateManager.servingRooms() == {102})
+        self.assertEqual(self.stateManager.count("startServing", 101), 0)
+
+    def testPreemption(self):
+        scheduler, channel = self.start(1)
+        channel.put(onRequest(101, 1))
+        self.waitFor(lambda: self.stateManager.servingRooms() == {101})
+        channel.put(onRequest(102, 2))
+        self.waitFor(lambda: self.stateManager.servingRooms() == {102})
+        self.assertEqual(self.stateManager.count("stopServing", 101), 1)
+        # 被调出的请求回到等待队列，高风速的房间关机之后重新送风
+        channel.put(powerOffRequest(102))
+        self.waitFor(lambda: self.stateManager.servingRooms() == {101})
+
+    def testTimeSliceRotation(self):
+        scheduler, channel = self.start(1, self.TIME_SLICE)
+        channel.put(onRequest(101, 2))
+        self.waitFor(lambda: self.stateManager.servingRooms() == {101})
+        channel.put(onRequest(102, 2))
+        # 同风速轮流送风
+        self.waitFor(lambda: self.stateManager.servingRooms() == {102})
+        self.waitFor(lambda: self.stateManager.count("startServing", 101) == 2)
+        self.assertEqual(self.stateManager.servingRooms(), {101})
+
+    def testNoRotationWithoutWaiting(self):
+        scheduler, channel = self.start(1, self.TIME_SLICE)
+        channel.put(onRequest(101, 2))
+        self.waitFor(lambda: self.stateManager.servingRooms() == {101})
+        time.sleep(self.TIME_SLICE * 3)
+        self.assertEqual(self.stateManager.count("stopServing", 101), 0)
+
+    def testCancel(self):
+        scheduler, channel = self.start(1)
+        channel.put(onRequest(101, 2))
+        self.waitFor(lambda: self.stateManager.servingRooms() == {101})
+        channel.put(onRequest(102, 1))
+        self.waitFor(lambda: scheduler.findRequest(102)[0] is not None)
+        # 等待中的请求取消之后不会再被调度
+        channel.put(powerOffRequest(102))
+        self.waitFor(lambda: self.stateManager.count("addWaitTime", 102) == 1)
+        channel.put(powerOffRequest(101))
+        self.waitFor(lambda: self.stateManager.servingRooms() == set())
+        self.assertEqual(self.stateManager.count("startServing", 102), 0)
+        self.assertEqual(scheduler.getMetrics().cancelCount, 2)
+
+    def testWithdraw(self):
+        scheduler, channel = self.start(1)
+        channel.put(onRequest(101, 2))
+        self.waitFor(lambda: self.stateManager.servingRooms() == {101})
+        channel.put(onRequest(102, 1))
+        self.waitFor(lambda: scheduler.findRequest(102)[0] is not None)
+        # 从其他线程撤回，返回时空出来的服务对象已经分给等待中的请求
+        self.assertIsNotNone(scheduler.withdraw(101))
+        self.assertEqual(self.stateManager.servingRooms(), {102})
+        self.assertEqual(self.stateManager.count("addWaitTime", 101), 1)
+        self.assertIsNone(scheduler.withdraw(101))
+
+
+class ThreadSchedulerTest(SchedulerScenarios, SimpleTestCase):
+
+    def createScheduler(self, instanceNum, timeSlice=None):
+        channel = RequestChannel()
+        if timeSlice is None:
+            scheduler = PriorityScheduler(instanceNum, ServingCluster(instanceNum), channel, batch=True)
+        else:
+            scheduler = RoundScheduler(instanceNum, ServingCluster(instanceNum), channel, timeSlice,
+                                       tickInterval=0.05, batch=True)
+        return scheduler, channel
+
+
+class AsyncSchedulerTest(SchedulerScenarios, SimpleTestCase):
+
+    def createScheduler(self, instanceNum, timeSlice=None):
+        if timeSlice is None:
+            scheduler = AsyncPriorityScheduler(instanceNum, ServingCluster(instanceNum))
+        else:
+            scheduler = AsyncRoundScheduler(instanceNum, ServingCluster(instanceNum), timeSlice)
+        return scheduler, scheduler
+
+    def testPutManyOnLoop(self):
+        scheduler, channel = self.start(1)
+        # 在调度器自己的事件循环里投递不能卡住事件循环
+        result = Future()
+        scheduler.loop.call_soon_threadsafe(lambda: result.set_result(scheduler.putMany([onRequest(101, 2)])))
+        self.assertTrue(result.result(self.TIMEOUT))
+        self.waitFor(lambda: self.stateManager.servingRooms() == {101})
+
+
+class ShardedSchedulerTest(SimpleTestCase):
+
+    def testPutManyAllOrNothing(self):
+        # 不启动调度器线程，请求留在队列中；按楼层分片，1、2 号房间在分片 0，102 号房间在分片 1
+        scheduler = ShardedScheduler(2, ShardRouter(2), capacity=1, batch=True)
+        self.assertTrue(scheduler.put(onRequest(1, 2)))
+        # 分片 0 已满，分片 1 的请求也不能入队
+        self.assertFalse(scheduler.putMany([onRequest(2, 2), onRequest(102, 2)], timeout=0))
+        self.assertEqual([len(channel) for channel in scheduler.channels], [1, 0])
+        self.assertEqual(scheduler.channels[1].getStats()["rejectedCount"], 1)
+
+        scheduler.channels[0].getBatch()
+        self.assertTrue(scheduler.putMany([onRequest(2, 2), onRequest(102, 2)], timeout=0))
+        self.assertEqual([len(channel) for channel in scheduler.channels], [1, 1])
+
+    def testPutManyWaitsForRoom(self):
+        scheduler = ShardedScheduler(2, ShardRouter(2), capacity=1, batch=True)
+        scheduler.put(onRequest(1, 2))
+        timer = threading.Timer(0.1, scheduler.channels[0].getBatch, (None, 0))
+        timer.start()
+        self.assertTrue(scheduler.putMany([onRequest(2, 2), onRequest(102, 2)], timeout=2))
+        timer.join()
+        self.assertEqual([len(channel) for channel in scheduler.channels], [1, 1])
+
+
+class HistogramTest(SimpleTestCase):
+
+    def testPercentileNotAboveMax(self):
+        histogram = Histogram()
+        for value in (0.2, 0.3, 0.489):
+            histogram.observe(value)
+        self.assertLessEqual(histogram.percentile(0.5), 0.489)
+        self.assertEqual(histogram.percentile(1), 0.489)
+        self.assertEqual(Histogram().percentile(0.5), 0)
+
+    def testPercentileInterpolates(self):
+        histogram = Histogram((1, 2))
+        for i in range(10):
+            histogram.observe(1.5)
+        for i in range(10):
+            histogram.observe(1.9)
+        # 20 个观测都在 (1, 2] 桶内，按线性分布插值
+        self.assertAlmostEqual(histogram.percentile(0.25), 1.25)
+        self.assertAlmostEqual(histogram.percentile(0.5), 1.5)
+        # 插值超过最大值时取最大值
+        self.assertAlmostEqual(histogram.percentile(0.95), 1.9)
+        # +inf 桶返回最大值
+        histogram.observe(7)
+        self.assertEqual(histogram.percentile(1), 7)
+
+
+class ACStateManagerTest(SimpleTestCase):
+
+    def testColdLoadDoesNotBlockHeartbeat(self):
+        manager = ACStateManager()
+        _AC = models.AC()
+        _AC.init(101)
+        manager.table[101] = _AC
+
+        loading = threading.Event()
+        release = threading.Event()
+
+        def slowGet(roomNumber):
+            loading.set()
+            release.wait(3)
+            loaded = models.AC()
+            loaded.init(roomNumber)
+            return loaded
+
+        with mock.patch.object(models.AC.objects, "get", side_effect=slowGet):
+            loader = threading.Thread(target=manager.get, args=(102,))
+            loader.start()
+            self.assertTrue(loading.wait(3))
+            # 另一个房间从数据库加载时，内存中的房间可以查找和处理心跳
+            result = Future()
+            threading.Thread(target=lambda: result.set_result(
+                (manager.peek(101), manager.heartbeat(101, 20)))).start()
+            self.assertEqual(result.result(1), (_AC, 0))
+            release.set()
+            loader.join()
+        self.assertEqual(manager.peek(102).roomNumber, 102)
+
+
+class BillingTest(SimpleTestCase):
+    START = datetime(2020, 1, 1, 12)
+
+    def setUp(self):
+        self.clock = Clock.VirtualClock(self.START)
+        self.oldClock = Clock.setClock(self.clock)
+
+    def tearDown(self):
+        Clock.setClock(self.oldClock)
+
+    def testAccumulatorMatchesIntervals(self):
+        # (秒, 新风速)：送风中改变风速、停止送风、重新送风，最后一段还没有结束
+        changes = [(0, 2), (90, 3), (150, 0), (600, 1), (660, 2)]
+        records = [SimpleNamespace(id=i + 1, date=self.START + timedelta(seconds=seconds), new_speed=speed)
+                   for i, (seconds, speed) in enumerate(changes)]
+        bill = RoomBill(101, self.START)
+        for record in records:
+            bill.transit(record.new_speed, record.date)
+        self.clock.set(720)
+
+        detail = bill.toDict(Clock.now())
+        segments = list(ACBillingManager.intervals(101, records))
+        self.assertEqual([segment["speed"] for segment in segments], [2, 3, 1, 2])
+        self.assertIsNone(segments[-1]["end"])
+        # 90 秒中风 + 60 秒高风 + 60 秒低风 + 60 秒中风
+        self.assertAlmostEqual(detail["totalCost"], 1.5 + 1.5 + 0.5 + 1)
+        self.assertAlmostEqual(detail["totalCost"], sum(segment["cost"] for segment in segments))
+        self.assertAlmostEqual(detail["servingTime"], sum(segment["duration"] for segment in segments))
+        self.assertEqual(detail["scheduleCount"], len(segments))
+
+    def testCheckOutClosesBill(self):
+        manager = ACBillingManager()
+        manager.checkIn(101)
+        # 没有登记入住的房间不计费
+        manager.speedChanged(102, 0, 2)
+        self.assertIsNone(manager.query(102))
+
+        manager.speedChanged(101, 0, 3)
+        self.clock.advance(120)
+        manager.speedChanged(101, 3, 1)
+        self.clock.advance(60)
+        self.assertAlmostEqual(manager.query(101)["totalCost"], 3.5)
+
+        bill = manager.checkOut(101)
+        self.assertAlmostEqual(bill["totalCost"], 3.5)
+        self.assertAlmostEqual(bill["servingTime"], 3)
+        self.assertEqual(bill["speed"], 0)
+        self.assertEqual(bill["checkOutTime"], "2020-01-01 12:03:00")
+        # 退房之后不再计费
+        self.clock.advance(60)
+        manager.speedChanged(101, 1, 2)
+        self.assertIsNone(manager.query(101))
+        self.assertIsNone(manager.checkOut(101))
+
+
+def makeRecord(roomNumber, date, oldSpeed=0, newSpeed=0, oldStatus="on", newStatus="on"):
+    """
+    只带统计需要的字段的记录
+    """
+    return SimpleNamespace(roomNumber=roomNumber, date=date,
+                           old_status=oldStatus, new_status=newStatus,
+                           last_targetTemperature=25, new_targetTemperature=25,
+                           last_targetSpeed=2, new_targetSpeed=2,
+                           old_speed=oldSpeed, new_speed=newSpeed)
+
+
+class StatManagerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = Clock.VirtualClock(datetime(2021, 2, 1))
+        self.oldClock = Clock.setClock(self.clock)
+
+    def tearDown(self):
+        Clock.setClock(self.oldClock)
+
+    def stat(self, manager, period, day, roomNumber=101):
+        for row in manager.report(period, day)["rooms"]:
+            if row["roomNumber"] == roomNumber:
+                return row
+        return None
+
+    def testRollupAcrossBoundaries(self):
+        manager = StatManager()
+        # 2020-12-31 是星期四，跨天、跨月、跨年，但是在同一周（从 2020-12-28 星期一开始）
+        manager.addRecords([
+            makeRecord(101, datetime(2020, 12, 31, 23, 0), oldStatus="powerOff"),
+            makeRecord(101, datetime(2020, 12, 31, 23, 30), 0, 2),
+            makeRecord(101, datetime(2021, 1, 1, 0, 30), 2, 0),
+            makeRecord(101, datetime(2021, 1, 1, 1, 0), newStatus="powerOff"),
+        ])
+        for period, day, usageTime in (("day", date(2020, 12, 31), 30), ("day", date(2021, 1, 1), 30),
+                                       ("month", date(2020, 12, 1), 30), ("month", date(2021, 1, 31), 30),
+                                       ("year", date(2020, 6, 1), 30), ("year", date(2021, 1, 1), 30),
+                                       ("week", date(2020, 12, 28), 60), ("week", date(2021, 1, 3), 60)):
+            stat = self.stat(manager, period, day)
+            self.assertAlmostEqual(stat["usageTime"], usageTime, msg=(period, day))
+            # 中风 1 元/分钟
+            self.assertAlmostEqual(stat["cost"], usageTime, msg=(period, day))
+
+        self.assertEqual(manager.report("week", date(2020, 12, 28))["start"], "2020-12-28")
+        self.assertEqual(manager.report("week", date(2020, 12, 28))["end"], "2021-01-04")
+        # 开机和调度算在开始的一天，关机算在结束的一天
+        day1 = self.stat(manager, "day", date(2020, 12, 31))
+        day2 = self.stat(manager, "day", date(2021, 1, 1))
+        self.assertEqual((day1["onCount"], day1["scheduleCount"], day1["detailCount"], day1["offCount"]), (1, 1, 1, 0))
+        self.assertEqual((day2["onCount"], day2["scheduleCount"], day2["detailCount"], day2["offCount"]), (0, 0, 0, 1))
+        self.assertIsNone(self.stat(manager, "week", date(2021, 1, 4)))
+
+    def testReportCountsOpenSegmentToNow(self):
+        manager = StatManager()
+        manager.addRecords([makeRecord(101, datetime(2021, 1, 31, 23, 50), 0, 3)])
+        # 现在是 2021-02-01 00:00，还没有结束的一段计到现在
+        self.assertAlmostEqual(self.stat(manager, "day", date(2021, 1, 31))["usageTime"], 10)
+        self.assertAlmostEqual(self.stat(manager, "month", date(2021, 1, 1))["cost"], 15)
+        self.clock.advance(600)
+        self.assertAlmostEqual(self.stat(manager, "day", date(2021, 2, 1))["usageTime"], 10)
+        self.assertAlmostEqual(self.stat(manager, "year", date(2021, 1, 1))["usageTime"], 20)
+
+    def testBackgroundRebuildKeepsNewRecords(self):
+        manager = StatManager()
+        manager.addRecords([makeRecord(102, datetime(2021, 1, 1, 9, 0), 0, 1)])
+        release = threading.Event()
+
+        def records():
+            yield makeRecord(101, datetime(2021, 1, 1, 10, 0), 0, 2)
+            release.wait(3)
+
+        manager.startRebuild(records())
+        self.assertFalse(manager.isReady())
+        # 恢复期间产生的记录先缓存，不需要等待数据库
+        manager.addRecords([makeRecord(101, datetime(2021, 1, 1, 10, 10), 2, 0)])
+        release.set()
+        manager.rebuilder.join(3)
+
+        self.assertTrue(manager.isReady())
+        self.assertAlmostEqual(self.stat(manager, "day", date(2021, 1, 1))["usageTime"], 10)
+        # 恢复丢弃原来的汇总
+        self.assertIsNone(self.stat(manager, "day", date(2021, 1, 1), 102))
+        self.assertEqual(manager.getStats()["recordCount"], 2)
+
+
+def recordColumns(start, end, records, seeds=()):
+    """
+    由内存中的记录构造 RecordColumns（和 RecordColumns.load 的转换相同），不读数据库
+    :param seeds: [(房间号, 风速)] 开始时正在送风的房间
+    """
+    records = sorted((record for record in records if start <= record.date < end),
+                     key=lambda record: (record.roomNumber, record.date))
+    columns = {}
+    for name, field, dtype in RecordColumns.COLUMNS:
+        values = [getattr(record, field) for record in records]
+        if field == "date":
+            values = [toSeconds(value) for value in values]
+        elif field.endswith("status"):
+            values = [RecordColumns.STATUS.get(value, -1) for value in values]
+        columns[name] = np.array(values, dtype=dtype)
+    seedRoom = np.array([roomNumber for roomNumber, speed in seeds], dtype="int32")
+    seedSpeed = np.array([speed for roomNumber, speed in seeds], dtype="int8")
+    return RecordColumns(start, end, columns, seedRoom, seedSpeed)
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class RecordAnalyticsTest(SimpleTestCase):
+    NOW = datetime(2021, 1, 1, 12)
+    # 102 号房间在分析的时间段之前开始送风，一直没有停；103 号房间的最后一段还没有结束
+    RECORDS = [
+        makeRecord(102, datetime(2020, 12, 30, 10, 0), 0, 1),
+        makeRecord(101, datetime(2020, 12, 31, 23, 0), oldStatus="powerOff"),
+        makeRecord(101, datetime(2020, 12, 31, 23, 30), 0, 2),
+        makeRecord(101, datetime(2021, 1, 1, 0, 30), 2, 3),
+        makeRecord(101, datetime(2021, 1, 1, 1, 0), 3, 0),
+        makeRecord(101, datetime(2021, 1, 1, 1, 5), newStatus="powerOff"),
+        makeRecord(103, datetime(2021, 1, 1, 11, 0), 0, 2),
+    ]
+
+    def setUp(self):
+        self.clock = Clock.VirtualClock(self.NOW)
+        self.oldClock = Clock.setClock(self.clock)
+        self.analytics = RecordAnalytics()
+        self.stat = StatManager()
+        self.stat.rebuild(self.RECORDS)
+
+    def tearDown(self):
+        Clock.setClock(self.oldClock)
+
+    def load(self, start, end):
+        # 放进缓存，分析时不读数据库
+        seeds = [(102, 1)] if start > self.RECORDS[0].date else []
+        self.analytics.cache[(start, end)] = recordColumns(start, end, self.RECORDS, seeds)
+
+    def statRow(self, day, roomNumber):
+        for row in self.stat.report("day", day)["rooms"]:
+            if row["roomNumber"] == roomNumber:
+                return row
+        # 报表中没有的房间全部为 0
+        return RoomStat().toDict()
+
+    def testMatchesStatManager(self):
+        start, end = datetime(2020, 12, 31), datetime(2021, 1, 2)
+        self.load(start, end)
+        usage = self.analytics.usage(start, end, 86400)
+        counts = self.analytics.counts(start, end, 86400)
+        self.assertEqual(usage["rooms"].tolist(), [101, 102, 103])
+        self.assertEqual(counts["rooms"].tolist(), [101, 102, 103])
+        for i, roomNumber in enumerate(usage["rooms"].tolist()):
+            for j in range(2):
+                row = self.statRow((start + timedelta(days=j)).date(), roomNumber)
+                for name in ("usageTime", "cost"):
+                    self.assertAlmostEqual(usage[name][i, j], row[name], places=2, msg=(roomNumber, j, name))
+                for name in ("onCount", "offCount", "scheduleCount", "detailCount",
+                             "temperatureCount", "speedCount"):
+                    self.assertEqual(counts[name][i, j], row[name], msg=(roomNumber, j, name))
+        # 102 号房间整个时间段都在送风，计到现在
+        self.assertEqual(usage["usageTime"][1].tolist(), [1440, 720])
+
+    def testOpenSegmentsStopAtNow(self):
+        start, end = datetime(2020, 1, 1), datetime(2030, 1, 1)
+        self.load(start, end)
+        usage = self.analytics.usage(start, end, 86400 * 366)
+        rooms = usage["rooms"].tolist()
+        self.assertAlmostEqual(usage["usageTime"][rooms.index(103)].sum(), 60)
+        self.assertAlmostEqual(usage["usageTime"][rooms.index(102)].sum(), 2 * 1440 + 120)
+        # 以后的年份没有用量
+        self.assertEqual(usage["usageTime"][:, 2:].sum(), 0)
+        self.clock.advance(600)
+        usage = self.analytics.usage(start, end, 86400 * 366)
+        self.assertAlmostEqual(usage["usageTime"][rooms.index(103)].sum(), 70)
@@ -8,5 +8,13 @@ urlpatterns = [
     path('checkout', ACSystem.checkout),
     path('checkDetail', ACSystem.checkDetail),
     path('update', ACSystem.update),
-    path('shutdown', ACSystem.shutdown)
+    path('updateMany', ACSystem.updateMany),
+    path('watch', ACSystem.watch),
+    path('events', ACSystem.events),
+    path('shutdown', ACSystem.shutdown),
+    path('report', ACSystem.report),
+    path('analytics', ACSystem.analytics),
+    path('exportReport', ACSystem.exportReport),
+    path('exportRecords', ACSystem.exportRecords),
+    path('metrics', ACSystem.metrics)
 ]
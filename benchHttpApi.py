@@ -0,0 +1,266 @@
+"""
+HTTP 接口端到端压测
+在进程内启动 Django（测试客户端 + 临时 sqlite 数据库），模拟 N 个房间控制器：
+startup -> register -> 多轮 update 心跳（其中一部分调温调风）-> checkout -> shutdown
+报告每个接口的吞吐量、p50/p95/p99 延迟、数据库查询次数，以及请求队列深度和调度器指标
+--thermal 时房间的当前温度由 ThermalModel 按服务器返回的风速推进（每轮 --tick 秒，需要 numpy），
+而不是随机下降，报告中增加平均温度和到达目标温度的房间数
+
+用法: python benchHttpApi.py [--rooms N] [--instances N] [--rounds N] [--threads N] [--change P]
+                             [--engine thread|asyncio] [--scheduler priority|round] [--shards N] [--seed N]
+                             [--thermal] [--tick SECONDS]
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import warnings
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ACSystem.settings')
+
+
+class QueryCounter:
+    """
+    统计所有线程（请求线程、调度器线程、后台写数据库线程）执行的数据库查询
+    请求线程执行的查询计入当前接口，其他线程计入 "background"
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.local = threading.local()
+
+    def __call__(self, execute, sql, params, many, context):
+        endpoint = getattr(self.local, "endpoint", "background")
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+
+class LoadGenerator:
+    """
+    模拟房间控制器，每个线程负责一部分房间，依次为每个房间发送请求
+    :param client 测试客户端工厂
+    :param rooms 房间号列表
+    :param threads 并发的控制器线程数
+    :param counter QueryCounter
+    :parameter latencies 接口 -> [延迟（秒）]
+    :parameter errors 接口 -> 返回码不是 200 的次数
+    """
+
+    def __init__(self, client, rooms, threads, counter):
+        self.client = client
+        self.rooms = rooms
+        self.threads = threads
+        self.counter = counter
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.elapsed = {}
+
+    def request(self, client, endpoint, params):
+        """
+        :return: 接口返回的 JSON
+        """
+        self.counter.local.endpoint = endpoint
+        start = time.perf_counter()
+        response = client.get('/admin/' + endpoint, params)
+        latency = time.perf_counter() - start
+        self.counter.local.endpoint = None
+        result = json.loads(response.content)
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            if result["status"] != 200:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        return result
+
+    def run(self, endpoint, work):
+        """
+        所有控制器线程并发执行一个阶段
+        :param endpoint: 阶段名称（用于统计时长）
+        :param work: work(client, rooms) 每个线程执行的函数
+        :return:
+        """
+        groups = [self.rooms[i::self.threads] for i in range(self.threads)]
+        workers = [threading.Thread(target=work, args=(self.client(), group)) for group in groups if len(group) > 0]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.elapsed[endpoint] = self.elapsed.get(endpoint, 0) + time.perf_counter() - start
+
+
+class DepthSampler(threading.Thread):
+    """
+    定期采样请求队列深度
+    """
+
+    def __init__(self, server, interval=0.01):
+        threading.Thread.__init__(self, daemon=True)
+        self.server = server
+        self.interval = interval
+        self.samples = []
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.samples.append(self.server.getRequestQueueStats()["depth"])
+            time.sleep(self.interval)
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--instances", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--change", type=float, default=0.1, help="每次心跳调温调风的概率")
+    parser.add_argument("--engine", default="thread")
+    parser.add_argument("--scheduler", default="priority")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--thermal", action="store_true", help="用 ThermalModel 模拟房间温度")
+    parser.add_argument("--tick", type=float, default=60, help="--thermal 时每轮心跳之间经过的模拟时间（秒）")
+    args = parser.parse_args()
+
+    # 在临时目录中运行：临时数据库和退房写的 Usage.log 都放在这里，结束时一起删除
+    workDir = tempfile.TemporaryDirectory()
+    cwd = os.getcwd()
+    os.chdir(workDir.name)
+    try:
+        run(args)
+    finally:
+        os.chdir(cwd)
+        workDir.cleanup()
+
+
+def run(args):
+    # 临时数据库，测试客户端使用 testserver 作为主机名
+    from django.conf import settings
+    settings.DATABASES["default"]["NAME"] = os.path.join(os.getcwd(), "bench.sqlite3")
+    settings.ALLOWED_HOSTS = list(settings.ALLOWED_HOSTS) + ["testserver"]
+    django.setup()
+    # 调度器使用不带时区的 Clock.now()，每条记录都会触发这个警告
+    warnings.filterwarnings("ignore", message="DateTimeField .* received a naive datetime", category=RuntimeWarning)
+
+    from django.db import connection
+    from django.db.backends.signals import connection_created
+    from django.test import Client
+    from ACSystemControl import ACSystem, models
+    from ACSystemControl.Modules.ThermalModel import ThermalModel
+
+    # ACSystemControl 没有迁移文件，直接建表
+    with connection.schema_editor() as editor:
+        editor.create_model(models.AC)
+        editor.create_model(models.Record)
+
+    counter = QueryCounter()
+    connection_created.connect(counter.install)
+    connection.execute_wrappers.append(counter)
+
+    ACSystem.SETTING.ENGINE = args.engine
+    ACSystem.SETTING.SCHEDULER = args.scheduler
+    ACSystem.SETTING.SHARD_NUM = args.shards
+    rooms = list(range(1, args.rooms + 1))
+    generator = LoadGenerator(Client, rooms, args.threads, counter)
+    client = Client()
+    generator.request(client, "startup", {"roomNum": args.rooms, "instanceNum": args.instances})
+    server = ACSystem.server
+
+    def register(client, group):
+        for roomNumber in group:
+            generator.request(client, "register", {"roomNumber": roomNumber, "ID": "ID%d" % roomNumber})
+
+    def heartbeat(client, group):
+        rnd = random.Random(args.seed * 100003 + group[0])
+        for roomNumber in group:
+            state = states[roomNumber]
+            if rnd.random() < args.change:
+                state["tt"] = rnd.randint(server.SETTING.WORK_TEMPERATURE_LOWERBOUND,
+                                          server.SETTING.WORK_TEMPERATURE_UPPERBOUND)
+                state["ts"] = rnd.randint(1, 3)
+            if thermal is None:
+                state["ct"] = round(state["ct"] - rnd.uniform(0, 0.3), 1)
+            else:
+                thermal.setTarget(roomNumber, state["tt"])
+                state["ct"] = round(thermal.get(roomNumber), 1)
+            result = generator.request(client, "update", dict(state, roomNumber=roomNumber, status="on"))
+            if thermal is not None:
+                thermal.setSpeed(roomNumber, result.get("speed", 0))
+
+    def checkout(client, group):
+        for roomNumber in group:
+            generator.request(client, "checkout", {"roomNumber": roomNumber, "ID": "ID%d" % roomNumber})
+
+    rnd = random.Random(args.seed)
+    states = {roomNumber: {"ct": rnd.randint(27, 33), "tt": 25, "cs": 0, "ts": 2} for roomNumber in rooms}
+    # 房间都在压测开始之前加入模型，心跳线程只修改各自房间的数组元素
+    thermal = ThermalModel(len(rooms)) if args.thermal else None
+    if thermal is not None:
+        for roomNumber in rooms:
+            thermal.addRoom(roomNumber, states[roomNumber]["ct"], states[roomNumber]["tt"])
+
+    sampler = DepthSampler(server)
+    sampler.start()
+    generator.run("register", register)
+    for i in range(args.rounds):
+        generator.run("update", heartbeat)
+        if thermal is not None:
+            thermal.step(args.tick)
+    generator.run("checkout", checkout)
+    sampler.running = False
+    sampler.join()
+
+    metrics = server.getMetrics()
+    generator.request(client, "shutdown", {})
+
+    print("rooms %d, instances %d, rounds %d, threads %d, engine %s, scheduler %s, shards %d, thermal %s" % (
+        args.rooms, args.instances, args.rounds, args.threads, args.engine, args.scheduler, args.shards,
+        "on" if thermal is not None else "off"))
+    print("%-10s %8s %8s %10s %9s %9s %9s %9s %9s" % (
+        "endpoint", "count", "errors", "req/s", "p50(ms)", "p95(ms)", "p99(ms)", "queries", "q/req"))
+    for endpoint in ("startup", "register", "update", "checkout", "shutdown"):
+        latencies = sorted(generator.latencies.get(endpoint, []))
+        count = len(latencies)
+        elapsed = generator.elapsed.get(endpoint, sum(latencies))
+        queries = counter.counts.get(endpoint, 0)
+        print("%-10s %8d %8d %10.1f %9.2f %9.2f %9.2f %9d %9.2f" % (
+            endpoint, count, generator.errors.get(endpoint, 0), count / elapsed if elapsed > 0 else 0,
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000,
+            percentile(latencies, 0.99) * 1000, queries, queries / count if count > 0 else 0))
+    print("background queries %d" % counter.counts.get("background", 0))
+
+    samples = sampler.samples
+    print("request queue depth: mean %.2f, max %d (%d samples)" % (
+        sum(samples) / len(samples) if len(samples) > 0 else 0, max(samples) if len(samples) > 0 else 0, len(samples)))
+    scheduler = metrics["scheduler"]
+    print("scheduler: serve %d, preempt %d, cancel %d, pass p50 %.3fms p99 %.3fms" % (
+        scheduler["serveCount"], scheduler["preemptCount"], scheduler["cancelCount"],
+        scheduler["passDuration"]["p50"] * 1000, scheduler["passDuration"]["p99"] * 1000))
+    for speed in ("1", "2", "3"):
+        latency = scheduler["serveLatency"][speed]
+        print("  speed %s: served %d, enqueue->serve p50 %.3fs p95 %.3fs max %.3fs" % (
+            speed, latency["count"], latency["p50"], latency["p95"], latency["max"]))
+    if thermal is not None:
+        stats = thermal.getStats()
+        print("thermal: %d rooms, mean temperature %.2f, reached target %d" % (
+            stats["rooms"], stats["meanTemperature"], stats["reachedTarget"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+等待队列微基准
+对比旧的三个 list 线性扫描实现和 WaitQueue（按风速分队列 + roomNumber 索引）
+
+用法: python benchWaitQueue.py [房间数 ...]
+"""
+import random
+import sys
+import time
+
+from ACSystemControl.Modules.WaitQueue import WaitQueue
+
+
+class _AirRequest:
+    def __init__(self, roomNumber, targetSpeed):
+        self.roomNumber = roomNumber
+        self.targetSpeed = targetSpeed
+
+
+class ListWaitQueue:
+    """
+    旧实现：三个 list，查找/取消/替换都要扫描全部队列，出队用 pop(0)
+    """
+
+    def __init__(self):
+        self.lowSpeedQueue = []
+        self.midSpeedQueue = []
+        self.highSpeedQueue = []
+
+    def _queue(self, speed):
+        return (self.lowSpeedQueue, self.midSpeedQueue, self.highSpeedQueue)[speed - 1]
+
+    def put(self, airRequest):
+        self._queue(airRequest.targetSpeed).append(airRequest)
+
+    def get(self):
+        for queue in (self.highSpeedQueue, self.midSpeedQueue, self.lowSpeedQueue):
+            if len(queue) > 0:
+                return queue.pop(0)
+        return None
+
+    def find(self, roomNumber):
+        request = None
+        for queue in (self.lowSpeedQueue, self.midSpeedQueue, self.highSpeedQueue):
+            for item in queue:
+                if item.roomNumber == roomNumber:
+                    request = item
+        return request
+
+    def remove(self, roomNumber):
+        for queue in (self.lowSpeedQueue, self.midSpeedQueue, self.highSpeedQueue):
+            for idx, item in enumerate(queue):
+                if item.roomNumber == roomNumber:
+                    return queue.pop(idx)
+        return None
+
+    def replace(self, airRequest):
+        old = self.find(airRequest.roomNumber)
+        if old.targetSpeed == airRequest.targetSpeed:
+            queue = self._queue(old.targetSpeed)
+            queue[queue.index(old)] = airRequest
+        else:
+            self.remove(airRequest.roomNumber)
+            self.put(airRequest)
+        return old
+
+
+def workload(queue, roomNum, seed=0):
+    """
+    入队全部房间 -> 每个房间调一次温/风 -> 一半房间关机 -> 剩下的依次出队
+    :return: 出队顺序，用于校验两种实现结果一致
+    """
+    rnd = random.Random(seed)
+    rooms = list(range(1, roomNum + 1))
+    for room in rooms:
+        queue.put(_AirRequest(room, rnd.randint(1, 3)))
+
+    rnd.shuffle(rooms)
+    for room in rooms:
+        queue.find(room)
+        queue.replace(_AirRequest(room, rnd.randint(1, 3)))
+
+    for room in rooms[:roomNum // 2]:
+        queue.remove(room)
+
+    order = []
+    airRequest = queue.get()
+    while airRequest is not None:
+        order.append(airRequest.roomNumber)
+        airRequest = queue.get()
+    return order
+
+
+def bench(factory, roomNum):
+    start = time.perf_counter()
+    order = workload(factory(), roomNum)
+    return time.perf_counter() - start, order
+
+
+def main(argv):
+    sizes = [int(item) for item in argv] or [100, 1000, 5000]
+    print("%8s %12s %12s %8s" % ("rooms", "list(s)", "index(s)", "speedup"))
+    for roomNum in sizes:
+        listTime, listOrder = bench(ListWaitQueue, roomNum)
+        indexTime, indexOrder = bench(WaitQueue, roomNum)
+        assert listOrder == indexOrder
+        print("%8d %12.4f %12.4f %7.1fx" % (roomNum, listTime, indexTime, listTime / indexTime))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,76 @@
+"""
+调度器模拟
+用虚拟时钟回放房间请求轨迹，比较不同调度策略的等待时长、吞吐量和调度次数
+
+用法: python simulateScheduler.py [轨迹.csv] [--rooms N] [--instances N] [--minutes N] [--seed N] [--thermal]
+轨迹文件每行: time,roomNumber,type[,targetTemperature,targetSpeed]，不给出时随机生成
+"""
+import argparse
+import os
+import random
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ACSystem.settings')
+django.setup()
+
+from ACSystemControl.Modules.Simulator import Simulator, TraceEvent, loadTrace  # noqa: E402
+
+
+def randomTrace(roomNum, minutes, seed=0):
+    """
+    随机生成请求轨迹：每个房间开机之后不定时调温调风，偶尔休眠或关机再开机
+    :param roomNum: 房间数量
+    :param minutes: 时长（分钟）
+    :param seed: 随机种子
+    :return: [TraceEvent]
+    """
+    rnd = random.Random(seed)
+    trace = []
+    for roomNumber in range(1, roomNum + 1):
+        time = rnd.uniform(0, 60)
+        on = True
+        trace.append(TraceEvent(time, roomNumber, "on", rnd.randint(18, 25), rnd.randint(1, 3)))
+        while True:
+            time += rnd.expovariate(1 / 120)
+            if time >= minutes * 60:
+                break
+            if not on:
+                trace.append(TraceEvent(time, roomNumber, "on", rnd.randint(18, 25), rnd.randint(1, 3)))
+                on = True
+            elif rnd.random() < 0.1:
+                trace.append(TraceEvent(time, roomNumber, rnd.choice(("powerOff", "hibernate"))))
+                on = False
+            else:
+                trace.append(TraceEvent(time, roomNumber, "on", rnd.randint(18, 25), rnd.randint(1, 3)))
+    return trace
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace", nargs="?")
+    parser.add_argument("--rooms", type=int, default=200)
+    parser.add_argument("--instances", type=int, default=20)
+    parser.add_argument("--minutes", type=int, default=120)
+    parser.add_argument("--timeSlice", type=int, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--thermal", action="store_true")
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        trace = loadTrace(args.trace)
+    else:
+        trace = randomTrace(args.rooms, args.minutes, args.seed)
+
+    keys = ("serveCount", "preemptCount", "cancelCount", "throughput", "utilisation",
+            "meanWait", "p95Wait", "maxWait", "stillWaiting")
+    if args.thermal:
+        keys += ("meanTemperature", "reachedTarget")
+    print("%-10s" % "scheduler" + "".join("%16s" % key for key in keys))
+    for scheduler in ("priority", "round"):
+        result = Simulator(args.instances, scheduler, args.timeSlice, thermal=args.thermal).run(trace, args.minutes * 60)
+        print("%-10s" % scheduler + "".join("%16.2f" % result[key] for key in keys))
+
+
+if __name__ == '__main__':
+    main()